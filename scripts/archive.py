@@ -0,0 +1,137 @@
+# scripts/archive.py
+#
+# Archive of finished job workspaces (worker_data_finished/).
+#
+# A job is archived by renaming its workspace into the archive, which is a
+# single metadata operation when both live on the same filesystem. Only if
+# the rename crosses filesystems are the files hardlinked (or, failing that,
+# copied) over. Entries can optionally be packed into a compressed tarball
+# afterwards, and a retention policy removes the oldest entries once they
+# are older than `max_age_s` or the archive grows beyond `max_bytes`.
+#
+# All of this is blocking file I/O; the server runs it on a background thread.
+
+import os
+import shutil
+import tarfile
+import time
+import uuid
+from pathlib import Path
+
+ARCHIVE_PREFIX = "worker_data_"
+# tarfile compression of archived entries ("gz", "bz2", "xz"), or None to keep plain directories
+ARCHIVE_COMPRESSION = os.environ.get("SAM_ARCHIVE_COMPRESSION") or None
+ARCHIVE_MAX_AGE_S = float(os.environ.get("SAM_ARCHIVE_MAX_AGE_DAYS", "14")) * 86400
+ARCHIVE_MAX_BYTES = int(float(os.environ.get("SAM_ARCHIVE_MAX_GB", "50")) * 1024**3)
+# walking the archive for its size is not free, so retention runs at most this often
+RETENTION_INTERVAL_S = 60.0
+
+
+def _link_tree(src, dest):
+    def link(s, d):
+        try:
+            os.link(s, d)
+        except OSError:
+            shutil.copy2(s, d)
+    shutil.copytree(src, dest, copy_function=link, dirs_exist_ok=True)
+
+
+def _tree_size(path):
+    if path.is_file():
+        return path.stat().st_size
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_size
+            except OSError:
+                continue
+    return total
+
+
+class JobArchive:
+    def __init__(self, root, compression=ARCHIVE_COMPRESSION,
+                 max_age_s=ARCHIVE_MAX_AGE_S, max_bytes=ARCHIVE_MAX_BYTES):
+        self.root = Path(root)
+        self.compression = compression
+        self.max_age_s = max_age_s
+        self.max_bytes = max_bytes
+        self._last_retention = 0.0
+
+    def entry_path(self, job_id):
+        return self.root / f"{ARCHIVE_PREFIX}{job_id}"
+
+    def add(self, job_id, job_dir):
+        """Move the workspace `job_dir` into the archive; returns the archive entry."""
+        self.root.mkdir(parents=True, exist_ok=True)
+        dest = self.entry_path(job_id)
+        try:
+            os.rename(job_dir, dest)
+        except OSError:
+            # another filesystem, or archived before (rename won't replace a non-empty dir)
+            _link_tree(job_dir, dest)
+            shutil.rmtree(job_dir, ignore_errors=True)
+        # retention counts from the time of archiving
+        os.utime(dest)
+        if self.compression:
+            dest = self.compress(dest)
+        return dest
+
+    def compress(self, entry):
+        """Replace the directory `entry` with <entry>.tar.<compression>."""
+        tar_path = entry.with_name(f"{entry.name}.tar.{self.compression}")
+        tmp_path = self.root / f".tmp-{uuid.uuid4().hex}"
+        try:
+            with tarfile.open(tmp_path, f"w:{self.compression}") as tar:
+                tar.add(entry, arcname=entry.name)
+            os.replace(tmp_path, tar_path)
+        except (OSError, tarfile.TarError):
+            # keep the plain directory
+            tmp_path.unlink(missing_ok=True)
+            return entry
+        shutil.rmtree(entry, ignore_errors=True)
+        return tar_path
+
+    def _entries(self):
+        entries = []
+        for p in self.root.iterdir():
+            if not p.name.startswith(ARCHIVE_PREFIX):
+                continue
+            try:
+                entries.append((p.stat().st_mtime, _tree_size(p), p))
+            except OSError:
+                continue
+        return entries
+
+    def enforce_retention(self, force=False):
+        """Remove entries past `max_age_s`, then the oldest until the archive fits `max_bytes`.
+
+        Returns the removed entries.
+        """
+        now = time.time()
+        if not self.root.exists() or (not force and now - self._last_retention < RETENTION_INTERVAL_S):
+            return []
+        self._last_retention = now
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        removed = []
+        for mtime, size, p in entries:
+            if now - mtime <= self.max_age_s and total <= self.max_bytes:
+                break
+            if p.is_dir():
+                shutil.rmtree(p, ignore_errors=True)
+            else:
+                p.unlink(missing_ok=True)
+            total -= size
+            removed.append(p.name)
+        return removed
+
+    def stats(self):
+        entries = self._entries() if self.root.exists() else []
+        return {
+            "entries": len(entries),
+            "bytes": sum(size for _, size, _ in entries),
+            "max_bytes": self.max_bytes,
+            "max_age_s": self.max_age_s,
+            "compression": self.compression,
+        }
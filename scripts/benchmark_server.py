@@ -0,0 +1,312 @@
+# scripts/benchmark_server.py
+#
+# End-to-end benchmark of the server's own overhead: upload handling, queue
+# handoff, status polling, archiving and downloads.
+#
+# The server is started with stub workers (see stub_worker.py) that sleep for
+# a configurable time instead of running the models, so this runs on a
+# CPU-only box. N concurrent clients each loop through
+# submit -> poll /status -> download every artifact, and the script reports
+# latency percentiles, jobs/sec and the queueing time per stage.
+#
+#   python scripts/benchmark_server.py --clients 8 --jobs 64 --sam3d-replicas 2 \
+#       --service "sam3=0.2,sam3d=1.0"
+#
+# With --url an already running server is benchmarked instead.
+# Only the standard library is used on the client side.
+
+import argparse
+import json
+import os
+import random
+import signal
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+import zlib
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+STATUS_POLL_S = 0.05
+SERVER_START_TIMEOUT_S = 120.0
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * q / 100.0
+    lo, hi = int(k), min(int(k) + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def make_png(width=64, height=48):
+    """A small random RGB PNG; every upload is unique, so the result cache never answers."""
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+    rows = b"".join(b"\x00" + os.urandom(width * 3) for _ in range(height))
+    return (b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(rows, 1))
+            + chunk(b"IEND", b""))
+
+
+def multipart(fields, files):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, (filename, content, content_type) in files.items():
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+            f"Content-Type: {content_type}\r\n\r\n".encode() + content + b"\r\n"
+        )
+    parts.append(f"--{boundary}--\r\n".encode())
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+
+class Client:
+    def __init__(self, base_url, timeout=30.0):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+
+    def request(self, path, data=None, headers=None):
+        req = urllib.request.Request(self.base_url + path, data=data, headers=headers or {})
+        with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+            return resp.status, resp.read(), resp.headers
+
+    def get_json(self, path):
+        return json.loads(self.request(path)[1])
+
+    def submit(self, prompt, priority, artifacts="default", image=None):
+        body, content_type = multipart(
+            {"prompt": prompt, "priority": priority, "artifacts": artifacts},
+            {"image": ("job.png", image or make_png(), "image/png")},
+        )
+        return json.loads(self.request("/submit", body, {"Content-Type": content_type})[1])
+
+
+def run_job(client, args, results, lock, image=None):
+    record = {"rejected": 0}
+    t0 = time.perf_counter()
+    while True:
+        try:
+            submitted = client.submit(args.prompt, args.priority, args.artifacts, image)
+            break
+        except urllib.error.HTTPError as e:
+            if e.code != 429:
+                raise
+            # admission control: back off as told
+            record["rejected"] += 1
+            time.sleep(float(e.headers.get("Retry-After", "1")))
+    t_submitted = time.perf_counter()
+    job_id = submitted["job_id"]
+
+    polls = 0
+    while True:
+        status = client.get_json(f"/status/{job_id}")
+        polls += 1
+        if status["status"] != "processing":
+            break
+        time.sleep(STATUS_POLL_S)
+    t_finished = time.perf_counter()
+
+    downloaded = 0
+    if args.bundle:
+        # one streamed archive instead of a request per artifact
+        downloaded += len(client.request(f"/download/{job_id}/bundle?format={args.bundle}")[1])
+    else:
+        for name in client.get_json(f"/list/{job_id}")["files"]:
+            downloaded += len(client.request(f"/download/{job_id}/{name}")[1])
+    t_done = time.perf_counter()
+
+    timestamps = status["timestamps"]
+    stages = {s["stage"]: s for s in status["stages"]}
+    queueing = {}
+    # time a job waited in front of each stage
+    if "sam3" in stages and stages["sam3"].get("started_at"):
+        queueing["sam3"] = stages["sam3"]["started_at"] - timestamps["queued"]
+    if "sam3" in stages and "sam3d" in stages and stages["sam3d"].get("started_at"):
+        queueing["sam3d"] = stages["sam3d"]["started_at"] - stages["sam3"]["completed_at"]
+
+    record.update({
+        "job_id": job_id,
+        "status": status["status"],
+        "cached": submitted.get("cached", False),
+        "submit_s": t_submitted - t0,
+        "processing_s": t_finished - t_submitted,
+        "download_s": t_done - t_finished,
+        "total_s": t_done - t0,
+        "polls": polls,
+        "bytes": downloaded,
+        "queueing_s": queueing,
+    })
+    with lock:
+        results.append(record)
+
+
+def run_clients(base_url, args):
+    client = Client(base_url)
+    results, errors = [], []
+    lock = threading.Lock()
+    remaining = iter(range(args.jobs))
+    # with --images N, uploads cycle through N images, so repeats can be answered from the result cache
+    images = [make_png() for _ in range(args.images)]
+
+    def worker():
+        while True:
+            with lock:
+                i = next(remaining, None)
+                if i is None:
+                    return
+            try:
+                run_job(client, args, results, lock, images[i % len(images)] if images else None)
+            except Exception as e:
+                with lock:
+                    errors.append(repr(e))
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(args.clients)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results, errors, time.perf_counter() - start
+
+
+def summarize(results, errors, wall_s, args):
+    def dist(values):
+        return {
+            "p50": percentile(values, 50),
+            "p95": percentile(values, 95),
+            "p99": percentile(values, 99),
+            "max": max(values) if values else None,
+        }
+
+    queueing = {}
+    for r in results:
+        for stage, seconds in r["queueing_s"].items():
+            queueing.setdefault(stage, []).append(seconds)
+    return {
+        "clients": args.clients,
+        "jobs": len(results),
+        "errors": len(errors),
+        "rejected_429": sum(r["rejected"] for r in results),
+        "cached": sum(1 for r in results if r["cached"]),
+        "wall_s": wall_s,
+        "jobs_per_s": len(results) / wall_s if wall_s > 0 else 0.0,
+        "latency_s": {
+            "total": dist([r["total_s"] for r in results]),
+            "submit": dist([r["submit_s"] for r in results]),
+            "processing": dist([r["processing_s"] for r in results]),
+            "download": dist([r["download_s"] for r in results]),
+        },
+        "queueing_s": {stage: dist(values) for stage, values in queueing.items()},
+        "statuses": {s: sum(1 for r in results if r["status"] == s) for s in {r["status"] for r in results}},
+        "error_samples": errors[:5],
+    }
+
+
+def print_report(summary):
+    def fmt(v):
+        return "-" if v is None else f"{v * 1000:9.1f}"
+
+    print(f"{summary['jobs']} jobs from {summary['clients']} clients in {summary['wall_s']:.2f}s "
+          f"({summary['jobs_per_s']:.2f} jobs/s), {summary['errors']} errors, "
+          f"{summary['rejected_429']} submissions rejected with 429, {summary['cached']} answered from the cache")
+    print(f"{'ms':<22}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+    rows = [(f"latency {k}", v) for k, v in summary["latency_s"].items()]
+    rows += [(f"queueing {k}", v) for k, v in summary["queueing_s"].items()]
+    for label, d in rows:
+        print(f"{label:<22}{fmt(d['p50']):>10}{fmt(d['p95']):>10}{fmt(d['p99']):>10}{fmt(d['max']):>10}")
+    for sample in summary["error_samples"]:
+        print(f"error: {sample}")
+
+
+def start_server(args, data_dir):
+    env = dict(
+        os.environ,
+        SAM_WORKER_DATA=str(data_dir / "worker_data"),
+        SAM_STUB_WORKERS="1",
+        SAM_STUB_SERVICE_S=args.service,
+        SAM3_REPLICAS=str(args.sam3_replicas),
+        SAM3D_REPLICAS=str(args.sam3d_replicas),
+    )
+    cmd = [sys.executable, "-m", "uvicorn", "scripts.sam_server:app",
+           "--host", "127.0.0.1", "--port", str(args.port), "--log-level", "warning"]
+    # own process group, so the stub workers started by the server go down with it
+    proc = subprocess.Popen(cmd, cwd=REPO_ROOT, env=env, start_new_session=True)
+    base_url = f"http://127.0.0.1:{args.port}"
+    client = Client(base_url, timeout=2.0)
+    deadline = time.monotonic() + SERVER_START_TIMEOUT_S
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"server exited with {proc.returncode}")
+        try:
+            if client.get_json("/ready")["ready"]:
+                return proc, base_url
+        except (OSError, ValueError):
+            pass
+        time.sleep(0.2)
+    stop_server(proc)
+    raise RuntimeError("server did not become ready")
+
+
+def stop_server(proc):
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        return
+    try:
+        proc.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        os.killpg(proc.pid, signal.SIGKILL)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end server benchmark with stub workers")
+    parser.add_argument("--clients", type=int, default=4, help="concurrent clients")
+    parser.add_argument("--jobs", type=int, default=32, help="jobs in total")
+    parser.add_argument("--service", default="sam3=0.2,sam3d=1.0", help="stub service time per stage in seconds")
+    parser.add_argument("--sam3-replicas", type=int, default=1)
+    parser.add_argument("--sam3d-replicas", type=int, default=1)
+    parser.add_argument("--prompt", default="red cup")
+    parser.add_argument("--priority", default="normal")
+    parser.add_argument("--artifacts", default="default", help="outputs to request, e.g. visual,collision or all")
+    parser.add_argument("--images", type=int, default=0,
+                        help="cycle through this many distinct images (default: every upload is unique)")
+    parser.add_argument("--bundle", choices=["zip", "tar"], help="download each job as one bundle instead of file by file")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--url", help="benchmark a running server instead of starting one")
+    parser.add_argument("--json", help="also write the summary to this file")
+    args = parser.parse_args()
+
+    proc = None
+    with tempfile.TemporaryDirectory(prefix="sam_bench_") as tmp:
+        if args.url:
+            base_url = args.url
+        else:
+            proc, base_url = start_server(args, Path(tmp))
+        try:
+            results, errors, wall_s = run_clients(base_url, args)
+            stages = Client(base_url).get_json("/stages")
+        finally:
+            if proc is not None:
+                stop_server(proc)
+
+    summary = summarize(results, errors, wall_s, args)
+    summary["stages"] = stages
+    print_report(summary)
+    if args.json:
+        Path(args.json).write_text(json.dumps(summary, indent=2))
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,246 @@
+# scripts/cache.py
+#
+# Small caches shared by the workers and the server.
+
+import hashlib
+import os
+import shutil
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+
+try:
+    from scripts.job_store import WORKER_DATA
+except ImportError:  # workers import the scripts/ modules directly
+    from job_store import WORKER_DATA
+
+# next to the job store (worker_data_cache/ beside worker_data/), so a scratch
+# job store (SAM_WORKER_DATA) gets a scratch cache; SAM_CACHE_DIR moves it
+# elsewhere. Unlike job workspaces, which are archived once downloaded,
+# entries stay until they are evicted.
+CACHE_ROOT = Path(os.environ.get("SAM_CACHE_DIR") or WORKER_DATA.parent / f"{WORKER_DATA.name}_cache")
+RESULT_CACHE_DIR = CACHE_ROOT / "results"
+RESULT_CACHE_MAX_BYTES = 20 * 1024**3
+
+
+def file_sha256(path, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def content_key(*parts):
+    """Stable key for a tuple of strings/bytes (e.g. image hash, prompt, config)."""
+    h = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode("utf-8")
+        h.update(hashlib.sha256(part).digest())
+    return h.hexdigest()
+
+
+def nbytes(obj):
+    """Approximate memory held by tensors/arrays nested in dicts, lists and tuples."""
+    if isinstance(obj, dict):
+        return sum(nbytes(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(nbytes(v) for v in obj)
+    if hasattr(obj, "element_size") and hasattr(obj, "nelement"):  # torch.Tensor
+        return obj.element_size() * obj.nelement()
+    if hasattr(obj, "nbytes"):  # numpy.ndarray
+        return int(obj.nbytes)
+    return 0
+
+
+class LRUCache:
+    """In-memory LRU cache bounded by an approximate byte size.
+
+    `sizeof(value)` estimates the footprint of an entry; the least recently used
+    entries are evicted until the total fits into `max_bytes`.
+    """
+
+    def __init__(self, max_bytes, sizeof=nbytes):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self._entries = OrderedDict()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        if key in self._entries:
+            self.current_bytes -= self._entries.pop(key)[1]
+        if size > self.max_bytes:
+            # would evict everything else and still not fit
+            return False
+        self._entries[key] = (value, size)
+        self.current_bytes += size
+        while self.current_bytes > self.max_bytes:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self.current_bytes -= evicted_size
+            self.evictions += 1
+        return True
+
+    def clear(self):
+        self._entries.clear()
+        self.current_bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class ArtifactStore:
+    """Content-addressed on-disk store of finished job outputs.
+
+    Each entry is a directory <root>/<key>/ holding the artifact files and a
+    `.status` file. The directory mtime records the last use; once the store
+    grows beyond `max_bytes` the least recently used entries are removed.
+    Entries are written to a temporary directory and renamed into place, so a
+    reader never sees a half-written entry.
+    """
+
+    STATUS_FILE = ".status"
+
+    def __init__(self, root, max_bytes):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def _entry_dir(self, key):
+        return self.root / key
+
+    def get(self, key, dest_dir):
+        """Materialize the entry into `dest_dir`; returns its status or None on a miss."""
+        entry = self._entry_dir(key)
+        try:
+            status = (entry / self.STATUS_FILE).read_text().strip()
+            dest_dir = Path(dest_dir)
+            dest_dir.mkdir(parents=True, exist_ok=True)
+            for f in entry.iterdir():
+                if f.name == self.STATUS_FILE or not f.is_file():
+                    continue
+                try:
+                    os.link(f, dest_dir / f.name)
+                except OSError:
+                    shutil.copy2(f, dest_dir / f.name)
+            os.utime(entry)
+        except OSError:
+            # missing, or evicted while we were reading it
+            self.misses += 1
+            return None
+        self.hits += 1
+        return status
+
+    def put(self, key, src_dir, status="done"):
+        entry = self._entry_dir(key)
+        if entry.exists():
+            os.utime(entry)
+            return
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmp_dir = self.root / f".tmp-{uuid.uuid4().hex}"
+        tmp_dir.mkdir()
+        try:
+            for f in Path(src_dir).iterdir():
+                if f.is_file():
+                    try:
+                        os.link(f, tmp_dir / f.name)
+                    except OSError:
+                        shutil.copy2(f, tmp_dir / f.name)
+            (tmp_dir / self.STATUS_FILE).write_text(status)
+            os.rename(tmp_dir, entry)
+        except OSError:
+            # another process stored the same key first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+        self.evict()
+
+    def add_file(self, key, path, replaces=None):
+        """Add a file produced after the entry was stored (e.g. an on-demand
+        render) to an existing entry, dropping the file named `replaces`."""
+        entry = self._entry_dir(key)
+        if not entry.is_dir():
+            return False
+        path = Path(path)
+        tmp_path = entry / f".{path.name}.{uuid.uuid4().hex}.tmp"
+        try:
+            try:
+                os.link(path, tmp_path)
+            except OSError:
+                shutil.copy2(path, tmp_path)
+            os.replace(tmp_path, entry / path.name)
+        except OSError:
+            # evicted meanwhile
+            return False
+        finally:
+            # renaming a hard link onto another link of the same file is a no-op
+            tmp_path.unlink(missing_ok=True)
+        if replaces:
+            try:
+                (entry / replaces).unlink()
+            except FileNotFoundError:
+                pass
+        return True
+
+    def _entries(self):
+        entries = []
+        for d in self.root.iterdir():
+            if d.name.startswith(".") or not d.is_dir():
+                continue
+            try:
+                size = sum(f.stat().st_size for f in d.iterdir() if f.is_file())
+                entries.append((d.stat().st_mtime, size, d))
+            except OSError:
+                continue
+        return entries
+
+    def evict(self):
+        if not self.root.exists():
+            return
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, d in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(d, ignore_errors=True)
+            total -= size
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        entries = self._entries() if self.root.exists() else []
+        return {
+            "entries": len(entries),
+            "bytes": sum(size for _, size, _ in entries),
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
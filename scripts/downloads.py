@@ -0,0 +1,224 @@
+# scripts/downloads.py
+#
+# HTTP helpers for artifact downloads: conditional and ranged single-file
+# responses, and zip/tar bundles streamed as they are generated.
+#
+# Published artifacts are never modified in place (they are written to a
+# temporary file and renamed), so mtime and size identify a version of a file
+# and make a cheap ETag.
+
+import mimetypes
+import os
+import stat
+import tarfile
+import zipfile
+from email.utils import formatdate
+from urllib.parse import quote
+
+from fastapi.responses import Response, StreamingResponse
+
+CHUNK_SIZE = 1 << 20
+BUNDLE_FORMATS = {"zip": "application/zip", "tar": "application/x-tar"}
+
+
+def file_etag(st):
+    return f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+
+
+def etag_matches(header, etag):
+    if header is None:
+        return False
+    if header.strip() == "*":
+        return True
+    # weak comparison, as If-None-Match asks for
+    tags = [t.strip().removeprefix("W/") for t in header.split(",")]
+    return etag in tags
+
+
+def parse_range(header, size):
+    """(start, end) inclusive for a single "bytes=" range, None to serve the whole file.
+
+    Raises ValueError if the range cannot be satisfied.
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        # multiple ranges are legal to ignore
+        return None
+    first, _, last = header[len("bytes="):].strip().partition("-")
+    try:
+        start = int(first) if first else None
+        end = int(last) if last else None
+    except ValueError:
+        # malformed, ignored like an absent header
+        return None
+    if start is None:
+        if end is None:
+            return None
+        # suffix range: the last N bytes
+        if end <= 0 or size == 0:
+            raise ValueError(header)
+        return max(0, size - end), size - 1
+    if end is None:
+        end = size - 1
+    elif end < start:
+        # syntactically invalid (RFC 7233 2.1), ignored like a malformed header
+        return None
+    if start >= size:
+        raise ValueError(header)
+    return start, min(end, size - 1)
+
+
+def read_chunks(f, start=0, length=None, chunk_size=CHUNK_SIZE):
+    f.seek(start)
+    remaining = length
+    while remaining is None or remaining > 0:
+        chunk = f.read(chunk_size if remaining is None else min(chunk_size, remaining))
+        if not chunk:
+            return
+        if remaining is not None:
+            remaining -= len(chunk)
+        yield chunk
+
+
+def iter_file(path, start=0, length=None, chunk_size=CHUNK_SIZE):
+    with open(path, "rb") as f:
+        yield from read_chunks(f, start, length, chunk_size)
+
+
+def content_disposition(filename):
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"attachment; filename*=utf-8''{quoted}"
+    return f'attachment; filename="{filename}"'
+
+
+def file_response(request, path, filename, on_complete=None):
+    """Serve `path` honoring If-None-Match, Range and If-Range.
+
+    `on_complete()` is called when the client has the whole file: after the
+    last byte of a full response or of a range reaching the end of the file
+    has been sent, or right away for a 304. The file is opened here, so a
+    workspace archived (renamed) meanwhile does not break the response.
+    Returns None if the file does not exist.
+    """
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return None
+    st = os.fstat(f.fileno())
+    etag = file_etag(st)
+    headers = {"ETag": etag, "Accept-Ranges": "bytes"}
+
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        f.close()
+        if on_complete is not None:
+            on_complete()
+        return Response(status_code=304, headers=headers)
+
+    byte_range = None
+    if_range = request.headers.get("if-range")
+    # a range of a different version of the file would corrupt the client's copy
+    if if_range is None or if_range.strip() == etag:
+        try:
+            byte_range = parse_range(request.headers.get("range"), st.st_size)
+        except ValueError:
+            f.close()
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{st.st_size}"})
+
+    start, end = byte_range or (0, st.st_size - 1)
+    headers.update({
+        "Content-Length": str(end - start + 1),
+        "Content-Disposition": content_disposition(filename),
+        "Last-Modified": formatdate(st.st_mtime, usegmt=True),
+    })
+    if byte_range is not None:
+        headers["Content-Range"] = f"bytes {start}-{end}/{st.st_size}"
+
+    def body():
+        try:
+            yield from read_chunks(f, start, end - start + 1)
+        finally:
+            f.close()
+        # resumed once the last chunk has been sent
+        if end == st.st_size - 1 and on_complete is not None:
+            on_complete()
+
+    return StreamingResponse(
+        body(),
+        status_code=200 if byte_range is None else 206,
+        headers=headers,
+        media_type=mimetypes.guess_type(filename)[0] or "application/octet-stream",
+    )
+
+
+class _Pipe:
+    """Write-only sink that hands out what has been written so far."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def iter_zip(files):
+    """Stream a zip of `files` ((arcname, path) pairs). Entries are stored, not
+    deflated: most artifacts (PNG, GIF, GLB) are compressed already."""
+    pipe = _Pipe()
+    # an unseekable sink makes zipfile write data descriptors instead of seeking back
+    with zipfile.ZipFile(pipe, "w", compression=zipfile.ZIP_STORED, allowZip64=True) as zf:
+        for arcname, path in files:
+            info = zipfile.ZipInfo.from_file(path, arcname)
+            info.compress_type = zipfile.ZIP_STORED
+            with zf.open(info, "w", force_zip64=True) as dest:
+                for chunk in iter_file(path):
+                    dest.write(chunk)
+                    yield pipe.take()
+            yield pipe.take()
+    yield pipe.take()
+
+
+def iter_tar(files):
+    """Stream an uncompressed ustar/pax archive of `files` ((arcname, path) pairs)."""
+    for arcname, path in files:
+        st = os.stat(path)
+        info = tarfile.TarInfo(arcname)
+        info.size = st.st_size
+        info.mtime = int(st.st_mtime)
+        info.mode = stat.S_IMODE(st.st_mode)
+        yield info.tobuf(format=tarfile.PAX_FORMAT)
+        written = 0
+        # stop at the announced size even if the file grew meanwhile
+        for chunk in iter_file(path, length=st.st_size):
+            written += len(chunk)
+            yield chunk
+        if written < st.st_size:
+            raise OSError(f"{path} shrank while being archived")
+        padding = -st.st_size % tarfile.BLOCKSIZE
+        if padding:
+            yield tarfile.NUL * padding
+    # end-of-archive marker
+    yield tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+
+
+def bundle_response(files, name, fmt="zip", on_complete=None):
+    """StreamingResponse with a zip or tar of `files`; `on_complete()` runs
+    once the last byte has been produced."""
+    def stream():
+        yield from (iter_zip(files) if fmt == "zip" else iter_tar(files))
+        if on_complete is not None:
+            on_complete()
+
+    return StreamingResponse(
+        (chunk for chunk in stream() if chunk),
+        media_type=BUNDLE_FORMATS[fmt],
+        headers={"Content-Disposition": f'attachment; filename="{name}.{fmt}"'},
+    )
@@ -0,0 +1,41 @@
+# scripts/image_io.py
+#
+# Upload validation and the one decode of a job's image.
+#
+# The server checks the first bytes of an upload against the formats below
+# before it writes the rest. SAM3 then decodes the image once with
+# decode_image() and hands the decoded array on to SAM-3D through shared
+# memory; SAM-3D only decodes again (with the same function, so the size
+# matches the masks) when that handoff is gone.
+
+# SAM3 resizes its input to this square resolution
+MODEL_INPUT_SIZE = 1008
+
+IMAGE_SIGNATURES = {
+    "jpeg": b"\xff\xd8\xff",
+    "png": b"\x89PNG\r\n\x1a\n",
+}
+
+
+def sniff_image_type(head):
+    """Format of an upload from its first bytes, or None if it is not supported."""
+    for fmt, magic in IMAGE_SIGNATURES.items():
+        if head.startswith(magic):
+            return fmt
+    return None
+
+
+def decode_image(path, min_side=MODEL_INPUT_SIZE):
+    """RGB PIL image of `path`.
+
+    Large JPEGs are decoded in draft mode: libjpeg scales them down by 1/2,
+    1/4 or 1/8 while decoding, as far as both sides stay at least `min_side`,
+    which is much cheaper than a full decode followed by a resize. Pass
+    min_side=None for the full resolution.
+    """
+    from PIL import Image
+
+    image = Image.open(path)
+    if min_side and image.format == "JPEG":
+        image.draft("RGB", (min_side, min_side))
+    return image.convert("RGB")
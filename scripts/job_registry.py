@@ -0,0 +1,258 @@
+# scripts/job_registry.py
+#
+# Indexed job registry: state, timestamps, completed stages, artifact manifest
+# and download progress of every job.
+#
+# Records live in an in-memory dict. With a `path`, every change is written
+# through to a SQLite database (WAL mode), which the worker processes update
+# as well, and which keeps the job state across server restarts. Changes from
+# other processes are picked up by re-reading the row on every lookup (a
+# primary-key lookup); jobs keep changing after they have finished, e.g. when
+# on-demand renders or further collision LODs are requested and published.
+
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+# queued -> processing -> done | no_masks_detected -> retrieved -> archived
+# a job whose deadline passes before a worker gets to it ends up "expired",
+# one a worker could not process (or that kept taking replicas down) "failed"
+TERMINAL_STATES = ("done", "no_masks_detected", "retrieved", "archived", "expired", "failed")
+
+
+class JobRegistry:
+    def __init__(self, path=None):
+        self._jobs = {}
+        self._lock = threading.RLock()
+        self._db = None
+        if path is not None:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(str(path), timeout=30.0, isolation_level=None, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "job_id TEXT PRIMARY KEY, state TEXT NOT NULL, data TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs(state)")
+
+    def _load(self, job_id):
+        row = self._db.execute("SELECT data FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _store(self, job):
+        self._db.execute(
+            "INSERT OR REPLACE INTO jobs (job_id, state, data, updated_at) VALUES (?, ?, ?, ?)",
+            (job["job_id"], job["state"], json.dumps(job), job["updated_at"]),
+        )
+
+    def _modify(self, job_id, fn):
+        # read-modify-write; BEGIN IMMEDIATE serializes it against the other processes
+        with self._lock:
+            if self._db is not None:
+                self._db.execute("BEGIN IMMEDIATE")
+                try:
+                    job = self._load(job_id)
+                    if job is None:
+                        raise KeyError(job_id)
+                    result = fn(job)
+                    job["updated_at"] = time.time()
+                    self._store(job)
+                    self._db.execute("COMMIT")
+                except BaseException:
+                    self._db.execute("ROLLBACK")
+                    raise
+            else:
+                job = self._jobs.get(job_id)
+                if job is None:
+                    raise KeyError(job_id)
+                result = fn(job)
+                job["updated_at"] = time.time()
+            self._jobs[job_id] = job
+            return result
+
+    # ---- lookups ----
+
+    def get(self, job_id):
+        """The job record (treat as read-only), or None for an unknown job."""
+        with self._lock:
+            if self._db is None:
+                return self._jobs.get(job_id)
+            job = self._load(job_id)
+            if job is not None:
+                self._jobs[job_id] = job
+            return job
+
+    def jobs_in_state(self, state):
+        with self._lock:
+            if self._db is not None:
+                rows = self._db.execute("SELECT job_id FROM jobs WHERE state = ?", (state,)).fetchall()
+                return [r[0] for r in rows]
+            return [job_id for job_id, job in self._jobs.items() if job["state"] == state]
+
+    def jobs_idle_since(self, states, cutoff):
+        """Jobs in one of `states` that have not changed since `cutoff` (a time.time())."""
+        with self._lock:
+            if self._db is not None:
+                marks = ",".join("?" * len(states))
+                rows = self._db.execute(
+                    f"SELECT job_id FROM jobs WHERE state IN ({marks}) AND updated_at < ?", (*states, cutoff)
+                ).fetchall()
+                return [r[0] for r in rows]
+            return [job_id for job_id, job in self._jobs.items()
+                    if job["state"] in states and job["updated_at"] < cutoff]
+
+    def count_by_state(self):
+        with self._lock:
+            if self._db is not None:
+                return dict(self._db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+            counts = {}
+            for job in self._jobs.values():
+                counts[job["state"]] = counts.get(job["state"], 0) + 1
+            return counts
+
+    # ---- updates ----
+
+    def create(self, job_id, **fields):
+        now = time.time()
+        job = {
+            "job_id": job_id,
+            "state": "queued",
+            "created_at": now,
+            "updated_at": now,
+            "timestamps": {"queued": now},
+            "stages": {},
+            "artifacts": {},
+            "masks": [],
+            "downloads": [],
+        }
+        job.update(fields)
+        with self._lock:
+            if self._db is not None:
+                self._store(job)
+            self._jobs[job_id] = job
+        return job
+
+    def update(self, job_id, **fields):
+        self._modify(job_id, lambda job: job.update(fields))
+
+    def set_state(self, job_id, state):
+        def apply(job):
+            job["state"] = state
+            job["timestamps"][state] = time.time()
+        self._modify(job_id, apply)
+
+    def mark_stage_started(self, job_id, stage):
+        # with the completion times this gives the queueing time per stage
+        self._modify(job_id, lambda job: job.setdefault("started", {}).__setitem__(stage, time.time()))
+
+    def mark_stage(self, job_id, stage):
+        self._modify(job_id, lambda job: job["stages"].__setitem__(stage, time.time()))
+
+    def add_artifacts(self, job_id, artifacts):
+        """Register published files; `artifacts` maps file name -> size in bytes."""
+        def apply(job):
+            now = time.time()
+            for name, size in artifacts.items():
+                # re-registering a file keeps its original publish time
+                job["artifacts"].setdefault(name, {"size": size, "published_at": now})
+        self._modify(job_id, apply)
+
+    def set_masks(self, job_id, names):
+        self.update(job_id, masks=sorted(names))
+
+    def expire_if_due(self, job_id, now=None):
+        """Mark a job whose deadline has passed as expired; returns True if it was."""
+        now = now or time.time()
+        job = self.get(job_id)
+        if job is None or job.get("deadline") is None or now < job["deadline"]:
+            return False
+        def apply(job):
+            deadline = job.get("deadline")
+            if deadline is None or now < deadline or job["state"] in TERMINAL_STATES:
+                return False
+            job["state"] = "expired"
+            job["timestamps"]["expired"] = now
+            return True
+        return self._modify(job_id, apply)
+
+    def fail(self, job_id, error):
+        """Give up on a job; `error` says why."""
+        def apply(job):
+            job["state"] = "failed"
+            job["timestamps"]["failed"] = time.time()
+            job["error"] = error
+        self._modify(job_id, apply)
+
+    def count_requeue(self, job_id, queue):
+        """Count a re-queue of a job on `queue` after the replica holding it failed;
+        returns how often that has happened."""
+        def apply(job):
+            requeues = job.setdefault("requeues", {})
+            requeues[queue] = requeues.get(queue, 0) + 1
+            return requeues[queue]
+        return self._modify(job_id, apply)
+
+    def request_collision_lods(self, job_id, lods):
+        """Queue further collision LODs for a finished job; returns all pending ones."""
+        def apply(job):
+            pending = job.setdefault("collision_requests", [])
+            pending.extend(lod for lod in lods if lod not in pending)
+            # new files are coming, don't archive the job before they have been downloaded
+            if job["state"] == "retrieved":
+                job["state"] = "done"
+            return list(pending)
+        return self._modify(job_id, apply)
+
+    def complete_collision_lods(self, job_id, lods):
+        def apply(job):
+            job["collision_requests"] = [lod for lod in job.get("collision_requests", []) if lod not in lods]
+        self._modify(job_id, apply)
+
+    def add_on_demand(self, job_id, names):
+        """Register artifacts that are only rendered when they are first downloaded."""
+        def apply(job):
+            on_demand = job.setdefault("on_demand", [])
+            on_demand.extend(n for n in names if n not in on_demand and n not in job["artifacts"])
+        self._modify(job_id, apply)
+
+    def request_render(self, job_id, name):
+        """Ask for an on-demand artifact; returns True if a render has to be queued
+        (False if it is rendered already or a request is pending)."""
+        def apply(job):
+            pending = job.setdefault("render_requests", [])
+            if name in job["artifacts"] or name in pending:
+                return False
+            pending.append(name)
+            # the new file has to be downloaded before the job is archived
+            if job["state"] == "retrieved":
+                job["state"] = "done"
+            return True
+        return self._modify(job_id, apply)
+
+    def complete_render(self, job_id, names):
+        """Close the render requests for `names`; the ones that were published are
+        no longer on demand, the others failed."""
+        def apply(job):
+            job["render_requests"] = [n for n in job.get("render_requests", []) if n not in names]
+            job["on_demand"] = [n for n in job.get("on_demand", []) if n not in job["artifacts"]]
+        self._modify(job_id, apply)
+
+    def record_download(self, job_id, filename):
+        """Track a download; returns True once a finished job is fully retrieved."""
+        return self.record_downloads(job_id, [filename])
+
+    def record_downloads(self, job_id, filenames):
+        def apply(job):
+            for filename in filenames:
+                if filename not in job["downloads"]:
+                    job["downloads"].append(filename)
+            # on-demand files that were never requested don't count, they are not
+            # rendered unless someone asks for them (see request_render)
+            if job["state"] in ("done", "no_masks_detected") and set(job["downloads"]) >= set(job["artifacts"]):
+                job["state"] = "retrieved"
+                job["timestamps"]["retrieved"] = time.time()
+                return True
+            return False
+        return self._modify(job_id, apply)
@@ -0,0 +1,314 @@
+# scripts/job_store.py
+#
+# Per-job workspaces and the FIFO stage queues the workers pull from.
+#
+# Every submitted job gets its own directory under worker_data/jobs/<job_id>/,
+# so concurrent submissions never share files. Handing a job to a stage means
+# dropping an entry file into worker_data/queues/<stage>/pending/; a worker
+# claims it by renaming the entry into active/<worker_id>/, which is atomic,
+# so two replicas can never pick up the same job, and the jobs a crashed
+# replica held can be put back by its supervisor. Entries are named
+# <priority>_<enqueue time>_<job_id>, so sorting them yields priority order
+# and FIFO within a priority class. They are empty, except for requests about
+# a finished job (collision LODs, on-demand renders), which carry what was
+# asked for as JSON. Idle workers block on a JobWaiter (see notify.py)
+# watching pending/ and are woken as soon as an entry lands.
+
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+
+try:
+    from scripts.notify import REMOVED_EVENTS, make_waiter, notify
+except ImportError:  # workers import the scripts/ modules directly
+    from notify import REMOVED_EVENTS, make_waiter, notify
+
+# SAM_WORKER_DATA moves the job store, e.g. to a scratch directory for benchmarks
+WORKER_DATA = Path(os.environ.get("SAM_WORKER_DATA") or Path(__file__).resolve().parent.parent / "worker_data")
+
+STAGES = ("sam3", "sam3d")
+# queues that are not a pipeline stage of their own, and the stage whose
+# workers serve them (they get woken up on its notify sockets)
+QUEUE_CONSUMERS = {"collision": "sam3d", "render": "sam3d"}
+
+# queue priority classes; lower values are claimed first
+PRIORITIES = {"interactive": 0, "normal": 1, "batch": 2}
+DEFAULT_PRIORITY = "normal"
+
+
+def parse_object_selection(spec):
+    """Parse the `objects` option of a submission.
+
+    "first" (default) reconstructs mask 0, "all" every mask, "top:K" the K
+    highest-scoring masks and "0,2,5" an explicit list of mask indices.
+    Returns (mode, arg); raises ValueError for anything else.
+    """
+    spec = (spec or "first").strip().lower()
+    if spec in ("first", "all"):
+        return spec, None
+    try:
+        if spec.startswith("top:"):
+            k = int(spec[len("top:"):])
+        else:
+            indices = [int(i) for i in spec.split(",") if i.strip()]
+    except ValueError:
+        raise ValueError(f"Invalid object selection: {spec!r}") from None
+    if spec.startswith("top:"):
+        if k < 1:
+            raise ValueError(f"top:K needs K >= 1, got {k}")
+        return "top", k
+    if not indices or min(indices) < 0:
+        raise ValueError(f"Invalid object selection: {spec!r}")
+    return "indices", sorted(set(indices))
+
+
+# collision meshes: a single convex hull, a convex decomposition into several
+# hulls, and watertight voxel remeshes with the pitch at 1/N of the mesh size
+COLLISION_LODS = ("hull", "multi_hull", "voxel_32", "voxel_64", "voxel_128")
+# generated for every object, it is cheap; the others can be requested for a
+# finished job through /collision
+DEFAULT_COLLISION_LODS = ("hull",)
+
+
+def parse_collision_lods(spec):
+    """Collision LODs from a comma separated list; raises ValueError for unknown ones."""
+    lods = [lod.strip().lower() for lod in (spec or "").split(",") if lod.strip()]
+    unknown = [lod for lod in lods if lod not in COLLISION_LODS]
+    if unknown or not lods:
+        raise ValueError(f"Collision LODs must be some of {list(COLLISION_LODS)}, got {spec!r}")
+    return list(dict.fromkeys(lods))
+
+
+# outputs a submission can ask for: the textured OBJ ("visual"), the collision
+# meshes, the turntable GIF, the raw GLB mesh and the gaussian splat, compressed
+# ("splat") or as the full float32 PLY ("splat_ply")
+ARTIFACT_KINDS = ("visual", "collision", "gif", "glb", "splat", "splat_ply")
+DEFAULT_ARTIFACTS = ("visual", "collision", "gif")
+# deferred artifacts are rendered on their first download from a state file
+# kept next to them in final_output, e.g. .chair_3d_visualization.gif.state
+RENDER_STATE_SUFFIX = ".state"
+
+
+def parse_artifact_selection(spec):
+    """Artifact kinds from the `artifacts` option of a submission, in canonical order.
+
+    "default" (or nothing) selects DEFAULT_ARTIFACTS, "all" every kind, and a
+    comma separated list the given kinds; raises ValueError for unknown ones.
+    """
+    spec = (spec or "default").strip().lower()
+    if spec == "default":
+        return DEFAULT_ARTIFACTS
+    if spec == "all":
+        return ARTIFACT_KINDS
+    kinds = {kind.strip() for kind in spec.split(",") if kind.strip()}
+    unknown = sorted(kinds - set(ARTIFACT_KINDS))
+    if unknown or not kinds:
+        raise ValueError(f"Artifacts must be 'default', 'all' or some of {list(ARTIFACT_KINDS)}, got {spec!r}")
+    return tuple(kind for kind in ARTIFACT_KINDS if kind in kinds)
+
+
+def render_state_name(artifact):
+    return f".{artifact}{RENDER_STATE_SUFFIX}"
+
+
+def deferred_artifact(filename):
+    """Name of the artifact rendered from the state file `filename`, or None."""
+    if filename.startswith(".") and filename.endswith(RENDER_STATE_SUFFIX):
+        return filename[1:-len(RENDER_STATE_SUFFIX)]
+    return None
+
+
+def select_object_indices(spec, scores):
+    """Mask indices to reconstruct for selection `spec`, given the mask scores."""
+    mode, arg = parse_object_selection(spec)
+    n = len(scores)
+    if mode == "first":
+        return [0] if n else []
+    if mode == "all":
+        return list(range(n))
+    if mode == "top":
+        return sorted(range(n), key=lambda i: scores[i], reverse=True)[:arg]
+    return [i for i in arg if i < n]
+
+
+class JobStore:
+    def __init__(self, root=WORKER_DATA):
+        self.root = Path(root)
+        self.jobs_dir = self.root / "jobs"
+        self.queues_dir = self.root / "queues"
+
+    # ---- job workspaces ----
+
+    def job_dir(self, job_id):
+        return self.jobs_dir / job_id
+
+    def input_dir(self, job_id):
+        # image + prompt written by the server
+        return self.job_dir(job_id) / "input"
+
+    def masks_dir(self, job_id):
+        # SAM3 -> SAM-3D handoff (object masks + raw image)
+        return self.job_dir(job_id) / "masks"
+
+    def output_dir(self, job_id):
+        # intermediate outputs and state flags
+        return self.job_dir(job_id) / "output"
+
+    def final_output_dir(self, job_id):
+        # files the client can list and download
+        return self.job_dir(job_id) / "final_output"
+
+    def create_job(self, job_id):
+        for d in [self.input_dir(job_id), self.masks_dir(job_id),
+                  self.output_dir(job_id), self.final_output_dir(job_id)]:
+            d.mkdir(parents=True, exist_ok=True)
+        return self.job_dir(job_id)
+
+    def registry_path(self):
+        # SQLite backing of the JobRegistry, shared by the server and the workers
+        return self.root / "jobs.db"
+
+    def job_exists(self, job_id):
+        return self.job_dir(job_id).is_dir()
+
+    def remove_job(self, job_id):
+        shutil.rmtree(self.job_dir(job_id), ignore_errors=True)
+
+    # ---- stage queues ----
+
+    def pending_dir(self, stage):
+        return self.queues_dir / stage / "pending"
+
+    def _active_dir(self, stage):
+        return self.queues_dir / stage / "active"
+
+    def notify_socket(self, stage, worker_id="0"):
+        # one socket per replica, every replica of the stage gets poked
+        return self.queues_dir / stage / f"notify.{worker_id}.sock"
+
+    def _notify_stage(self, stage):
+        stage = QUEUE_CONSUMERS.get(stage, stage)
+        for socket_path in (self.queues_dir / stage).glob("notify.*.sock"):
+            notify(socket_path)
+
+    def waiter(self, stage, worker_id="0"):
+        """JobWaiter that wakes up when a job is enqueued for `stage` (or a queue it serves)."""
+        queues = [stage] + [q for q, consumer in QUEUE_CONSUMERS.items() if consumer == stage]
+        for q in queues:
+            self.pending_dir(q).mkdir(parents=True, exist_ok=True)
+        return make_waiter([self.pending_dir(q) for q in queues], socket_path=self.notify_socket(stage, worker_id))
+
+    def space_waiter(self, stage):
+        """JobWaiter that wakes up when a pending job of `stage` is claimed."""
+        self.pending_dir(stage).mkdir(parents=True, exist_ok=True)
+        return make_waiter([self.pending_dir(stage)], events=REMOVED_EVENTS)
+
+    def enqueue(self, stage, job_id, priority=DEFAULT_PRIORITY, payload=None):
+        """Queue a job for `stage`; `payload` (JSON-serializable) is stored in the
+        entry and read back by the worker with claimed_payloads()."""
+        pending = self.pending_dir(stage)
+        pending.mkdir(parents=True, exist_ok=True)
+        # entries sort by priority, then by enqueue time
+        entry = f"{PRIORITIES[priority]}_{time.time_ns():020d}_{job_id}"
+        tmp_path = pending / f".{entry}.tmp"
+        tmp_path.write_text("" if payload is None else json.dumps(payload))
+        os.replace(tmp_path, pending / entry)
+        self._notify_stage(stage)
+
+    def _owned_dir(self, stage, owner):
+        # jobs claimed by one replica; unowned claims sit in active/ itself
+        return self._active_dir(stage) / owner if owner else self._active_dir(stage)
+
+    def _active_entries(self, stage, owner=None):
+        """Paths of the claimed entries of a stage, of all replicas or of `owner`."""
+        dirs = [self._owned_dir(stage, owner)]
+        if owner is None and dirs[0].exists():
+            dirs += [d for d in dirs[0].iterdir() if d.is_dir()]
+        entries = []
+        for d in dirs:
+            try:
+                entries += [d / e for e in os.listdir(d) if not (d / e).is_dir()]
+            except FileNotFoundError:
+                continue
+        return entries
+
+    def claim(self, stage, owner=None):
+        """Take the next pending job of a stage (highest priority, oldest first), or None.
+
+        `owner` (the claiming replica's worker ID) records who holds the job,
+        see requeue_active().
+        """
+        pending = self.pending_dir(stage)
+        active = self._owned_dir(stage, owner)
+        active.mkdir(parents=True, exist_ok=True)
+        try:
+            entries = sorted(e for e in os.listdir(pending) if not e.startswith("."))
+        except FileNotFoundError:
+            return None
+        for entry in entries:
+            try:
+                os.rename(pending / entry, active / entry)
+            except FileNotFoundError:
+                # another worker claimed it first
+                continue
+            return entry.rsplit("_", 1)[1]
+        return None
+
+    def claimed_payloads(self, stage, job_id, owner=None):
+        """Payloads of the entries of `job_id` claimed from `stage` (by `owner`)."""
+        payloads = []
+        for entry in sorted(self._active_entries(stage, owner)):
+            if entry.name.rsplit("_", 1)[-1] != job_id:
+                continue
+            try:
+                text = entry.read_text()
+            except FileNotFoundError:
+                continue
+            if text:
+                payloads.append(json.loads(text))
+        return payloads
+
+    def complete(self, stage, job_id):
+        for entry in self._active_entries(stage):
+            if entry.name.rsplit("_", 1)[-1] == job_id:
+                try:
+                    os.remove(entry)
+                except FileNotFoundError:
+                    pass
+
+    def active_jobs(self, stage, owner=None):
+        """IDs of the jobs claimed from `stage` (by `owner`)."""
+        return [entry.name.rsplit("_", 1)[-1] for entry in self._active_entries(stage, owner)]
+
+    def requeue_active(self, stage, owner=None, drop=()):
+        """Put jobs claimed by workers that are gone (all of them, or the replica
+        `owner`) back at the front of the queue; returns their job IDs. Entries
+        of the jobs in `drop` are removed instead."""
+        entries = self._active_entries(stage, owner)
+        if not entries:
+            return []
+        self.pending_dir(stage).mkdir(parents=True, exist_ok=True)
+        requeued = []
+        for entry in entries:
+            job_id = entry.name.rsplit("_", 1)[-1]
+            try:
+                if job_id in drop:
+                    os.remove(entry)
+                    continue
+                # the original entry name keeps the job's place in the FIFO
+                os.replace(entry, self.pending_dir(stage) / entry.name)
+            except FileNotFoundError:
+                # completed meanwhile
+                continue
+            requeued.append(job_id)
+        if requeued:
+            self._notify_stage(stage)
+        return requeued
+
+    def queue_depth(self, stage):
+        try:
+            return sum(1 for e in os.listdir(self.pending_dir(stage)) if not e.startswith("."))
+        except FileNotFoundError:
+            return 0
@@ -0,0 +1,99 @@
+# scripts/mask_export.py
+#
+# Batched export of the SAM3 masks.
+#
+# All masks of a job are handled as one (N, H, W) boolean array:
+#   - masks.npz: the masks bit-packed (8 pixels per byte) plus their bounding
+#     boxes, compressed; SAM-3D falls back to it when the shared-memory handoff
+#     is gone, and clients download it instead of one PNG per mask
+#   - <index>.png: RGBA cut-out of each object cropped to its bounding box, only
+#     when PNGs are wanted; the crops are encoded in parallel on a thread pool
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+MASKS_FILE = "masks.npz"
+# zlib level for the cut-out PNGs: the files are for debugging, speed matters more
+PNG_COMPRESS_LEVEL = 1
+
+
+def mask_bboxes(masks):
+    """(N, 4) int array of x0, y0, x1, y1 (exclusive) per mask; empty masks get all zeros."""
+    masks = np.asarray(masks, dtype=bool)
+    rows = masks.any(axis=2)
+    cols = masks.any(axis=1)
+    nonempty = rows.any(axis=1)
+    height, width = masks.shape[1:]
+    y0 = rows.argmax(axis=1)
+    y1 = height - rows[:, ::-1].argmax(axis=1)
+    x0 = cols.argmax(axis=1)
+    x1 = width - cols[:, ::-1].argmax(axis=1)
+    bboxes = np.stack([x0, y0, x1, y1], axis=1)
+    bboxes[~nonempty] = 0
+    return bboxes
+
+
+def save_compact_masks(path, masks, bboxes=None):
+    masks = np.asarray(masks, dtype=bool)
+    if bboxes is None:
+        bboxes = mask_bboxes(masks)
+    np.savez_compressed(
+        path,
+        packed=np.packbits(masks.reshape(len(masks), -1), axis=1),
+        shape=np.array(masks.shape),
+        bboxes=bboxes,
+    )
+
+
+def load_compact_masks(path):
+    """Masks written by save_compact_masks as an (N, H, W) boolean array."""
+    with np.load(path) as data:
+        shape = tuple(int(v) for v in data["shape"])
+        pixels = shape[1] * shape[2]
+        return np.unpackbits(data["packed"], axis=1, count=pixels).reshape(shape).astype(bool)
+
+
+def rgba_cutouts(img_np, masks, bboxes):
+    """RGBA crops of every object; only the bounding box of each mask is copied."""
+    # alpha planes of all masks in one operation
+    alpha = np.where(masks, np.uint8(255), np.uint8(0))
+    rgb = img_np[..., :3]
+    cutouts = []
+    for i, (x0, y0, x1, y1) in enumerate(bboxes):
+        # an empty mask still gets a (transparent) 1x1 image
+        x1, y1 = max(x1, x0 + 1), max(y1, y0 + 1)
+        cutouts.append(np.dstack((rgb[y0:y1, x0:x1], alpha[i, y0:y1, x0:x1])))
+    return cutouts
+
+
+def _save_png(array, path):
+    tmp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.tmp")
+    Image.fromarray(array).save(tmp_path, format="PNG", compress_level=PNG_COMPRESS_LEVEL)
+    os.replace(tmp_path, path)
+    return os.path.basename(path)
+
+
+def encode_pngs(images, pool=None):
+    """Write `images` (path -> array) as PNGs; zlib releases the GIL, so threads help."""
+    if pool is None:
+        return [_save_png(array, path) for path, array in images.items()]
+    return list(pool.map(lambda item: _save_png(item[1], item[0]), images.items()))
+
+
+def export_masks(output_dir, img_np, masks, cutouts=False, pool=None):
+    """Write masks.npz (and the cut-out PNGs); returns the bounding boxes and written file names."""
+    masks = np.asarray(masks, dtype=bool)
+    bboxes = mask_bboxes(masks)
+    save_compact_masks(os.path.join(output_dir, MASKS_FILE), masks, bboxes)
+    written = [MASKS_FILE]
+    if cutouts:
+        crops = rgba_cutouts(img_np, masks, bboxes)
+        written += encode_pngs({os.path.join(output_dir, f"{i}.png"): crop for i, crop in enumerate(crops)}, pool)
+    return bboxes, written
+
+
+def make_png_pool(max_workers=4):
+    return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="png")
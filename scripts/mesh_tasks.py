@@ -0,0 +1,379 @@
+# scripts/mesh_tasks.py
+#
+# CPU-bound mesh post-processing of the SAM-3D worker. Everything here runs in
+# a process pool (forked before CUDA is initialized), so it must not touch the
+# GPU. Each export task writes into its own staging directory and publishes
+# its files into the destination with an atomic rename, so a file shows up in
+# final_output only once it is complete.
+
+import hashlib
+import importlib.util
+import json
+import os
+import shutil
+import time
+import uuid
+from pathlib import Path
+
+import imageio
+import numpy as np
+import trimesh
+
+from utils import ColorPrint
+from job_store import WORKER_DATA, DEFAULT_COLLISION_LODS
+from tracing import Tracer
+from cache import CACHE_ROOT
+print = ColorPrint(worker_name="SAM_3D_POST", default_color="orange")
+
+# spans of the post-processing workers, one trace file per pool process
+TRACER = Tracer(WORKER_DATA, "sam3d_post")
+
+
+def publish(src, dest_dir, name=None):
+    """Atomically move a finished file into `dest_dir`, returns its new name."""
+    name = name or os.path.basename(src)
+    os.replace(src, os.path.join(dest_dir, name))
+    return name
+
+def staging_dir(output_dir, name):
+    d = Path(output_dir) / "staging" / name
+    d.mkdir(parents=True, exist_ok=True)
+    return str(d)
+
+def clean_mesh(m):
+    # remove degenerate faces via mask
+    mask = m.nondegenerate_faces()
+    if mask is not None:
+        m = m.submesh([mask], append=True)
+
+    # remove unused vertices
+    m.remove_unreferenced_vertices()
+
+    # final validation
+    m.process(validate=True)
+    return m
+
+def rescale_to_match(source: trimesh.Trimesh, target: trimesh.Trimesh):
+    # Compute bounding boxes
+    src_extents = source.bounding_box.extents
+    tgt_extents = target.bounding_box.extents
+
+    # Uniform scale factor (preserve proportions)
+    scale = (src_extents / tgt_extents).min()
+
+    target.apply_scale(scale)
+
+    # Align centers
+    src_center = source.bounding_box.centroid
+    tgt_center = target.bounding_box.centroid
+    target.apply_translation(src_center - tgt_center)
+
+    return target
+
+@TRACER.traced("mesh.convex_hull")
+def create_convex_hull_mesh(mesh, reduce_percent=0.9):
+    # Simplify mesh to reduce number of faces
+    simplified_mesh = mesh.simplify_quadric_decimation(reduce_percent)
+    convexhull = simplified_mesh.convex_hull
+    convexhull = clean_mesh(convexhull)
+    convexhull = rescale_to_match(mesh, convexhull)
+    print(f"Convex hull mesh has {len(convexhull.faces)} faces")
+    return convexhull
+
+def make_mujoco_safe(mesh: trimesh.Trimesh) -> trimesh.Trimesh:
+    mesh = mesh.copy()
+
+    # Remove degenerate faces
+    mask = mesh.nondegenerate_faces()
+    if mask is not None:
+        mesh = mesh.submesh([mask], append=True)
+
+    # THIS IS CRITICAL
+    mesh.remove_unreferenced_vertices()
+
+    # Force clean reindex
+    mesh.process(validate=True)
+
+    return mesh
+
+@TRACER.traced("mesh.export_glb")
+def export_glb_task(mesh, done_dir, output_dir, prompt):
+    staging = staging_dir(output_dir, f"{prompt}_glb")
+    mesh_path = os.path.join(staging, f"{prompt}_mesh.glb")
+    mesh.export(mesh_path)
+    published = [publish(mesh_path, done_dir)]
+    print(f"Exported .glb mesh")
+    return published
+
+@TRACER.traced("mesh.export_visual")
+def export_visual_task(mesh, done_dir, output_dir, prompt):
+    staging = staging_dir(output_dir, f"{prompt}_visual")
+    published = []
+    # Import and export to .obj with texture and material
+    mesh = make_mujoco_safe(mesh)
+    mesh.apply_scale(1 / 10.0)
+    # Rename material and texture if present
+    if hasattr(mesh, 'visual') and hasattr(mesh.visual, 'material'):
+        mesh.visual.material.name = f"{prompt}_material"
+        if hasattr(mesh.visual.material, 'image') and mesh.visual.material.image is not None:
+            texture_name = f"{prompt}_texture.png"
+            staged_texture_path = os.path.join(staging, texture_name)
+            imageio.imwrite(staged_texture_path, mesh.visual.material.image)
+            published.append(publish(staged_texture_path, done_dir))
+            mesh.visual.material.image = os.path.join(done_dir, texture_name)
+    mesh.export(os.path.join(staging, f"{prompt}_visual.obj"))
+    # Rename automatically generated MTL
+    auto_mtl_path = os.path.join(staging, f"material.mtl")
+    if os.path.exists(auto_mtl_path):
+        published.append(publish(auto_mtl_path, done_dir, f"{prompt}_material.mtl"))
+    # the .obj goes last, once everything it references is in place
+    published.append(publish(os.path.join(staging, f"{prompt}_visual.obj"), done_dir))
+    print(f"Exported visual mesh")
+    return published
+
+# ---- collision meshes ----
+
+# quadric decimation before the single convex hull
+HULL_REDUCE_PERCENT = 0.93
+# upper bound of the convex decomposition
+MAX_CONVEX_PARTS = 16
+# collision meshes are memoized by the hash of their source mesh
+COLLISION_CACHE_DIR = CACHE_ROOT / "collision"
+COLLISION_CACHE_MAX_BYTES = 4 * 1024**3
+
+
+def collision_file_name(prompt, lod):
+    # the single hull keeps the name it always had
+    return f"{prompt}_collision.obj" if lod == "hull" else f"{prompt}_collision_{lod}.obj"
+
+def collision_task_groups(lods):
+    """Split LODs into independent pool tasks; the voxel LODs share one voxelization."""
+    voxel = [lod for lod in lods if lod.startswith("voxel_")]
+    return [[lod] for lod in lods if not lod.startswith("voxel_")] + ([voxel] if voxel else [])
+
+def prepare_collision_source(mesh):
+    # Ensure mesh is a single unified mesh
+    if isinstance(mesh, trimesh.Scene):
+        mesh = trimesh.util.concatenate(mesh.dump())
+    mesh = make_mujoco_safe(mesh)
+    mesh.apply_scale(1 / 10.0)
+    return mesh
+
+def mesh_hash(mesh):
+    h = hashlib.sha256()
+    h.update(np.ascontiguousarray(mesh.vertices, dtype=np.float64).tobytes())
+    h.update(np.ascontiguousarray(mesh.faces, dtype=np.int64).tobytes())
+    return h.hexdigest()
+
+
+class CollisionCache:
+    """Collision meshes by source mesh hash.
+
+    <root>/<hash>/source.ply is the prepared source mesh (so further LODs can be
+    generated without the job), <lod>.obj and <lod>.json a generated LOD and
+    its report. Files are written under a temporary name and renamed into
+    place; the least recently used entries go once the cache outgrows `max_bytes`.
+    """
+
+    SOURCE_FILE = "source.ply"
+
+    def __init__(self, root=COLLISION_CACHE_DIR, max_bytes=COLLISION_CACHE_MAX_BYTES):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+
+    def _entry(self, key):
+        return self.root / key
+
+    def _write(self, dest, write):
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = dest.with_name(f".tmp-{uuid.uuid4().hex}{dest.suffix}")
+        try:
+            write(tmp_path)
+            os.replace(tmp_path, dest)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+
+    def get(self, key, lod):
+        """(path of the mesh, report) of a memoized LOD, or None."""
+        entry = self._entry(key)
+        try:
+            report = json.loads((entry / f"{lod}.json").read_text())
+            path = entry / f"{lod}.obj"
+            if not path.exists():
+                return None
+            os.utime(entry)
+        except (OSError, ValueError):
+            return None
+        return path, report
+
+    def put(self, key, lod, mesh, report):
+        entry = self._entry(key)
+        self._write(entry / f"{lod}.obj", lambda p: mesh.export(p, file_type="obj"))
+        # the report last: it marks the LOD as complete
+        self._write(entry / f"{lod}.json", lambda p: p.write_text(json.dumps(report)))
+        return entry / f"{lod}.obj"
+
+    def load_source(self, key):
+        return trimesh.load(self._entry(key) / self.SOURCE_FILE, file_type="ply", force="mesh", process=False)
+
+    def put_source(self, key, mesh):
+        if not (self._entry(key) / self.SOURCE_FILE).exists():
+            # geometry only, the visual mesh is exported separately
+            geometry = trimesh.Trimesh(mesh.vertices, mesh.faces, process=False)
+            self._write(self._entry(key) / self.SOURCE_FILE, lambda p: geometry.export(p, file_type="ply"))
+
+    def evict(self):
+        if not self.root.exists():
+            return
+        entries = []
+        for d in self.root.iterdir():
+            try:
+                entries.append((d.stat().st_mtime, sum(f.stat().st_size for f in d.iterdir()), d))
+            except OSError:
+                continue
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, d in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(d, ignore_errors=True)
+            total -= size
+
+
+COLLISION_CACHE = CollisionCache()
+
+
+def convex_decomposition_backend():
+    """The installed convex decomposition package ("coacd" or "vhacdx"), or None."""
+    for name in ("coacd", "vhacdx"):
+        if importlib.util.find_spec(name) is not None:
+            return name
+    return None
+
+@TRACER.traced("mesh.convex_decomposition")
+def create_convex_decomposition(mesh, max_parts=MAX_CONVEX_PARTS):
+    """Convex parts of `mesh` as a Scene: CoACD if installed, else V-HACD through trimesh."""
+    if convex_decomposition_backend() == "coacd":
+        import coacd
+        parts = coacd.run_coacd(coacd.Mesh(mesh.vertices, mesh.faces), max_convex_hull=max_parts)
+        hulls = [trimesh.Trimesh(vertices, faces) for vertices, faces in parts]
+    else:
+        # trimesh runs V-HACD through the vhacdx package
+        hulls = mesh.convex_decomposition(maxConvexHulls=max_parts)
+        if isinstance(hulls, trimesh.Trimesh):
+            hulls = [hulls]
+    # one OBJ object per convex part
+    return trimesh.Scene({f"hull_{i}": clean_mesh(h.convex_hull) for i, h in enumerate(hulls)})
+
+@TRACER.traced("mesh.voxel_collision")
+def create_voxel_collision_meshes(mesh, voxel_scales):
+    """Watertight voxel remeshes at several resolutions, {scale: mesh}.
+
+    The mesh is voxelized and filled once, at the finest resolution; coarser
+    levels pool blocks of that grid instead of voxelizing the surface again.
+    """
+    finest = max(voxel_scales)
+    filled = mesh.voxelized(pitch=mesh.scale / finest).fill().matrix
+    meshes = {}
+    for scale in voxel_scales:
+        factor = finest // scale
+        grid = filled
+        if factor > 1:
+            pad = [(0, -n % factor) for n in grid.shape]
+            grid = np.pad(grid, pad)
+            nx, ny, nz = (n // factor for n in grid.shape)
+            grid = grid.reshape(nx, factor, ny, factor, nz, factor).any(axis=(1, 3, 5))
+        collision = trimesh.voxel.VoxelGrid(grid).marching_cubes
+        collision = clean_mesh(collision)
+        collision = rescale_to_match(mesh, collision)
+        if not collision.is_watertight:
+            raise ValueError(f"voxel_{scale} collision mesh is not watertight")
+        meshes[scale] = collision
+    return meshes
+
+def generate_collision_lods(mesh, lods):
+    """{lod: (mesh or scene, report)} for LODs of one task group."""
+    results = {}
+    voxel_scales = [int(lod.split("_")[1]) for lod in lods if lod.startswith("voxel_")]
+    if voxel_scales:
+        start = time.perf_counter()
+        voxel_meshes = create_voxel_collision_meshes(mesh, voxel_scales)
+        # the shared voxelization is split evenly over the levels
+        seconds = (time.perf_counter() - start) / len(voxel_scales)
+        for scale, collision in voxel_meshes.items():
+            results[f"voxel_{scale}"] = (collision, {"faces": len(collision.faces), "generation_s": seconds})
+    for lod in lods:
+        if lod in results:
+            continue
+        start = time.perf_counter()
+        if lod == "hull":
+            collision = create_convex_hull_mesh(mesh, reduce_percent=HULL_REDUCE_PERCENT)
+            report = {"faces": len(collision.faces)}
+        elif lod == "multi_hull":
+            collision = create_convex_decomposition(mesh)
+            report = {"faces": sum(len(g.faces) for g in collision.geometry.values()), "parts": len(collision.geometry)}
+        else:
+            raise ValueError(f"Unknown collision LOD {lod!r}")
+        report["generation_s"] = time.perf_counter() - start
+        results[lod] = (collision, report)
+    return results
+
+@TRACER.traced("mesh.export_collision")
+def export_collision_task(mesh, done_dir, output_dir, prompt, lods=DEFAULT_COLLISION_LODS, source_hash=None):
+    """Collision meshes of one object at the given LODs.
+
+    `mesh` is the reconstructed mesh, or None to take the source of an earlier
+    export from the cache by `source_hash`. LODs generated before for the same
+    mesh come from the cache. Returns {"files", "mesh_hash", "collision"},
+    where "collision" reports file, face count and generation time (or the
+    error) per LOD.
+    """
+    staging = staging_dir(output_dir, f"{prompt}_collision_{'_'.join(lods)}")
+    if mesh is None:
+        mesh = COLLISION_CACHE.load_source(source_hash)
+    else:
+        mesh = prepare_collision_source(mesh)
+    key = source_hash or mesh_hash(mesh)
+    COLLISION_CACHE.put_source(key, mesh)
+    print(f"Mesh has {len(mesh.faces)} faces")
+
+    reports, sources = {}, {}
+    missing = []
+    for lod in lods:
+        cached = COLLISION_CACHE.get(key, lod)
+        if cached is not None:
+            sources[lod], reports[lod] = cached[0], dict(cached[1], cached=True)
+        else:
+            missing.append(lod)
+    if "multi_hull" in missing and convex_decomposition_backend() is None:
+        # not an error of this mesh; the LOD is left out until coacd or vhacdx is installed
+        print("! Neither coacd nor vhacdx is installed, skipping the multi_hull collision LOD.", color="yellow")
+        missing.remove("multi_hull")
+        reports["multi_hull"] = {"skipped": "no convex decomposition backend (coacd or vhacdx) installed"}
+    if missing:
+        try:
+            generated = generate_collision_lods(mesh, missing)
+        except Exception as e:
+            # e.g. a voxelization that is not watertight; the other task groups are unaffected
+            print(f"! Collision LOD(s) {missing} failed: {e!r}", color="red")
+            generated = {}
+            reports.update({lod: {"error": repr(e)} for lod in missing})
+        for lod, (collision, report) in generated.items():
+            sources[lod] = COLLISION_CACHE.put(key, lod, collision, report)
+            reports[lod] = dict(report, cached=False)
+
+    published = []
+    for lod in sources:
+        name = collision_file_name(prompt, lod)
+        staged_path = os.path.join(staging, name)
+        try:
+            os.link(sources[lod], staged_path)
+        except OSError:
+            shutil.copy2(sources[lod], staged_path)
+        published.append(publish(staged_path, done_dir))
+        reports[lod]["file"] = name
+        print(f"Collision mesh {lod}: {reports[lod]['faces']} faces, "
+              f"{reports[lod]['generation_s']:.2f}s" + (" (cached)" if reports[lod]["cached"] else ""))
+    if missing:
+        COLLISION_CACHE.evict()
+    return {"files": published, "mesh_hash": key, "collision": reports}
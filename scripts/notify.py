@@ -0,0 +1,204 @@
+# scripts/notify.py
+#
+# Job-notification layer: lets workers sleep until something changes instead
+# of polling the filesystem every 100 ms.
+#
+# A JobWaiter blocks in select() on one or more event sources:
+#   - InotifySource: Linux inotify watch on the queue/ready directories
+#   - SocketSource:  a Unix datagram socket the producer pokes after enqueueing
+# If no source can be set up (non-Linux, unsupported filesystem, ...) the waiter
+# falls back to plain polling. The backend can be forced with the environment
+# variable SAM_NOTIFY_BACKEND = auto | inotify | socket | poll.
+
+import asyncio
+import ctypes
+import ctypes.util
+import os
+import select
+import socket
+import sys
+import time
+from pathlib import Path
+
+NOTIFY_BACKEND = os.environ.get("SAM_NOTIFY_BACKEND", "auto")
+POLL_INTERVAL = 0.1
+
+# inotify event masks (see <sys/inotify.h>)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+
+# something was added to a watched directory
+ADDED_EVENTS = IN_CREATE | IN_MOVED_TO | IN_CLOSE_WRITE
+# something was taken out of a watched directory
+REMOVED_EVENTS = IN_MOVED_FROM | IN_DELETE
+
+
+class InotifySource:
+    def __init__(self, dirs, events=ADDED_EVENTS):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.fd = fd
+        # the directories must exist; watching never creates them (a job's
+        # workspace would come back after it has been archived)
+        for d in dirs:
+            wd = libc.inotify_add_watch(fd, os.fsencode(str(d)), events)
+            if wd < 0:
+                os.close(fd)
+                raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {d}")
+
+    def fileno(self):
+        return self.fd
+
+    def drain(self):
+        try:
+            while os.read(self.fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        os.close(self.fd)
+
+
+class SocketSource:
+    def __init__(self, socket_path):
+        self.socket_path = str(socket_path)
+        Path(self.socket_path).parent.mkdir(parents=True, exist_ok=True)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.socket_path)
+        self.sock.setblocking(False)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def drain(self):
+        try:
+            while self.sock.recv(1024):
+                pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        self.sock.close()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+class JobWaiter:
+    """Blocks until one of its sources fires, or polls if it has none."""
+
+    def __init__(self, sources=()):
+        self.sources = list(sources)
+
+    @property
+    def backend(self):
+        if not self.sources:
+            return "poll"
+        return "+".join(type(s).__name__.replace("Source", "").lower() for s in self.sources)
+
+    def wait(self, timeout=None):
+        """Returns True if woken by an event, False on timeout/poll tick."""
+        if not self.sources:
+            time.sleep(POLL_INTERVAL if timeout is None else min(timeout, POLL_INTERVAL))
+            return False
+        ready, _, _ = select.select(self.sources, [], [], timeout)
+        for source in ready:
+            source.drain()
+        return bool(ready)
+
+    async def wait_async(self, timeout=None):
+        """Like wait(), but for the asyncio event loop (no thread is blocked)."""
+        if not self.sources:
+            await asyncio.sleep(POLL_INTERVAL if timeout is None else min(timeout, POLL_INTERVAL))
+            return False
+        loop = asyncio.get_running_loop()
+        fired = asyncio.Event()
+
+        def on_readable(source):
+            source.drain()
+            fired.set()
+
+        for source in self.sources:
+            loop.add_reader(source.fileno(), on_readable, source)
+        try:
+            await asyncio.wait_for(fired.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            for source in self.sources:
+                loop.remove_reader(source.fileno())
+
+    def close(self):
+        for source in self.sources:
+            source.close()
+        self.sources = []
+
+
+def make_waiter(dirs=(), socket_path=None, backend=None, events=ADDED_EVENTS):
+    """Build a JobWaiter watching `dirs` and/or listening on `socket_path`.
+
+    With backend "auto", inotify is preferred on Linux, then the socket, then polling.
+    `events` is the inotify mask used for the directory watches; if one of
+    `dirs` does not exist, the waiter falls back to the socket or polling.
+    """
+    backend = backend or NOTIFY_BACKEND
+    sources = []
+    if backend in ("auto", "inotify") and dirs and sys.platform.startswith("linux"):
+        try:
+            sources.append(InotifySource(dirs, events))
+        except OSError:
+            pass
+    if socket_path is not None and (backend == "socket" or (backend == "auto" and not sources)):
+        try:
+            sources.append(SocketSource(socket_path))
+        except OSError:
+            pass
+    return JobWaiter(sources)
+
+
+def notify(socket_path, message=b"job"):
+    """Best-effort poke of a waiting worker; a missing listener is not an error."""
+    if socket_path is None or not os.path.exists(socket_path):
+        return False
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.sendto(message, str(socket_path))
+        return True
+    except OSError:
+        return False
+
+
+def wait_for_files(paths, timeout=None, on_wait=None, report_every=10.0):
+    """Block until all `paths` exist. Returns False if `timeout` expires first.
+
+    `on_wait(missing)` is called every `report_every` seconds while waiting.
+    """
+    paths = [Path(p) for p in paths]
+    waiter = make_waiter({p.parent for p in paths})
+    deadline = None if timeout is None else time.monotonic() + timeout
+    next_report = time.monotonic() + report_every
+    try:
+        while True:
+            missing = [p for p in paths if not p.exists()]
+            if not missing:
+                return True
+            now = time.monotonic()
+            if deadline is not None and now >= deadline:
+                return False
+            if on_wait is not None and now >= next_report:
+                on_wait(missing)
+                next_report = now + report_every
+            wait_s = next_report - now
+            if deadline is not None:
+                wait_s = min(wait_s, deadline - now)
+            waiter.wait(max(wait_s, 0.0))
+    finally:
+        waiter.close()
@@ -0,0 +1,59 @@
+# scripts/overlay.py
+#
+# Segmentation overlay drawn directly on the decoded image array with NumPy
+# and PIL (replaces the matplotlib figure of the SAM3 worker).
+#
+# Every mask is alpha-blended in its palette color, then the boxes and the
+# "(id=i, prob=p)" labels are drawn on the same image, which is written as a
+# PNG. No figure, no re-decoding of the input and nothing left open per job.
+
+import os
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+MASK_ALPHA = 0.5
+BOX_WIDTH = 2
+
+
+def _color_u8(color):
+    color = np.asarray(color, dtype=np.float32)
+    # palette colors are floats in [0, 1]
+    if color.max() <= 1.0:
+        color = color * 255.0
+    return tuple(int(round(c)) for c in color[:3])
+
+
+def render_overlay(img_np, masks, boxes, scores, colors, alpha=MASK_ALPHA):
+    """RGB uint8 image with all masks blended in and their boxes and labels drawn."""
+    canvas = img_np[..., :3].astype(np.float32)
+    palette = [_color_u8(colors[i % len(colors)]) for i in range(len(masks))]
+    for i, mask in enumerate(masks):
+        # masks are layered in order, like stacked imshow calls
+        region = canvas[mask]
+        canvas[mask] = region + alpha * (np.asarray(palette[i], dtype=np.float32) - region)
+    image = Image.fromarray(np.clip(canvas + 0.5, 0, 255).astype(np.uint8))
+
+    draw = ImageDraw.Draw(image)
+    font = ImageFont.load_default()
+    for i, (box, score) in enumerate(zip(boxes, scores)):
+        x0, y0, x1, y1 = (float(v) for v in box)
+        color = palette[i]
+        draw.rectangle((x0, y0, x1, y1), outline=color, width=BOX_WIDTH)
+        label = f"(id={i}, prob={float(score):.2f})"
+        left, top, right, bottom = draw.textbbox((x0, y0), label, font=font)
+        # label sits on top of the box, inside the image
+        shift = min(bottom - top + 4, y0)
+        draw.rectangle((left, top - shift, right + 4, bottom - shift + 2), fill=color)
+        draw.text((x0 + 2, y0 - shift + 1), label, fill=(255, 255, 255), font=font)
+    return image
+
+
+def save_overlay(output_dir, safe_prompt, img_np, masks, boxes, scores, colors):
+    """Render and publish <prompt>_segmentation_results.png; returns the file name."""
+    name = f"{safe_prompt}_segmentation_results.png"
+    # write under a hidden name first so clients never see a partial file
+    tmp_path = os.path.join(output_dir, f".{name}.tmp")
+    render_overlay(img_np, masks, boxes, scores, colors).save(tmp_path, format="PNG", compress_level=1)
+    os.replace(tmp_path, os.path.join(output_dir, name))
+    return name
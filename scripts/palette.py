@@ -0,0 +1,52 @@
+# scripts/palette.py
+#
+# Color palette of the segmentation overlay.
+#
+# The palette is k-means clustered in LAB space for perceptually distinct
+# colors. That takes seconds (5000 color conversions and a KMeans fit), so it
+# is computed once and kept as a small .npy file next to the result cache;
+# sklearn and skimage are only imported when the file has to be built.
+
+import os
+import uuid
+
+import numpy as np
+
+from cache import CACHE_ROOT
+
+PALETTE_DIR = CACHE_ROOT / "palette"
+
+
+def generate_colors(n_colors=256, n_samples=5000):
+    from sklearn.cluster import KMeans
+    from skimage.color import rgb2lab, lab2rgb
+
+    # Step 1: Random RGB samples
+    np.random.seed(42)
+    rgb = np.random.rand(n_samples, 3)
+    # Step 2: Convert to LAB for perceptual uniformity
+    lab = rgb2lab(rgb.reshape(1, -1, 3)).reshape(-1, 3)
+    # Step 3: k-means clustering in LAB
+    kmeans = KMeans(n_clusters=n_colors, n_init=10)
+    kmeans.fit(lab)
+    centers_lab = kmeans.cluster_centers_
+    # Step 4: Convert LAB back to RGB
+    colors_rgb = lab2rgb(centers_lab.reshape(1, -1, 3)).reshape(-1, 3)
+    colors_rgb = np.clip(colors_rgb, 0, 1)
+    return colors_rgb
+
+
+def load_palette(n_colors=128, n_samples=5000):
+    """The cached palette, built and stored on first use. Returns (colors, from_cache)."""
+    path = PALETTE_DIR / f"palette_{n_colors}_{n_samples}.npy"
+    try:
+        return np.load(path), True
+    except (OSError, ValueError):
+        pass
+    colors = generate_colors(n_colors=n_colors, n_samples=n_samples)
+    PALETTE_DIR.mkdir(parents=True, exist_ok=True)
+    # several workers may build it at the same time; the last rename wins
+    tmp_path = PALETTE_DIR / f".{path.stem}.{uuid.uuid4().hex}.npy"
+    np.save(tmp_path, colors)
+    os.replace(tmp_path, path)
+    return colors, False
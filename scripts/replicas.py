@@ -0,0 +1,205 @@
+# scripts/replicas.py
+#
+# Replicas of a pipeline stage: identity, readiness, heartbeat and load.
+#
+# Every worker process is one replica of its stage, identified by a worker ID
+# (SAM_WORKER_ID, set by start_workers.py). Once its model is loaded it writes
+# worker_data/workers_ready/<stage>/<worker_id>.json and rewrites it every
+# HEARTBEAT_INTERVAL_S with its current load (jobs it holds). A replica whose
+# file has not been refreshed for HEARTBEAT_TIMEOUT_S is considered gone.
+#
+# Scheduling is pull based, so it also works across boxes sharing a job
+# store: replicas claim from the shared stage queue, but a replica only claims
+# while no other live replica of the stage has a lower load. Idle replicas
+# therefore get the next job first (least-loaded), and the atomic claim in
+# JobStore settles ties.
+#
+# Replicas started by the supervisor in start_workers.py also announce their
+# readiness on a pipe (SAM_READY_FD), so it learns about it without polling.
+
+import json
+import os
+import socket
+import threading
+import time
+from pathlib import Path
+
+try:
+    from scripts.notify import make_waiter
+except ImportError:  # workers import the scripts/ modules directly
+    from notify import make_waiter
+
+HEARTBEAT_INTERVAL_S = 2.0
+HEARTBEAT_TIMEOUT_S = 10.0
+# how long a replica that deferred to a less loaded one waits before it looks again
+SCHEDULE_RECHECK_S = 0.5
+# write end of the supervisor's readiness pipe, inherited from start_workers.py
+READY_FD_ENV = "SAM_READY_FD"
+
+
+def default_worker_id():
+    return os.environ.get("SAM_WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+
+
+def ready_dir(root, stage):
+    return Path(root) / "workers_ready" / stage
+
+
+def read_replicas(root, stage):
+    replicas = []
+    d = ready_dir(root, stage)
+    if not d.exists():
+        return replicas
+    for f in sorted(d.glob("*.json")):
+        try:
+            replicas.append(json.loads(f.read_text()))
+        except (OSError, ValueError):
+            # being replaced right now
+            continue
+    return replicas
+
+
+def live_replicas(root, stage, timeout=HEARTBEAT_TIMEOUT_S, now=None):
+    """Replicas of `stage` that are ready and sent a heartbeat within `timeout`."""
+    now = now or time.time()
+    return [r for r in read_replicas(root, stage) if now - r.get("updated_at", 0) <= timeout]
+
+
+def replica_summary(root, stage, timeout=HEARTBEAT_TIMEOUT_S):
+    now = time.time()
+    return [
+        {
+            "worker_id": r["worker_id"],
+            "host": r.get("host"),
+            "load": r.get("load", 0),
+            "heartbeat_age_s": round(now - r.get("updated_at", 0), 1),
+            "live": now - r.get("updated_at", 0) <= timeout,
+        }
+        for r in read_replicas(root, stage)
+    ]
+
+
+def supervisor_path(root):
+    # written by the supervisor in start_workers.py
+    return Path(root) / "stats" / "supervisor.json"
+
+
+def read_supervisor_status(root):
+    """Replica states, restarts and recoveries reported by the supervisor, or None."""
+    try:
+        return json.loads(supervisor_path(root).read_text())
+    except (OSError, ValueError):
+        return None
+
+
+def stages_ready(root, replicas):
+    """True once every stage in `replicas` (stage -> count) has that many live replicas."""
+    return all(len(live_replicas(root, stage)) >= count for stage, count in replicas.items())
+
+
+class Replica:
+    def __init__(self, root, stage, worker_id=None, interval=HEARTBEAT_INTERVAL_S):
+        self.root = Path(root)
+        self.stage = stage
+        self.worker_id = worker_id or default_worker_id()
+        self.interval = interval
+        self.path = ready_dir(root, stage) / f"{self.worker_id}.json"
+        self.started_at = time.time()
+        self.load = 0
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def write(self):
+        with self._lock:
+            data = {
+                "stage": self.stage,
+                "worker_id": self.worker_id,
+                "host": socket.gethostname(),
+                "pid": os.getpid(),
+                "load": self.load,
+                "started_at": self.started_at,
+                "updated_at": time.time(),
+            }
+            # the server clears workers_ready/ when it starts
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_suffix(".json.tmp")
+            tmp_path.write_text(json.dumps(data))
+            os.replace(tmp_path, self.path)
+
+    def mark_ready(self):
+        """Announce the replica and keep its heartbeat going from a daemon thread."""
+        self.write()
+        self._notify_supervisor()
+        self._thread = threading.Thread(target=self._beat, name="heartbeat", daemon=True)
+        self._thread.start()
+
+    def _notify_supervisor(self):
+        fd = os.environ.get(READY_FD_ENV)
+        if not fd:
+            return
+        message = {"event": "ready", "stage": self.stage, "worker_id": self.worker_id, "pid": os.getpid(),
+                   "ready_at": time.time()}
+        try:
+            # one line, well below PIPE_BUF, so the write is atomic
+            os.write(int(fd), (json.dumps(message) + "\n").encode())
+        except (OSError, ValueError):
+            # the supervisor is gone; the heartbeat file still announces the replica
+            pass
+
+    def _beat(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.write()
+            except OSError:
+                pass
+
+    def adjust_load(self, delta):
+        # jobs claimed (+1) or let go (-1); finalizer threads call this too
+        with self._lock:
+            self.load += delta
+            self.write()
+
+    def should_claim(self):
+        """Least-loaded scheduling: defer while another live replica has less work."""
+        others = [r for r in live_replicas(self.root, self.stage) if r["worker_id"] != self.worker_id]
+        return all(self.load <= r.get("load", 0) for r in others)
+
+    def stop(self):
+        self._stop.set()
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def wait_for_replicas(root, replicas, timeout=None, on_wait=None, report_every=10.0):
+    """Block until every stage in `replicas` (stage -> count) has that many live replicas.
+
+    Returns False if `timeout` expires first; `on_wait(missing)` gets the stages
+    still short of replicas every `report_every` seconds.
+    """
+    for stage in replicas:
+        # the server clears workers_ready/ when it starts
+        ready_dir(root, stage).mkdir(parents=True, exist_ok=True)
+    waiter = make_waiter([ready_dir(root, stage) for stage in replicas])
+    deadline = None if timeout is None else time.monotonic() + timeout
+    next_report = time.monotonic() + report_every
+    try:
+        while True:
+            missing = {stage: count - len(live_replicas(root, stage)) for stage, count in replicas.items()}
+            missing = {stage: n for stage, n in missing.items() if n > 0}
+            if not missing:
+                return True
+            now = time.monotonic()
+            if deadline is not None and now >= deadline:
+                return False
+            if on_wait is not None and now >= next_report:
+                on_wait(missing)
+                next_report = now + report_every
+            wait_s = next_report - now
+            if deadline is not None:
+                wait_s = min(wait_s, deadline - now)
+            waiter.wait(max(wait_s, 0.0))
+    finally:
+        waiter.close()
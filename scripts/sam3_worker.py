@@ -1,22 +1,31 @@
 # scripts/sam_segmentation_worker.py
 
-import os, sys
-
-from utils import ColorPrint
+import os, sys, json, functools
+
+from utils import ColorPrint, StartupTimer
+STARTUP = StartupTimer()
+from job_store import JobStore, WORKER_DATA, DEFAULT_PRIORITY
+from job_registry import JobRegistry
+from shm_transport import export_arrays, unlink_segments
+from mask_export import export_masks, make_png_pool
+from overlay import save_overlay
+from stage_stats import StageStats
+from replicas import Replica, SCHEDULE_RECHECK_S
+from tracing import Tracer, current_job
+from cache import ArtifactStore, RESULT_CACHE_DIR, RESULT_CACHE_MAX_BYTES, LRUCache, file_sha256
+from palette import load_palette
+from image_io import decode_image
 print = ColorPrint(worker_name="SAM3", default_color="yellow")
 
 print("Loading libraries and model...")
 
-import matplotlib.pyplot as plt
+# timing spans of this worker, correlated with the other processes by job_id
+TRACER = Tracer(WORKER_DATA, "sam3")
+
 import numpy as np
 
-import sam3
-from PIL import Image
-from sam3 import build_sam3_image_model
 import time
-from sam3.model.box_ops import box_xywh_to_cxcywh
-from sam3.model.sam3_image_processor import Sam3Processor
-from sam3.visualization_utils import draw_box_on_image, normalize_bbox, plot_results, plot_bbox, plot_mask
+from concurrent.futures import ThreadPoolExecutor
 
 # sam3_root = os.path.join(os.path.dirname(sam3.__file__), "..")
 
@@ -31,89 +40,99 @@ torch.backends.cudnn.allow_tf32 = True
 
 # use bfloat16 for the entire notebook
 torch.autocast("cuda", dtype=torch.bfloat16).__enter__()
+STARTUP.mark("imports")
 
-from sklearn.cluster import KMeans
-from skimage.color import rgb2lab, lab2rgb
-from matplotlib.colors import to_rgb
-
-
-def save_masks_as_pngs(inference_state, output_dir, img_np):
-    for idx, mask in enumerate(inference_state["masks"]):
-        mask_np = mask.squeeze(0).cpu().numpy().astype("uint8")
-        # Create an RGBA image: copy RGB, set alpha from mask
-        rgba = np.zeros((img_np.shape[0], img_np.shape[1], 4), dtype=np.uint8)
-        rgba[..., :3] = img_np[..., :3]  # Only take RGB channels if img_np has alpha
-        rgba[..., 3] = mask_np * 255
-        obj_img = Image.fromarray(rgba)
-        obj_save_path = os.path.join(output_dir, f"{idx}.png")
-        obj_img.save(obj_save_path)
-        print(f"Saved object {idx} to {obj_save_path}")
-
-def generate_colors(n_colors=256, n_samples=5000):
-    # Step 1: Random RGB samples
-    np.random.seed(42)
-    rgb = np.random.rand(n_samples, 3)
-    # Step 2: Convert to LAB for perceptual uniformity
-    # print(f"Converting {n_samples} RGB samples to LAB color space...")
-    lab = rgb2lab(rgb.reshape(1, -1, 3)).reshape(-1, 3)
-    # print("Conversion to LAB complete.")
-    # Step 3: k-means clustering in LAB
-    kmeans = KMeans(n_clusters=n_colors, n_init=10)
-    # print(f"Fitting KMeans with {n_colors} clusters on {n_samples} samples...")
-    kmeans.fit(lab)
-    # print("KMeans fitting complete.")
-    centers_lab = kmeans.cluster_centers_
-    # Step 4: Convert LAB back to RGB
-    colors_rgb = lab2rgb(centers_lab.reshape(1, -1, 3)).reshape(-1, 3)
-    colors_rgb = np.clip(colors_rgb, 0, 1)
-    return colors_rgb
-
-def plot_mask(mask, color="r", ax=None):
-    im_h, im_w = mask.shape
-    mask_img = np.zeros((im_h, im_w, 4), dtype=np.float32)
-    mask_img[..., :3] = to_rgb(color)
-    mask_img[..., 3] = mask * 0.5
-    # Use the provided ax or the current axis
-    if ax is None:
-        ax = plt.gca()
-    ax.imshow(mask_img)
-    
-def visualize_segmentation_results(image_path, output_dir, inference_state, colors, safe_prompt):
-    plt.figure(figsize=(12, 8))
-    img = Image.open(image_path)
-    plt.imshow(img)
-    results = inference_state
-    nb_objects = len(inference_state["scores"])
-    print(f"found {nb_objects} object(s)")
-    for i in range(nb_objects):
-        color = colors[i % len(colors)]
-        plot_mask(results["masks"][i].squeeze(0).cpu(), color=color)
-        w, h = img.size
-        prob = results["scores"][i].item()
-        plot_bbox(
-            h,
-            w,
-            results["boxes"][i].cpu(),
-            text=f"(id={i}, {prob=:.2f})",
-            box_format="XYXY",
-            color=color,
-            relative_coords=False,
-        )
-    plt.tight_layout()
-    save_path = os.path.join(output_dir, f"{safe_prompt}_segmentation_results.png")
-    plt.savefig(save_path)
-    print(f"Plotted results saved to {save_path}")
-
+def load_processor():
+    # runs in the background while the rest of the worker is set up
+    start_time = time.time()
+    from sam3 import build_sam3_image_model
+    from sam3.model.sam3_image_processor import Sam3Processor
+    model = build_sam3_image_model()
+    return Sam3Processor(model, confidence_threshold=0.5), time.time() - start_time
+
+def copy_image_state(state):
+    # set_text_prompt adds its outputs to the state dicts, so every job gets its
+    # own dicts while the (read-only) backbone tensors stay shared with the cache
+    return {k: dict(v) if isinstance(v, dict) else v for k, v in state.items()}
+
+def split_image_batch(batch_state, n):
+    """Per-image states, as set_image returns them, from a set_image_batch state."""
+    def take(obj, i):
+        if isinstance(obj, torch.Tensor):
+            # a copy, so the cache doesn't keep the whole batch alive
+            return obj[i:i + 1].clone() if obj.dim() and obj.shape[0] == n else obj
+        if isinstance(obj, dict):
+            return {k: take(v, i) for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(take(v, i) for v in obj)
+        return obj
+
+    heights, widths = batch_state["original_heights"], batch_state["original_widths"]
+    rest = {k: v for k, v in batch_state.items() if k not in ("original_heights", "original_widths", "backbone_out")}
+    return [
+        {**rest, "original_height": heights[i], "original_width": widths[i],
+         "backbone_out": take(batch_state["backbone_out"], i)}
+        for i in range(n)
+    ]
+
+def encode_images(processor, images):
+    """set_image for several images, as one batch through the backbone where possible."""
+    if len(images) > 1 and hasattr(processor, "set_image_batch"):
+        try:
+            return split_image_batch(processor.set_image_batch(images), len(images))
+        except (KeyError, TypeError, ValueError, RuntimeError) as e:
+            # different processor version, or the batch does not fit on the GPU
+            print(f"! Batched set_image failed ({e!r}), encoding the images one by one.", color="yellow")
+    return [processor.set_image(image) for image in images]
+
+def get_image_states(processor, images, image_keys, cache):
+    """Backbone states of `images`; the cache misses go through the model together."""
+    states = [None] * len(images)
+    misses = {}  # image key -> indices, the same image may come with several prompts
+    for i, key in enumerate(image_keys):
+        cached_state = cache.get(key)
+        if cached_state is not None:
+            states[i] = copy_image_state(cached_state)
+        else:
+            misses.setdefault(key, []).append(i)
+    stats = cache.stats()
+    if len(misses) < len(images):
+        print(f"Image embedding cache hit ({stats['hits']} hits / {stats['misses']} misses)")
+    if not misses:
+        return states
 
-def run_sam(model, image_path, prompt_path, output_dir, done_dir, colors, final_output_dir):
+    start_time = time.time()
+    with TRACER.span("sam3.set_image", images=len(misses)):
+        encoded = encode_images(processor, [images[indices[0]] for indices in misses.values()])
+    for (key, indices), inference_state in zip(misses.items(), encoded):
+        processor.reset_all_prompts(inference_state)
+        cache.put(key, copy_image_state(inference_state))
+        for i in indices:
+            states[i] = copy_image_state(inference_state)
+    stats = cache.stats()
+    print(
+        f"Image embedding cache miss, encoded {len(misses)} image(s) in {time.time() - start_time:.2f}s "
+        f"({stats['entries']} cached, {stats['bytes'] / 1024**2:.0f}/{stats['max_bytes'] / 1024**2:.0f} MB, "
+        f"{stats['evictions']} evictions)"
+    )
+    return states
+
+def load_job_image(image_path):
+    # the only decode of the upload: masks, overlay and SAM-3D all use this image
+    with TRACER.span("sam3.image_decode") as span:
+        image = decode_image(image_path)
+        span["size"] = list(image.size)
+    return image
+
+render_visualization = TRACER.traced("sam3.visualization")(save_overlay)
+
+def run_sam(processor, image, inference_state, prompt_path, done_dir, colors, final_output_dir):
+    """Segment one job, given its decoded image and backbone state; returns (files published
+    to final_output, futures of deferred files), or None if nothing was detected."""
     
     print("Starting inference...")
 
-    image = Image.open(image_path).convert("RGB")  # Ensure image is in RGB format
     width, height = image.size
-    processor = Sam3Processor(model, confidence_threshold=0.5)
-    inference_state = processor.set_image(image)
-
     processor.reset_all_prompts(inference_state)
     prompt = "object"
     if prompt_path and os.path.exists(prompt_path):
@@ -122,80 +141,291 @@ def run_sam(model, image_path, prompt_path, output_dir, done_dir, colors, final_
         print(f"Using prompt from file: \"{prompt}\".")
     else:
         print(f"! No prompt file found at {prompt_path}, using default prompt \"{prompt}\".")
-    inference_state = processor.set_text_prompt(state=inference_state, prompt=prompt)
+    with TRACER.span("sam3.set_text_prompt"):
+        inference_state = processor.set_text_prompt(state=inference_state, prompt=prompt)
 
     # check if there are masks detected
     if len(inference_state["masks"]) == 0:
         print("No masks detected!!!!, skipping saving masks and visualization.")
-        open(os.path.join(os.path.dirname(done_dir), "sam3_nomaskdetected.flag"), "a").close()
-        return
+        return None
     
     print(f"Detected {len(inference_state['masks'])} masks, saving masks and visualization...")
 
     img_np = np.array(image)
-    save_masks_as_pngs(inference_state, done_dir, img_np)
-    # Save the raw image in the done_dir
     # Sanitize prompt to create a valid filename
     safe_prompt = "".join(c if c.isalnum() or c in ('_', '-') else '_' for c in prompt.lower())
     safe_prompt = safe_prompt.replace(' ', '_').strip('_')
-    raw_img_save_path = os.path.join(done_dir, f"{safe_prompt}.png")
-    image.save(raw_img_save_path)
-    print(f"Saved raw image to {raw_img_save_path}")
 
-    visualize_segmentation_results(image_path, final_output_dir, inference_state, colors, safe_prompt)
-    print("Visualization complete.")
+    # SAM-3D gets the decoded image and the boolean masks through shared memory
+    with TRACER.span("sam3.handoff_export"):
+        masks_np = inference_state["masks"].squeeze(1).cpu().numpy().astype(bool)
+        handoff = export_arrays({"image": img_np, "masks": masks_np}, prefix="sam3")
+
+    try:
+        # compact copy of all masks (plus cropped cut-out PNGs when archiving)
+        export_start = time.time()
+        with TRACER.span("sam3.mask_export", masks=len(masks_np)):
+            _, mask_files = export_masks(done_dir, img_np, masks_np, cutouts=ARCHIVE_MASK_PNGS, pool=PNG_POOL)
+        print(f"Exported {len(masks_np)} masks in {time.time() - export_start:.3f}s: {len(mask_files)} file(s)")
+        if ARCHIVE_MASK_PNGS:
+            # Save the raw image in the done_dir
+            raw_img_save_path = os.path.join(done_dir, f"{safe_prompt}.png")
+            image.save(raw_img_save_path)
+            print(f"Saved raw image to {raw_img_save_path}")
+
+        # scores and boxes let SAM-3D pick which objects to reconstruct
+        masks_info = {
+            "prompt": prompt,
+            "name": safe_prompt,
+            "image": f"{safe_prompt}.png" if ARCHIVE_MASK_PNGS else None,
+            "image_size": [width, height],
+            "handoff": handoff,
+            "masks_file": mask_files[0],
+            "masks": [
+                {"index": i, "score": float(score), "box": [float(v) for v in box]}
+                for i, (score, box) in enumerate(zip(inference_state["scores"].tolist(), inference_state["boxes"].tolist()))
+            ],
+        }
+        with open(os.path.join(done_dir, "masks.json"), "w", encoding="utf-8") as f:
+            json.dump(masks_info, f, indent=2)
+    except Exception:
+        # the server only frees the segments listed in masks.json
+        unlink_segments(handoff)
+        raise
+
+    # overlay of all masks, boxes and scores; deferred renders it off the critical path
+    published, deferred = [], []
+    if VISUALIZATION != "off":
+        overlay_args = (
+            final_output_dir, safe_prompt, img_np, masks_np,
+            inference_state["boxes"].float().cpu().numpy(), inference_state["scores"].float().cpu().numpy(), colors,
+        )
+        if VISUALIZATION == "deferred":
+            deferred.append(PNG_POOL.submit(render_visualization, *overlay_args, job_id=current_job.get()))
+        else:
+            vis_start = time.time()
+            published.append(render_visualization(*overlay_args))
+            print(f"Visualization complete ({time.time() - vis_start:.3f}s).")
+    return published, deferred
 
 #######
 
-COLORS = generate_colors(n_colors=128, n_samples=5000)
-
-model = build_sam3_image_model()
-
-def create_all_folders():
-    for d in [INPUT_DIR, OUTPUT_DIR, DONE_DIR, READY_DIR]:
-        os.makedirs(d, exist_ok=True)
+MODEL_LOADER = ThreadPoolExecutor(max_workers=1, thread_name_prefix="model_loader").submit(load_processor)
+
+COLORS, palette_cached = load_palette(n_colors=128, n_samples=5000)
+STARTUP.mark("palette (cached)" if palette_cached else "palette (built)")
+
+# write the cut-outs and the raw image as PNGs too (debugging/archiving only,
+# SAM-3D reads them from shared memory)
+ARCHIVE_MASK_PNGS = False
+PNG_POOL = make_png_pool()
+
+# segmentation overlay: "off", "sync" (published before SAM-3D starts) or
+# "deferred" (rendered on PNG_POOL while the job moves on)
+VISUALIZATION = "sync"
+
+# backbone outputs of recently seen images, bounded by their (GPU) memory footprint
+EMBEDDING_CACHE_MAX_BYTES = 2 * 1024**3
+EMBEDDING_CACHE = LRUCache(max_bytes=EMBEDDING_CACHE_MAX_BYTES)
+
+STORE = JobStore()
+REGISTRY = JobRegistry(STORE.registry_path())
+RESULT_STORE = ArtifactStore(RESULT_CACHE_DIR, max_bytes=RESULT_CACHE_MAX_BYTES)
+
+# this process is one replica of the sam3 stage (see replicas.py)
+REPLICA = Replica(STORE.root, "sam3")
+print(f"Worker ID: {REPLICA.worker_id}")
+TRACER.worker_id = REPLICA.worker_id
+
+# wake up as soon as a job is enqueued; rescan now and then as a safety net
+WAITER = STORE.waiter("sam3", REPLICA.worker_id)
+IDLE_RESCAN_S = 5.0
+print(f"Job notification backend: {WAITER.backend}")
+
+# bounded buffer between the stages: SAM3 keeps segmenting while SAM-3D is
+# busy, but stops taking new jobs once this many are waiting for SAM-3D
+HANDOFF_CAPACITY = 4
+HANDOFF_WAITER = STORE.space_waiter("sam3d")
+
+# micro-batching: jobs queued together share one backbone pass (set_image_batch);
+# a claimed job waits at most BATCH_MAX_WAIT_S for others to join its batch
+MAX_BATCH_SIZE = int(os.environ.get("SAM3_BATCH_SIZE", "4"))
+BATCH_MAX_WAIT_S = float(os.environ.get("SAM3_BATCH_WAIT_MS", "20")) / 1000
+
+STATS = StageStats(STORE.root, "sam3", worker_id=REPLICA.worker_id)
+
+def wait_for_handoff_space():
+    blocked_start = None
+    while STORE.queue_depth("sam3d") >= HANDOFF_CAPACITY:
+        if blocked_start is None:
+            blocked_start = time.time()
+            print(f"SAM-3D buffer full ({HANDOFF_CAPACITY} jobs), waiting...")
+        HANDOFF_WAITER.wait(timeout=IDLE_RESCAN_S)
+    if blocked_start is not None:
+        STATS.add_blocked(time.time() - blocked_start)
+
+def register_files(job_id, names):
+    final_output_dir = STORE.final_output_dir(job_id)
+    REGISTRY.add_artifacts(job_id, {name: os.path.getsize(final_output_dir / name) for name in names})
+
+def register_deferred(job_id, future):
+    if future.exception() is not None:
+        print(f"! Visualization of job {job_id} failed: {future.exception()}", color="red")
+    else:
+        register_files(job_id, [future.result()])
 
-PATH = "/home/ferdinand/sam_project/sam_server/worker_data/sam3_worker"
-job_name = "job.jpg"
-INPUT_DIR = os.path.join(PATH, "input")
-OUTPUT_DIR = os.path.join(PATH, "output")
-DONE_DIR = os.path.join(os.path.dirname(PATH), "sam_3d_worker", "input")
-READY_DIR = os.path.join(os.path.dirname(PATH), "workers_ready")
-create_all_folders()
-PROMPT_PATH = os.path.join(INPUT_DIR, "prompt.txt")
-FINAL_OUTPUT_DIR = os.path.join(os.path.dirname(PATH), "final_output")
-IMAGE_PATH = os.path.join(INPUT_DIR, job_name)
+STARTUP.mark("setup")
 
+processor, model_load_s = MODEL_LOADER.result()
+STARTUP.mark("waiting for model")
+STARTUP.add("model load (background)", model_load_s)
 
-open(os.path.join(READY_DIR, "sam3_worker.ready"), "a").close()
+REPLICA.mark_ready()
+print(f"Ready after {STARTUP.total():.2f}s ({STARTUP.summary()})")
+STATS.set_extra(startup=STARTUP.phases, time_to_ready_s=STARTUP.total())
+STATS.write()
 print("Ready! Waiting for jobs...")
 
 
+def claim_batch():
+    """Claim up to MAX_BATCH_SIZE jobs; once one is claimed, wait at most BATCH_MAX_WAIT_S for more."""
+    batch = []
+    deadline = None
+    while len(batch) < MAX_BATCH_SIZE:
+        if batch and not REPLICA.should_claim():
+            # another replica is idle, leave it the rest of the queue
+            break
+        job_id = STORE.claim("sam3", owner=REPLICA.worker_id)
+        if job_id is None:
+            remaining = 0 if deadline is None else deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            WAITER.wait(timeout=remaining)
+            continue
+        if not STORE.job_exists(job_id):
+            print(f"! Workspace of job {job_id} is gone, skipping.")
+            STORE.complete("sam3", job_id)
+            continue
+        if REGISTRY.expire_if_due(job_id):
+            print(f"! Deadline of job {job_id} has passed, dropping it.", color="yellow")
+            STORE.complete("sam3", job_id)
+            continue
+        REPLICA.adjust_load(+1)
+        batch.append(job_id)
+        if deadline is None:
+            deadline = time.monotonic() + BATCH_MAX_WAIT_S
+    return batch
+
+def finish_job(job_id, start_time, result):
+    elapsed_time = time.time() - start_time
+    print(f"Job {job_id} finished! ({elapsed_time:.2f})s")
+    TRACER.record("sam3.job", start_time, elapsed_time, job_id=job_id, masks_detected=result is not None)
+
+    REGISTRY.mark_stage(job_id, "sam3")
+    # hand the masks over to SAM-3D before releasing the SAM3 queue entry
+    if result is not None:
+        published, deferred = result
+        register_files(job_id, published)
+        for future in deferred:
+            future.add_done_callback(functools.partial(register_deferred, job_id))
+        REGISTRY.set_masks(job_id, os.listdir(STORE.masks_dir(job_id)))
+        STORE.enqueue("sam3d", job_id, priority=REGISTRY.get(job_id).get("priority", DEFAULT_PRIORITY))
+    else:
+        REGISTRY.set_state(job_id, "no_masks_detected")
+        cache_key = REGISTRY.get(job_id).get("cache_key")
+        if cache_key:
+            RESULT_STORE.put(cache_key, STORE.final_output_dir(job_id), status="no_masks_detected")
+    STORE.complete("sam3", job_id)
+    REPLICA.adjust_load(-1)
+
+def fail_job(job_id, error):
+    # the job is given up, the replica carries on with the others
+    print(f"! Job {job_id} failed: {error!r}", color="red")
+    REGISTRY.fail(job_id, f"sam3: {error!r}")
+    STORE.complete("sam3", job_id)
+    REPLICA.adjust_load(-1)
+
+def encode_batch(images, image_keys):
+    """Backbone states of a micro-batch. If the batch fails, its images are encoded
+    one by one, so a bad image only fails its own job; failures come back as
+    the exception in place of the state."""
+    try:
+        return get_image_states(processor, images, image_keys, EMBEDDING_CACHE)
+    except Exception as e:
+        if len(images) == 1:
+            return [e]
+        print(f"! Encoding the batch failed ({e!r}), encoding its images one by one.", color="yellow")
+    states = []
+    for image, key in zip(images, image_keys):
+        try:
+            states += get_image_states(processor, [image], [key], EMBEDDING_CACHE)
+        except Exception as e:
+            states.append(e)
+    return states
+
+def run_batch(batch):
+    """Segment the jobs of a micro-batch: their images go through the backbone
+    together, the prompts and exports run per job."""
+    start_time = time.time()
+    STATS.job_started(batch[0])
+    jobs, images, image_keys = [], [], []
+    for job_id in batch:
+        print(f"Job {job_id} started" + (f" (batch of {len(batch)})" if len(batch) > 1 else ""))
+        REGISTRY.set_state(job_id, "processing")
+        REGISTRY.mark_stage_started(job_id, "sam3")
+        image_path = STORE.input_dir(job_id) / "job.jpg"
+        try:
+            with TRACER.job(job_id):
+                image = load_job_image(image_path)
+            # identical uploads share the backbone output, only the text prompt is rerun;
+            # the server hashed the upload while receiving it
+            image_key = REGISTRY.get(job_id).get("image_sha256") or file_sha256(image_path)
+        except Exception as e:
+            # e.g. an upload that looks like a JPEG but does not decode
+            fail_job(job_id, e)
+            continue
+        jobs.append(job_id)
+        images.append(image)
+        image_keys.append(image_key)
+
+    states = encode_batch(images, image_keys) if jobs else []
+
+    for job_id, image, inference_state in zip(jobs, images, states):
+        if isinstance(inference_state, Exception):
+            fail_job(job_id, inference_state)
+            continue
+        try:
+            with TRACER.job(job_id):
+                result = run_sam(
+                    processor,
+                    image,
+                    inference_state,
+                    os.path.join(STORE.input_dir(job_id), "prompt.txt"),
+                    STORE.masks_dir(job_id),
+                    COLORS,
+                    STORE.final_output_dir(job_id),
+                )
+        except Exception as e:
+            fail_job(job_id, e)
+            continue
+        finish_job(job_id, start_time, result)
+
+    STATS.set_extra(
+        embedding_cache=EMBEDDING_CACHE.stats(),
+        batch_size=len(batch),
+        # high-water mark of the CUDA caching allocator since the worker started
+        gpu_max_memory_bytes=torch.cuda.max_memory_allocated() if torch.cuda.is_available() else None,
+    )
+    STATS.job_finished(batch[0], batch_size=len(batch))
+
 while True:
-    if( not os.path.exists(INPUT_DIR) ):
-        create_all_folders()
-        time.sleep(0.1)
+    wait_for_handoff_space()
+    if STORE.queue_depth("sam3") and not REPLICA.should_claim():
+        # a less loaded replica takes this one
+        WAITER.wait(timeout=SCHEDULE_RECHECK_S)
         continue
-    
-    if not os.path.exists(IMAGE_PATH):
-        time.sleep(0.1)
+    batch = claim_batch()
+    if not batch:
+        WAITER.wait(timeout=IDLE_RESCAN_S)
         continue
-
-    start_time = time.time()
-    print(f"Job started")
-    
-    done_flag_path = os.path.join(OUTPUT_DIR, "done.flag")
-    if os.path.exists(done_flag_path):
-        os.remove(done_flag_path)
-    
-    run_sam(model, IMAGE_PATH, PROMPT_PATH, OUTPUT_DIR, DONE_DIR, COLORS, FINAL_OUTPUT_DIR)
-    
-    elapsed_time = time.time() - start_time
-    print(f"Job finished! ({elapsed_time:.2f})s")
-    
-    # open(os.path.join(OUTPUT_DIR, "done.flag"), "a").close()
-
-    os.remove(IMAGE_PATH)
-    if os.path.exists(PROMPT_PATH):
-        os.remove(PROMPT_PATH)
-    
\ No newline at end of file
+    run_batch(batch)
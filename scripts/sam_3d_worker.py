@@ -2,25 +2,77 @@
 
 import sys, os
 
-from utils import ColorPrint
+from utils import ColorPrint, StartupTimer
+STARTUP = StartupTimer()
+from job_store import (
+    JobStore, WORKER_DATA, DEFAULT_PRIORITY, DEFAULT_COLLISION_LODS, DEFAULT_ARTIFACTS, select_object_indices,
+    render_state_name,
+)
+from job_registry import JobRegistry
+from shm_transport import SharedArrays, unlink_segments
+from mask_export import load_compact_masks
+from stage_stats import StageStats
+from tracing import Tracer
+from replicas import Replica, SCHEDULE_RECHECK_S
+from cache import ArtifactStore, RESULT_CACHE_DIR, RESULT_CACHE_MAX_BYTES
+from image_io import decode_image
+from splat_io import write_compressed_ply, transform_gaussians
 print = ColorPrint(worker_name="SAM_3D", default_color="orange")
 
 print("Loading libraries and model...")
 
+import multiprocessing as mp
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+import mesh_tasks
+from mesh_tasks import publish, staging_dir, collision_task_groups
+
+# CPU post-processing (mesh exports, convex hull) runs in a process pool. It is
+# forked right away, before torch/CUDA are initialized in this process.
+POSTPROCESS_WORKERS = 4
+POSTPROCESS_POOL = ProcessPoolExecutor(max_workers=POSTPROCESS_WORKERS, mp_context=mp.get_context("fork"))
+POSTPROCESS_POOL.submit(int).result()
+STARTUP.mark("postprocess pool")
+# A pool process that dies (OOM kill, segfault in a mesh library) breaks the
+# pool for good. It can't be forked again now that CUDA is up, so the replica
+# exits and the supervisor restarts it; the jobs it held are re-queued.
+POOL_BROKEN_EXIT_CODE = 3
+
+def exit_if_pool_broken(error):
+    if isinstance(error, BrokenProcessPool):
+        print(f"! Post-processing pool is broken ({error!r}), exiting for a restart.", color="red")
+        os._exit(POOL_BROKEN_EXIT_CODE)
+
+# exports that need the gaussians on the GPU (splats, GIF) run on one thread here
+GPU_EXPORT_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gpu_export")
+
 sys.path.insert(0, "/home/ferdinand/sam_project/sam-3d-objects/notebook")
 
 import time
+import json
+import shutil
+import inspect
+import functools
 import imageio
-import uuid
-from IPython.display import Image as ImageDisplay
-from inference import Inference, ready_gaussian_for_video_rendering, render_video, load_image, load_single_mask, display_image, make_scene, interactive_visualizer
-import trimesh
-
-def save_gif(model_output, output_dir, image_name):
-    # render gaussian splat
+import numpy as np
+import torch
+# the notebook's inference module (and the notebook/IPython stack it pulls in) is
+# imported where it is used, the pipeline loader imports it in the background
+STARTUP.mark("imports")
+
+# timing spans of this worker, correlated with the other processes by job_id
+TRACER = Tracer(WORKER_DATA, "sam3d")
+
+def prepare_render_scene(model_output):
+    # cheap; the turntable itself is only rendered when the GIF is downloaded
+    from inference import make_scene, ready_gaussian_for_video_rendering
     scene_gs = make_scene(model_output)
-    scene_gs = ready_gaussian_for_video_rendering(scene_gs)
+    return ready_gaussian_for_video_rendering(scene_gs)
 
+def save_gif(scene_gs, output_dir, image_name):
+    from inference import render_video
+    # render gaussian splat
     video = render_video(
         scene_gs,
         r=1,
@@ -40,207 +92,535 @@ def save_gif(model_output, output_dir, image_name):
         loop=0,  # 0 means loop indefinitely
     )
     
-def clean_mesh(m):
-    # remove degenerate faces via mask
-    mask = m.nondegenerate_faces()
-    if mask is not None:
-        m = m.submesh([mask], append=True)
-
-    # remove unused vertices
-    m.remove_unreferenced_vertices()
-
-    # final validation
-    m.process(validate=True)
-    return m
-
-def rescale_to_match(source: trimesh.Trimesh, target: trimesh.Trimesh):
-    # Compute bounding boxes
-    src_extents = source.bounding_box.extents
-    tgt_extents = target.bounding_box.extents
-
-    # Uniform scale factor (preserve proportions)
-    scale = (src_extents / tgt_extents).min()
-
-    target.apply_scale(scale)
-
-    # Align centers
-    src_center = source.bounding_box.centroid
-    tgt_center = target.bounding_box.centroid
-    target.apply_translation(src_center - tgt_center)
-
-    return target
-
-def create_voxel_collision_mesh(mesh, voxel_scale=64.0):
-
-    # Voxel resolution control (lower = coarser)
-    voxel_pitch = mesh.scale / voxel_scale  # try 64, 128, 256
-
-    vox = mesh.voxelized(pitch=voxel_pitch)
-    vox = vox.fill()
-    # 3. Reconstruct surface
-    collision = vox.marching_cubes
-    collision = clean_mesh(collision)
-    collision = rescale_to_match(mesh, collision)
-
-    print(f"Collision mesh: {len(collision.faces)} faces")
-    print("Collision watertight:", collision.is_watertight)
-    assert collision.is_watertight, "Collision mesh is NOT watertight!"
-    # print("Collision Euler number:", collision.euler_number)
-    # print("Collision volume:", collision.volume)
-    
-    return collision
-
-def create_convex_hull_mesh(mesh, reduce_percent=0.9):
-    # Simplify mesh to reduce number of faces
-    simplified_mesh = mesh.simplify_quadric_decimation(reduce_percent)
-    convexhull = simplified_mesh.convex_hull
-    convexhull = clean_mesh(convexhull)
-    convexhull = rescale_to_match(mesh, convexhull)
-    print(f"Convex hull mesh has {len(convexhull.faces)} faces")
-    return convexhull
-
-def make_mujoco_safe(mesh: trimesh.Trimesh) -> trimesh.Trimesh:
-    mesh = mesh.copy()
-
-    # Remove degenerate faces
-    mask = mesh.nondegenerate_faces()
-    if mask is not None:
-        mesh = mesh.submesh([mask], append=True)
-
-    # THIS IS CRITICAL
-    mesh.remove_unreferenced_vertices()
-
-    # Force clean reindex
-    mesh.process(validate=True)
-
-    return mesh
-
-def run_sam3d(config_path, image_path, done_dir, output_dir, prompt):
-    
-    print("Starting inference...")
-        
+def load_pipeline(config_path):
+    start_time = time.time()
+    from inference import Inference
     inference = Inference(config_path, compile=False)
+    print(f"Loaded SAM-3D pipeline ({time.time() - start_time:.2f})s")
+    return inference
 
-    ######
-
-    IMAGE_NAME = os.path.basename(os.path.dirname(image_path))
-    image = load_image(image_path, convert_rgb=True)
-    input_dir = os.path.dirname(image_path)
-    mask = load_single_mask(input_dir, index=0)
-    # display_image(image, masks=[mask])
-
-    ######
-
-    # run model
-    model_output = inference(image, mask, seed=42)
-    
-    WITH_MESH_POSTPROCESS = True
-    WITH_TEXTURE_BAKING = True
-    model_output = inference._pipeline.postprocess_slat_output(
-        model_output,
-        with_mesh_postprocess=WITH_MESH_POSTPROCESS,
-        with_texture_baking=WITH_TEXTURE_BAKING,
-        use_vertex_color=not WITH_TEXTURE_BAKING,
-    )
-    
-    mesh = model_output["glb"]  # trimesh object
-    mesh_path = os.path.join(output_dir, f"{prompt}_mesh.glb")
-    mesh.export(mesh_path)
-    print(f"Exported .glb mesh")
-    
-    # Import and export to .obj with texture and material
-    # mesh = trimesh.load(mesh_path, force="mesh")
-    mesh = model_output["glb"].copy()
-    mesh = make_mujoco_safe(mesh)
-    mesh.apply_scale(1 / 10.0)
-    # Rename material and texture if present
-    if hasattr(mesh, 'visual') and hasattr(mesh.visual, 'material'):
-        mesh.visual.material.name = f"{prompt}_material"
-        if hasattr(mesh.visual.material, 'image') and mesh.visual.material.image is not None:
-            texture_path = os.path.join(done_dir, f"{prompt}_texture.png")
-            imageio.imwrite(texture_path, mesh.visual.material.image)
-            mesh.visual.material.image = texture_path
-    mesh.export(os.path.join(done_dir, f"{prompt}_visual.obj"))
-    # Rename automatically generated MTL
-    auto_mtl_path = os.path.join(done_dir, f"material.mtl")
-    desired_mtl_path = os.path.join(done_dir, f"{prompt}_material.mtl")
-    if os.path.exists(auto_mtl_path):
-        os.rename(auto_mtl_path, desired_mtl_path)
-    print(f"Exported visual mesh")
-        
-    # Ensure mesh is a single unified mesh
-    if isinstance(mesh, trimesh.Scene):
-        mesh = trimesh.util.concatenate(mesh.dump())
-    print(f"Mesh has {len(mesh.faces)} faces")
-        
-    # create convex hull
-    create_convex_hull_mesh(mesh, reduce_percent=0.93).export(os.path.join(done_dir, f"{prompt}_collision.obj"))    
-    print(f"Exported convex hull collision mesh")
+def warmup_pipeline(inference, size=256):
+    # run one inference on a dummy image/mask so the first real job doesn't pay
+    # for lazy initialization (kernel selection, allocator growth, ...)
+    start_time = time.time()
+    image = np.full((size, size, 3), 127, dtype=np.uint8)
+    mask = np.zeros((size, size), dtype=bool)
+    mask[size // 4: 3 * size // 4, size // 4: 3 * size // 4] = True
+    try:
+        inference(image, mask, seed=42)
+    except Exception as e:
+        print(f"! Warm-up inference failed, continuing without it: {e}")
+        return
+    print(f"Warm-up inference done ({time.time() - start_time:.2f})s")
+
+def splat_attributes(gs):
+    """Gaussian attributes as numpy arrays, in the conventions and the frame of gs.save_ply()."""
+    def numpy(t):
+        return t.detach().float().cpu().numpy()
+
+    features_rest = getattr(gs, "_features_rest", None)
+    attributes = {
+        "xyz": numpy(gs.get_xyz),
+        "f_dc": numpy(gs._features_dc.transpose(1, 2).flatten(start_dim=1)),
+        "f_rest": None if features_rest is None else numpy(features_rest.transpose(1, 2).flatten(start_dim=1)),
+        "opacity": numpy(torch.logit(gs.get_opacity)),
+        "scale": numpy(torch.log(gs.get_scaling)),
+        "rotation": numpy(gs.get_rotation),
+    }
+    # save_ply() rotates the splat into the PLY frame (y-up to z-up) by default
+    transform = inspect.signature(gs.save_ply).parameters.get("transform")
+    if transform is not None and transform.default is not None:
+        attributes["xyz"], attributes["rotation"] = transform_gaussians(
+            attributes["xyz"], attributes["rotation"], transform.default)
+    return attributes
+
+@TRACER.traced("sam3d.export_splat")
+def export_splat_task(model_output, done_dir, output_dir, prompt):
+    # quantized, chunked splat (see splat_io.py), about a quarter of the full PLY
+    staging = staging_dir(output_dir, f"{prompt}_gsplat")
+    ply_path = os.path.join(staging, f"{prompt}_gsplat.compressed.ply")
+    size = write_compressed_ply(ply_path, **splat_attributes(model_output["gs"]))
+    published = [publish(ply_path, done_dir)]
+    print(f"Exported compressed gaussian splat ({size / 1e6:.1f} MB)")
+    return published
+
+@TRACER.traced("sam3d.export_ply")
+def export_splat_ply_task(model_output, done_dir, output_dir, prompt):
+    # export gaussian splat (as point cloud), full float32 precision
+    staging = staging_dir(output_dir, f"{prompt}_gsplat")
+    ply_path = os.path.join(staging, f"{prompt}_gsplat.ply")
+    model_output["gs"].save_ply(ply_path)
+    published = [publish(ply_path, done_dir)]
+    print(f"Exported gaussian splat")
+    return published
+
+@TRACER.traced("sam3d.export_render_state")
+def export_render_state_task(model_output, done_dir, output_dir, prompt):
+    # the GIF is rendered on its first download (see serve_render_request), from
+    # the scene prepared here; the state sits next to it in final_output, so it
+    # is archived and cached along with the job
+    gif_name = f"{prompt}_3d_visualization.gif"
+    staging = staging_dir(output_dir, f"{prompt}_gif")
+    state_path = os.path.join(staging, render_state_name(gif_name))
+    torch.save(prepare_render_scene(model_output), state_path)
+    publish(state_path, done_dir)
+    print(f"Prepared gif visualization for rendering on demand")
+    return {"files": [], "on_demand": [gif_name]}
+
+@TRACER.traced("sam3d.export_gif")
+def render_gif_task(done_dir, output_dir, gif_name):
+    scene_gs = torch.load(os.path.join(done_dir, render_state_name(gif_name)), map_location="cuda", weights_only=False)
+    staging = staging_dir(output_dir, gif_name)
+    save_gif(scene_gs, staging, gif_name.removesuffix(".gif"))
+    published = publish(os.path.join(staging, gif_name), done_dir)
+    print(f"Rendered gif visualization {gif_name}")
+    return published
+
+def export_collision(mesh, done_dir, output_dir, prompt, lods, source_hash=None, job_id=None):
+    # the LODs are generated in parallel, see mesh_tasks.collision_task_groups
+    return [
+        POSTPROCESS_POOL.submit(mesh_tasks.export_collision_task, mesh, done_dir, output_dir, prompt, group,
+                                source_hash=source_hash, job_id=job_id)
+        for group in collision_task_groups(lods)
+    ]
+
+def task_files(result):
+    # collision and render state tasks return a report along with their files
+    return result["files"] if isinstance(result, dict) else result
+
+# outputs that need the textured mesh of postprocess_slat_output()
+MESH_OUTPUTS = ("visual", "collision", "glb")
+
+def export_object(model_output, done_dir, output_dir, prompt, outputs=DEFAULT_ARTIFACTS, job_id=None):
+    """Schedule the exports of one object selected by `outputs`, returns their futures.
+
+    Each future resolves to the list of files it published to `done_dir`, or
+    for collision meshes and the GIF to a dict with the files and a report.
+    """
+    mesh = model_output.get("glb")  # trimesh object
+    futures = []
+    if "glb" in outputs:
+        futures.append(POSTPROCESS_POOL.submit(mesh_tasks.export_glb_task, mesh, done_dir, output_dir, prompt,
+                                               job_id=job_id))
+    if "visual" in outputs:
+        futures.append(POSTPROCESS_POOL.submit(mesh_tasks.export_visual_task, mesh, done_dir, output_dir, prompt,
+                                               job_id=job_id))
+    if "collision" in outputs:
+        futures += export_collision(mesh, done_dir, output_dir, prompt, DEFAULT_COLLISION_LODS, job_id=job_id)
+    if "splat" in outputs:
+        futures.append(GPU_EXPORT_POOL.submit(export_splat_task, model_output, done_dir, output_dir, prompt,
+                                              job_id=job_id))
+    if "splat_ply" in outputs:
+        futures.append(GPU_EXPORT_POOL.submit(export_splat_ply_task, model_output, done_dir, output_dir, prompt,
+                                              job_id=job_id))
+    if "gif" in outputs:
+        futures.append(GPU_EXPORT_POOL.submit(export_render_state_task, model_output, done_dir, output_dir, prompt,
+                                              job_id=job_id))
+    return futures
+
+def accepts_pointmap(inference):
+    try:
+        return "pointmap" in inspect.signature(inference.__call__).parameters
+    except (TypeError, ValueError):
+        return False
+
+@TRACER.traced("sam3d.load_inputs")
+def load_inputs(masks_dir, image_path, masks_info, indices):
+    """Image and masks of a job; returns (image, masks, shared) where `shared` must be released."""
+    load_start = time.time()
+    shared = None
+    if masks_info.get("handoff"):
+        try:
+            # decoded arrays straight from the SAM3 worker's shared memory
+            shared = SharedArrays(masks_info["handoff"])
+        except FileNotFoundError:
+            # shared memory does not survive a reboot
+            print("! Shared-memory handoff is gone, reading the mask files.", color="yellow")
+    if shared is not None:
+        image = shared["image"]
+        masks = {idx: shared["masks"][idx] for idx in indices}
+        source = "shared memory"
+    else:
+        if masks_info.get("image"):
+            from inference import load_image
+            image = load_image(os.path.join(masks_dir, masks_info["image"]), convert_rgb=True)
+        else:
+            # decoded the way SAM3 did, so the size matches the masks
+            image = np.array(decode_image(image_path))
+        all_masks = load_compact_masks(os.path.join(masks_dir, masks_info["masks_file"]))
+        masks = {idx: all_masks[idx] for idx in indices}
+        source = masks_info["masks_file"]
+    print(f"Input loading ({source}): {time.time() - load_start:.2f}s")
+    return image, masks, shared
+
+def run_sam3d(inference, image, masks, done_dir, output_dir, prompt, indices, indexed_names=False,
+              outputs=DEFAULT_ARTIFACTS, job_id=None):
     
-    # # create voxel-based watertight collision mesh
-    # create_voxel_collision_mesh(mesh, voxel_scale=64.0).export(os.path.join(done_dir, "collision.obj"))
-
-
-    # export gaussian splat (as point cloud) and gif visualization
-    model_output["gs"].save_ply(f"{output_dir}/{prompt}_gsplat.ply")
-    save_gif(model_output, done_dir, f"{prompt}_3d_visualization")
-    print(f"Exported gaussian splat and gif visualization")
-
+    print(f"Starting inference for {len(indices)} object(s): {indices}")
+    # display_image(image, masks=list(masks.values()))
+
+    # The model reconstructs one mask per call. The pointmap only depends on
+    # the image, so it is estimated once and shared by all objects.
+    share_pointmap = len(indices) > 1 and accepts_pointmap(inference)
+    pointmap = None
+    objects = []
+    for idx in indices:
+        name = f"{prompt}_{idx}" if indexed_names else prompt
+
+        # run model
+        inference_start = time.time()
+        with TRACER.span("sam3d.inference", job_id=job_id, object=idx, shared_pointmap=pointmap is not None):
+            if pointmap is not None:
+                model_output = inference(image, masks[idx], seed=42, pointmap=pointmap)
+            else:
+                model_output = inference(image, masks[idx], seed=42)
+        if share_pointmap and pointmap is None:
+            pointmap = model_output.get("pointmap")
+        inference_time = time.time() - inference_start
+        print(f"Object {idx}: inference {inference_time:.2f}s")
+
+        # the mesh is only post-processed (and textured) if an output needs it
+        WITH_MESH_POSTPROCESS = any(kind in outputs for kind in MESH_OUTPUTS)
+        WITH_TEXTURE_BAKING = "visual" in outputs or "glb" in outputs
+        if WITH_MESH_POSTPROCESS:
+            postprocess_start = time.time()
+            with TRACER.span("sam3d.postprocess_slat_output", job_id=job_id, object=idx):
+                model_output = inference._pipeline.postprocess_slat_output(
+                    model_output,
+                    with_mesh_postprocess=WITH_MESH_POSTPROCESS,
+                    with_texture_baking=WITH_TEXTURE_BAKING,
+                    use_vertex_color=not WITH_TEXTURE_BAKING,
+                )
+            print(f"Object {idx}: postprocessing {time.time() - postprocess_start:.2f}s")
+
+        # exports run in the background, the GPU can move on right away
+        objects.append({
+            "index": idx,
+            "name": name,
+            "futures": export_object(model_output, done_dir, output_dir, name, outputs, job_id=job_id),
+        })
+        del model_output
+
+    return objects
+
+def register_files(job_id, names):
+    final_output_dir = STORE.final_output_dir(job_id)
+    REGISTRY.add_artifacts(job_id, {name: os.path.getsize(final_output_dir / name) for name in names})
+
+def register_artifacts(job_id, future):
+    # make the files of one export task visible as soon as it is done
+    if future.exception() is None:
+        result = future.result()
+        register_files(job_id, task_files(result))
+        if isinstance(result, dict) and result.get("on_demand"):
+            REGISTRY.add_on_demand(job_id, result["on_demand"])
+
+def write_objects_json(job_id, data):
+    final_output_dir = str(STORE.final_output_dir(job_id))
+    tmp_path = os.path.join(final_output_dir, ".objects.json.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2)
+    publish(tmp_path, final_output_dir, "objects.json")
+    register_files(job_id, ["objects.json"])
+
+def requested_collision_lods(job_id):
+    # the LODs sent along with the queue entries, and any others still open in the registry
+    lods = [lod for payload in STORE.claimed_payloads("collision", job_id, owner=REPLICA.worker_id)
+            for lod in payload.get("lods", [])]
+    lods += (REGISTRY.get(job_id) or {}).get("collision_requests", [])
+    return list(dict.fromkeys(lods))
+
+def serve_collision_request(job_id):
+    """Generate the collision LODs requested for a finished job, from the source
+    meshes memoized by mesh_tasks, and add them to its objects.json."""
+    start_time = time.time()
+    lods = []
+    try:
+        lods = requested_collision_lods(job_id)
+        objects_path = STORE.final_output_dir(job_id) / "objects.json"
+        if not lods:
+            # served together with an earlier entry of the job
+            return
+        if not objects_path.exists():
+            print(f"! Collision LODs {lods} of job {job_id} requested, but it has no objects.json.", color="red")
+            return
+        print(f"Collision LODs {lods} requested for job {job_id}")
+        data = json.loads(objects_path.read_text())
+        done_dir, output_dir = str(STORE.final_output_dir(job_id)), str(STORE.output_dir(job_id))
+        pending = [
+            (obj, export_collision(None, done_dir, output_dir, obj["name"], lods,
+                                   source_hash=obj["mesh_hash"], job_id=job_id))
+            for obj in data["objects"] if obj.get("mesh_hash")
+        ]
+        for obj, futures in pending:
+            for future in futures:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    exit_if_pool_broken(e)
+                    # e.g. the source mesh has been evicted from the cache
+                    print(f"! Collision LODs for object {obj['index']} of job {job_id} failed: {e}", color="red")
+                    continue
+                register_files(job_id, result["files"])
+                obj["files"] = sorted(set(obj["files"]) | set(result["files"]))
+                obj.setdefault("collision", {}).update(result["collision"])
+        write_objects_json(job_id, data)
+        print(f"Collision LODs of job {job_id} done ({time.time() - start_time:.2f})s")
+        TRACER.record("sam3d.collision_request", start_time, time.time() - start_time, job_id=job_id, lods=lods)
+    except Exception as e:
+        exit_if_pool_broken(e)
+        print(f"! Collision request of job {job_id} failed: {e}", color="red")
+    finally:
+        # the request is closed either way; LODs that failed are missing from the artifacts
+        if lods:
+            REGISTRY.complete_collision_lods(job_id, lods)
+        shutil.rmtree(os.path.join(STORE.output_dir(job_id), "staging"), ignore_errors=True)
+        STORE.complete("collision", job_id)
+
+def serve_render_request(job_id):
+    """Render the on-demand GIFs requested for a finished job (see render_gif_task)."""
+    names = []
+    try:
+        job = REGISTRY.get(job_id) or {}
+        # the names sent along with the queue entries (older entries are empty)
+        names = [name for payload in STORE.claimed_payloads("render", job_id, owner=REPLICA.worker_id)
+                 for name in payload.get("names", [])]
+        names = list(dict.fromkeys(names or job.get("render_requests", [])))
+        done_dir, output_dir = str(STORE.final_output_dir(job_id)), str(STORE.output_dir(job_id))
+        for name in names:
+            try:
+                render_gif_task(done_dir, output_dir, name, job_id=job_id)
+            except Exception as e:
+                # the request is closed without the file, the download reports the failure
+                print(f"! Rendering {name} of job {job_id} failed: {e}", color="red")
+                continue
+            register_files(job_id, [name])
+            state_name = render_state_name(name)
+            if job.get("cache_key"):
+                # later cache hits get the GIF instead of rendering it again
+                RESULT_STORE.add_file(job["cache_key"], os.path.join(done_dir, name), replaces=state_name)
+            os.remove(os.path.join(done_dir, state_name))
+    except Exception as e:
+        print(f"! Render request of job {job_id} failed: {e}", color="red")
+    finally:
+        REGISTRY.complete_render(job_id, names)
+        shutil.rmtree(os.path.join(STORE.output_dir(job_id), "staging"), ignore_errors=True)
+        STORE.complete("render", job_id)
+
+def fail_job(job_id, error):
+    # the job is given up, the replica carries on with the next one
+    print(f"! Job {job_id} failed: {error!r}", color="red")
+    REGISTRY.fail(job_id, f"sam3d: {error!r}")
+    shutil.rmtree(os.path.join(STORE.output_dir(job_id), "staging"), ignore_errors=True)
+    STORE.complete("sam3d", job_id)
+    STATS.job_finished(job_id)
+    release_job_slot()
+
+def finalize_job(job_id, objects, selection, scores, start_time):
+    # waits for the background exports of a job and then marks it done
+    try:
+        wait([f for obj in objects for f in obj["futures"]])
+        failed_exports = 0
+        for obj in objects:
+            files = []
+            for future in obj.pop("futures"):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    exit_if_pool_broken(e)
+                    print(f"! Export for object {obj['index']} of job {job_id} failed: {e}", color="red")
+                    failed_exports += 1
+                    continue
+                files += task_files(result)
+                if isinstance(result, dict) and "collision" in result:
+                    # collision LODs: face count and generation time per level
+                    obj["mesh_hash"] = result["mesh_hash"]
+                    obj.setdefault("collision", {}).update(result["collision"])
+                if isinstance(result, dict) and result.get("on_demand"):
+                    obj.setdefault("on_demand", []).extend(result["on_demand"])
+                    REGISTRY.add_on_demand(job_id, result["on_demand"])
+            obj["files"] = sorted(files)
+            obj["score"] = scores[obj["index"]]
+            # done callbacks may still be running, register everything before the job counts as done
+            register_files(job_id, files)
+        shutil.rmtree(os.path.join(STORE.output_dir(job_id), "staging"), ignore_errors=True)
+
+        FINAL_OUTPUT_DIR = str(STORE.final_output_dir(job_id))
+        write_objects_json(job_id, {"selection": selection, "objects": objects})
+        REGISTRY.mark_stage(job_id, "exports")
+
+        cache_key = REGISTRY.get(job_id).get("cache_key")
+        if cache_key and failed_exports:
+            # a partial result (e.g. after a transient OOM) must not answer later submissions
+            print(f"! Result of job {job_id} not cached, {failed_exports} export(s) failed.", color="yellow")
+        elif cache_key:
+            RESULT_STORE.put(cache_key, FINAL_OUTPUT_DIR, status="done")
+        REGISTRY.set_state(job_id, "done")
+        STORE.complete("sam3d", job_id)
+        print(f"Job {job_id} done, all artifacts published ({time.time() - start_time:.2f})s")
+        TRACER.record("sam3d.job", start_time, time.time() - start_time, job_id=job_id)
+    except Exception as e:
+        exit_if_pool_broken(e)
+        print(f"! Finishing job {job_id} failed: {e!r}", color="red")
+        REGISTRY.fail(job_id, f"sam3d: {e!r}")
+        STORE.complete("sam3d", job_id)
+    finally:
+        release_job_slot()
 
-def create_all_folders():
-    for d in [INPUT_DIR, OUTPUT_DIR, DONE_DIR, READY_DIR]:
-        os.makedirs(d, exist_ok=True)
 
-                
 config_path = "/home/ferdinand/sam_project/sam-3d-objects/checkpoints/hf/pipeline.yaml"
+WARMUP = True
 
-PATH = "/home/ferdinand/sam_project/sam_server/worker_data/sam_3d_worker"
-INPUT_DIR = os.path.join(PATH, "input")
-OUTPUT_DIR = os.path.join(PATH, "output")
-DONE_DIR = os.path.join(os.path.dirname(PATH), "final_output")
-READY_DIR = os.path.join(os.path.dirname(PATH), "workers_ready")
-create_all_folders()
-PROMPT_NAME = "object"
-
-open(os.path.join(READY_DIR, "sam_3d_worker.ready"), "a").close()
+def load_and_warm_up(config_path):
+    # runs in the background while the rest of the worker is set up
+    start_time = time.time()
+    inference = load_pipeline(config_path)
+    if WARMUP:
+        warmup_pipeline(inference)
+    return inference, time.time() - start_time
+
+# the pipeline stays resident and is reused by every job
+PIPELINE_LOADER = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pipeline_loader").submit(load_and_warm_up, config_path)
+
+STORE = JobStore()
+REGISTRY = JobRegistry(STORE.registry_path())
+RESULT_STORE = ArtifactStore(RESULT_CACHE_DIR, max_bytes=RESULT_CACHE_MAX_BYTES)
+
+# this process is one replica of the sam3d stage (see replicas.py)
+REPLICA = Replica(STORE.root, "sam3d")
+print(f"Worker ID: {REPLICA.worker_id}")
+TRACER.worker_id = REPLICA.worker_id
+
+def gpu_max_memory_bytes():
+    # high-water mark of the CUDA caching allocator since the worker started
+    import torch
+    return torch.cuda.max_memory_allocated() if torch.cuda.is_available() else None
+
+# wake up as soon as a job is enqueued; rescan now and then as a safety net
+WAITER = STORE.waiter("sam3d", REPLICA.worker_id)
+IDLE_RESCAN_S = 5.0
+print(f"Job notification backend: {WAITER.backend}")
+STATS = StageStats(STORE.root, "sam3d", worker_id=REPLICA.worker_id)
+# jobs whose exports may still be running while the GPU works on the next one
+MAX_FINALIZING_JOBS = 2
+FINALIZE_SLOTS = threading.Semaphore(MAX_FINALIZING_JOBS)
+
+# collision LOD requests, one at a time; their meshes are built on POSTPROCESS_POOL
+COLLISION_REQUESTS = ThreadPoolExecutor(max_workers=1, thread_name_prefix="collision")
+
+def release_job_slot():
+    FINALIZE_SLOTS.release()
+    REPLICA.adjust_load(-1)
+
+STARTUP.mark("setup")
+
+INFERENCE, pipeline_load_s = PIPELINE_LOADER.result()
+STARTUP.mark("waiting for pipeline")
+STARTUP.add("pipeline load + warm-up (background)", pipeline_load_s)
+
+REPLICA.mark_ready()
+print(f"Ready after {STARTUP.total():.2f}s ({STARTUP.summary()})")
+STATS.set_extra(startup=STARTUP.phases, time_to_ready_s=STARTUP.total())
+STATS.write()
 print("Ready! Waiting for jobs...")
 
 
 while True:
-    if( not os.path.exists(INPUT_DIR) ):
-        create_all_folders()
-        time.sleep(0.1)
+    # collision LODs requested for finished jobs; CPU only, so they are served
+    # next to the GPU work
+    while (collision_job_id := STORE.claim("collision", owner=REPLICA.worker_id)) is not None:
+        COLLISION_REQUESTS.submit(serve_collision_request, collision_job_id)
+    # GIFs rendered on their first download; they need the GPU
+    while (render_job_id := STORE.claim("render", owner=REPLICA.worker_id)) is not None:
+        GPU_EXPORT_POOL.submit(serve_render_request, render_job_id)
+    FINALIZE_SLOTS.acquire()
+    if STORE.queue_depth("sam3d") and not REPLICA.should_claim():
+        # a less loaded replica takes this one
+        FINALIZE_SLOTS.release()
+        WAITER.wait(timeout=SCHEDULE_RECHECK_S)
         continue
-    # Check if there is any .png image in the input directory
-    png_full_image_files = [f for f in os.listdir(INPUT_DIR) if f.lower().endswith('.png') and len(os.path.splitext(f)[0]) > 2]
-    if not png_full_image_files:
-        time.sleep(0.1)
+    job_id = STORE.claim("sam3d", owner=REPLICA.worker_id)
+    if job_id is None:
+        FINALIZE_SLOTS.release()
+        WAITER.wait(timeout=IDLE_RESCAN_S)
         continue
-    
-    png_files = [f for f in os.listdir(INPUT_DIR) if f.lower().endswith('.png')]
-    # Take the .png file with the longest name
-    IMAGE_FILENAME = max(png_files, key=lambda f: len(os.path.splitext(f)[0]))
-    IMAGE_PATH = os.path.join(INPUT_DIR, IMAGE_FILENAME)
-    # Extract prompt name from image filename (e.g., "promptname.png" -> "promptname")
-    PROMPT_NAME = os.path.splitext(IMAGE_FILENAME)[0]
+    REPLICA.adjust_load(+1)
+    if not STORE.job_exists(job_id):
+        print(f"! Workspace of job {job_id} is gone, skipping.")
+        STORE.complete("sam3d", job_id)
+        release_job_slot()
+        continue
+
+    INPUT_DIR = str(STORE.masks_dir(job_id))
+    OUTPUT_DIR = str(STORE.output_dir(job_id))
+    # masks.json holds the SAM3 score of every mask and the handoff descriptor
+    try:
+        with open(os.path.join(INPUT_DIR, "masks.json"), "r", encoding="utf-8") as f:
+            masks_info = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError) as e:
+        # e.g. SAM3 failed while writing it; only this job is lost
+        fail_job(job_id, e)
+        continue
+    if REGISTRY.expire_if_due(job_id):
+        print(f"! Deadline of job {job_id} has passed, dropping it.", color="yellow")
+        unlink_segments(masks_info.get("handoff") or {})
+        STORE.complete("sam3d", job_id)
+        release_job_slot()
+        continue
+    PROMPT_NAME = masks_info["name"]
     print(f"Prompt name: {PROMPT_NAME}")
 
     start_time = time.time()
-    print(f"Job started")
-    
-    done_flag_path = os.path.join(OUTPUT_DIR, "done.flag")
-    if os.path.exists(done_flag_path):
-        os.remove(done_flag_path)
-    
-    run_sam3d(config_path, IMAGE_PATH, DONE_DIR, OUTPUT_DIR, PROMPT_NAME)
-    
+    print(f"Job {job_id} started")
+    STATS.job_started(job_id)
+    REGISTRY.mark_stage_started(job_id, "sam3d")
+
+    scores = [m["score"] for m in masks_info["masks"]]
+    selection = REGISTRY.get(job_id).get("objects", "first")
+    outputs = REGISTRY.get(job_id).get("outputs", DEFAULT_ARTIFACTS)
+    indices = select_object_indices(selection, scores)
+    FINAL_OUTPUT_DIR = str(STORE.final_output_dir(job_id))
+    try:
+        image, masks, shared = load_inputs(INPUT_DIR, str(STORE.input_dir(job_id) / "job.jpg"), masks_info, indices,
+                                           job_id=job_id)
+    except FileNotFoundError:
+        # neither the handoff nor the mask files are left; segment the image again
+        print(f"! Inputs of job {job_id} are gone, sending it back to SAM3.", color="yellow")
+        STORE.enqueue("sam3", job_id, priority=REGISTRY.get(job_id).get("priority", DEFAULT_PRIORITY))
+        STORE.complete("sam3d", job_id)
+        STATS.job_finished(job_id)
+        release_job_slot()
+        continue
+    except Exception as e:
+        fail_job(job_id, e)
+        continue
+    try:
+        objects = run_sam3d(INFERENCE, image, masks, FINAL_OUTPUT_DIR, OUTPUT_DIR, PROMPT_NAME,
+                            indices, indexed_names=selection != "first", outputs=outputs, job_id=job_id)
+    except Exception as e:
+        # the submit of an export raises once the pool is broken
+        exit_if_pool_broken(e)
+        # e.g. CUDA out of memory on a large object; the next job gets a fresh try
+        torch.cuda.empty_cache()
+        fail_job(job_id, e)
+        continue
+    finally:
+        del image, masks
+        if shared is not None:
+            shared.release()
+
     elapsed_time = time.time() - start_time
-    print(f"Job finished! ({elapsed_time:.2f})s")
-    
-    open(os.path.join(OUTPUT_DIR, "done.flag"), "a").close()
-    
-    # Remove all files in the input folder
-    for f in os.listdir(INPUT_DIR):
-        file_path = os.path.join(INPUT_DIR, f)
-        if os.path.isfile(file_path):
-            os.remove(file_path)
+    print(f"Job {job_id} finished on the GPU! ({elapsed_time:.2f})s, exports continue in the background")
+    TRACER.record("sam3d.gpu", start_time, elapsed_time, job_id=job_id, objects=len(indices))
+    STATS.set_extra(gpu_max_memory_bytes=gpu_max_memory_bytes())
+    STATS.job_finished(job_id)
+    REGISTRY.mark_stage(job_id, "sam3d")
+    for obj in objects:
+        for future in obj["futures"]:
+            future.add_done_callback(functools.partial(register_artifacts, job_id))
+
+    threading.Thread(
+        target=finalize_job,
+        args=(job_id, objects, selection, scores, start_time),
+        daemon=True,
+    ).start()
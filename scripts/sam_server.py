@@ -1,49 +1,112 @@
-from fastapi import FastAPI, UploadFile, Form, HTTPException
+from fastapi import FastAPI, UploadFile, Form, HTTPException, Request, Query
 from pathlib import Path
+import asyncio
+import hashlib
+import json
+import math
 import uuid
 import shutil
 import subprocess
 import time
 import threading
 import os
-from fastapi.responses import FileResponse
-from collections import defaultdict
+from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from fastapi.responses import StreamingResponse, PlainTextResponse, JSONResponse
 
 from scripts.utils import ColorPrint
+from scripts.job_store import (
+    JobStore, STAGES, QUEUE_CONSUMERS, PRIORITIES, DEFAULT_PRIORITY, parse_object_selection, parse_collision_lods,
+    parse_artifact_selection, deferred_artifact, DEFAULT_ARTIFACTS,
+)
+from scripts.job_registry import JobRegistry
+from scripts.stage_stats import summarize_stages, read_worker_stats
+from scripts.replicas import live_replicas, replica_summary, wait_for_replicas, read_supervisor_status
+from scripts.notify import make_waiter
+from scripts.shm_transport import unlink_segments
+from scripts.cache import ArtifactStore, RESULT_CACHE_DIR, RESULT_CACHE_MAX_BYTES, content_key
+from scripts.tracing import Tracer, SpanCollector, MetricsText
+from scripts.archive import JobArchive
+from scripts.downloads import file_response, bundle_response, BUNDLE_FORMATS
+from scripts.image_io import sniff_image_type
 print = ColorPrint(worker_name="SAM_SERVER", default_color="magenta")
 
-READY_DIR = Path("worker_data/workers_ready")
-JOBS = Path("worker_data")
-JOBS.mkdir(exist_ok=True)
-old_job_id = None
-
-# Track downloaded files for each job
-job_download_tracker = defaultdict(set)
-
-def delete_worker_data():
-    worker_data_dir = "worker_data"
-    if os.path.exists(worker_data_dir):
-        for folder in os.listdir(worker_data_dir):
-            folder_path = os.path.join(worker_data_dir, folder)
-            if os.path.isdir(folder_path):
-                print(f"Deleting folder: {folder_path}")
-                shutil.rmtree(folder_path)
-    else:
-        print(f"Folder not found: {worker_data_dir}")
+STORE = JobStore()
+STORE.root.mkdir(parents=True, exist_ok=True)
+
+# replicas per stage and stub workers (sleep instead of running models), passed on to start_workers.py
+REPLICAS = {
+    "sam3": int(os.environ.get("SAM3_REPLICAS", "1")),
+    "sam3d": int(os.environ.get("SAM3D_REPLICAS", "1")),
+}
+STUB_WORKERS = os.environ.get("SAM_STUB_WORKERS", "0") == "1"
+
+# Finished results keyed by (image, prompt, pipeline config). Jobs run with a
+# fixed seed, so an identical submission can be answered from the store.
+RESULT_STORE = ArtifactStore(RESULT_CACHE_DIR, max_bytes=RESULT_CACHE_MAX_BYTES)
+SAM3D_CONFIG_PATH = Path("/home/ferdinand/sam_project/sam-3d-objects/checkpoints/hf/pipeline.yaml")
+# bump whenever the workers change what they produce for the same input
+PIPELINE_VERSION = "1"
+
+def pipeline_fingerprint():
+    config = SAM3D_CONFIG_PATH.read_bytes() if SAM3D_CONFIG_PATH.exists() else b""
+    # placeholder results of stub workers must never answer real submissions
+    return content_key(PIPELINE_VERSION, config, "stub" if STUB_WORKERS else "")
+
+PIPELINE_FINGERPRINT = pipeline_fingerprint()
+
+def reset_worker_data():
+    # Job workspaces, queues and the registry survive a restart. Only the state
+    # of the previous worker processes is cleared, and jobs they had claimed
+    # go back into their queues.
+    for folder in ["workers_ready", "stats", "traces"]:
+        folder_path = STORE.root / folder
+        if folder_path.exists():
+            print(f"Deleting folder: {folder_path}")
+            shutil.rmtree(folder_path)
+    for stage in (*STAGES, *QUEUE_CONSUMERS):
+        requeued = STORE.requeue_active(stage)
+        if requeued:
+            print(f"Re-queued {len(requeued)} interrupted {stage} job(s): {requeued}")
+
+reset_worker_data()
+
+# state, stages, artifact manifest and download progress of every job
+REGISTRY = JobRegistry(STORE.registry_path())
+
+# timing spans of the server; /metrics folds in those of all workers
+TRACER = Tracer(STORE.root, "server")
+SPANS = SpanCollector(STORE.root)
 
-delete_worker_data()
+# finished workspaces end up in worker_data_finished/, next to worker_data/
+ARCHIVE = JobArchive(STORE.root.parent / "worker_data_finished")
+# finished jobs that nobody downloaded (or only partly) are archived after this
+# long without a download or any other change, so their workspaces don't pile up
+UNRETRIEVED_TTL_S = float(os.environ.get("SAM_UNRETRIEVED_TTL_HOURS", "24")) * 3600
+# one thread, so a job is never archived twice concurrently
+ARCHIVE_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix="archive")
 
 app = FastAPI()
 
 def launch_workers():
-    global workers_ready
     print("Launching worker processes...")
-    subprocess.Popen(["python3", "scripts/start_workers.py"])
-    while not all((READY_DIR / f).exists() for f in ["sam3_worker.ready", "sam_3d_worker.ready"]):
-        print("Waiting for workers to be ready...")
-        time.sleep(2.0)
+    # the supervisor keeps the workers running (and stops them when the server exits)
+    cmd = ["python3", "scripts/start_workers.py", "--sam3", str(REPLICAS["sam3"]), "--sam3d", str(REPLICAS["sam3d"]),
+           "--exit-with-parent"]
+    if STUB_WORKERS:
+        cmd.append("--stub")
+    subprocess.Popen(cmd)
+    wait_for_replicas(
+        STORE.root,
+        REPLICAS,
+        on_wait=lambda missing: print(f"Waiting for workers to be ready: {missing}"),
+    )
     print("All workers are ready!")
 
+def workers_ready():
+    # at least one live replica per stage
+    return all(live_replicas(STORE.root, stage) for stage in STAGES)
+
 @app.on_event("startup")
 def startup():
     print("Starting up FastAPI server...")
@@ -51,117 +114,558 @@ def startup():
 
 @app.get("/ready")
 def ready():
-    ready = all(
-        (READY_DIR / f).exists()
-        for f in ["sam3_worker.ready", "sam_3d_worker.ready"]
-    )
+    ready = workers_ready()
     print(f"Ready check: {ready}")
     return {"ready": ready}
 
 
-def archive_and_clear_worker_data(prompt_name):
-    worker_data_dir = Path("worker_data")
-    archive_dir = Path(f"worker_data_finished/worker_data_{prompt_name}")
-
-    if worker_data_dir.exists():
-        # Create the archive directory
-        archive_dir.mkdir(parents=True, exist_ok=True)
-        
-        # Copy worker_data to the archive directory
-        shutil.copytree(worker_data_dir, archive_dir, dirs_exist_ok=True)
-        print(f"Archived worker data to {archive_dir}")
-
-        # Clear the worker_data directory
-        for folder in worker_data_dir.iterdir():
-            if folder.is_dir():
-                shutil.rmtree(folder)
-            else:
-                folder.unlink()
-        
-        READY_DIR = Path("worker_data/workers_ready")
-        READY_DIR.mkdir(exist_ok=True)
-        
-        print("Cleared worker_data directory.")
-        
+@TRACER.traced("server.archive")
+def archive_job(job_id):
+    job_dir = STORE.job_dir(job_id)
+
+    if job_dir.exists():
+        # free a shared-memory handoff that never reached SAM-3D
+        masks_json = STORE.masks_dir(job_id) / "masks.json"
+        if masks_json.exists():
+            unlink_segments(json.loads(masks_json.read_text()).get("handoff") or {})
+
+        # move (not copy) the workspace into the archive
+        entry = ARCHIVE.add(job_id, job_dir)
+        print(f"Archived job {job_id} to {entry}")
+
     else:
-        print("worker_data directory does not exist.")
+        print(f"Workspace of job {job_id} does not exist.")
+    REGISTRY.set_state(job_id, "archived")
 
-@app.post("/submit")
-async def submit(image: UploadFile, prompt: str = Form(...)):
-    if not all(
-        (READY_DIR / f).exists()
-        for f in ["sam3_worker.ready", "sam_3d_worker.ready"]
-    ):
+def abandoned_jobs():
+    # a pending render or collision request means someone is still waiting for files
+    abandoned = []
+    for job_id in REGISTRY.jobs_idle_since(("done", "no_masks_detected"), time.time() - UNRETRIEVED_TTL_S):
+        job = REGISTRY.get(job_id)
+        if not job.get("render_requests") and not job.get("collision_requests"):
+            abandoned.append(job_id)
+    return abandoned
+
+def archive_finished_jobs():
+    # archive jobs whose files have all been downloaded, jobs that expired or failed,
+    # and finished jobs that have not been retrieved within UNRETRIEVED_TTL_S
+    try:
+        for job_id in (REGISTRY.jobs_in_state("retrieved") + REGISTRY.jobs_in_state("expired")
+                       + REGISTRY.jobs_in_state("failed")):
+            archive_job(job_id, job_id=job_id)
+        for job_id in abandoned_jobs():
+            print(f"Job {job_id} has not been retrieved within {UNRETRIEVED_TTL_S / 3600:g}h.", color="yellow")
+            archive_job(job_id, job_id=job_id)
+        removed = ARCHIVE.enforce_retention()
+        if removed:
+            print(f"Removed {len(removed)} archived job(s) past the retention limits.")
+    except Exception as e:
+        print(f"! Archiving failed: {e!r}", color="red")
+
+# admission control: jobs waiting in the stage queues before /submit answers 429
+MAX_QUEUED_JOBS = int(os.environ.get("SAM_MAX_QUEUED_JOBS", "32"))
+# Retry-After when no service time has been measured yet
+DEFAULT_RETRY_AFTER_S = 10
+MAX_RETRY_AFTER_S = 600
+
+def queued_jobs():
+    return sum(STORE.queue_depth(stage) for stage in STAGES)
+
+def retry_after_s(backlog):
+    """Seconds until the backlog has drained below the limit, from the measured service times."""
+    summary = summarize_stages(STORE.root, STAGES)["stages"]
+    # jobs per second the slowest stage gets through with its live replicas
+    rates = [
+        len(live_replicas(STORE.root, stage)) / stats["mean_service_s"]
+        for stage, stats in summary.items() if stats["mean_service_s"]
+    ]
+    rate = min(rates, default=0.0)
+    if rate <= 0:
+        return DEFAULT_RETRY_AFTER_S
+    excess = backlog - MAX_QUEUED_JOBS + 1
+    return max(1, min(MAX_RETRY_AFTER_S, math.ceil(excess / rate)))
+
+# uploads beyond this are rejected with 413
+MAX_UPLOAD_BYTES = int(float(os.environ.get("SAM_MAX_UPLOAD_MB", "50")) * 1024**2)
+UPLOAD_CHUNK_BYTES = 1 << 20
+# room for the other form fields and the multipart framing
+MAX_FORM_OVERHEAD_BYTES = 64 * 1024
+# images per /submit_batch request
+MAX_BATCH_IMAGES = int(os.environ.get("SAM_MAX_BATCH_IMAGES", "16"))
+# largest request body accepted per endpoint
+MAX_REQUEST_BYTES = {
+    "/submit": MAX_UPLOAD_BYTES + MAX_FORM_OVERHEAD_BYTES,
+    "/submit_batch": MAX_BATCH_IMAGES * (MAX_UPLOAD_BYTES + MAX_FORM_OVERHEAD_BYTES),
+}
+
+def too_large():
+    return HTTPException(413, f"Image larger than {MAX_UPLOAD_BYTES // 1024**2} MB")
+
+@app.middleware("http")
+async def limit_upload_size(request: Request, call_next):
+    # refuse oversized submissions from Content-Length before the body is received
+    limit = MAX_REQUEST_BYTES.get(request.url.path)
+    if request.method == "POST" and limit is not None:
+        try:
+            length = int(request.headers.get("content-length", "0"))
+        except ValueError:
+            length = 0
+        if length > limit:
+            print(f"Rejecting a {length} byte submission.")
+            return JSONResponse({"detail": too_large().detail}, status_code=413)
+    return await call_next(request)
+
+async def save_upload(upload, path):
+    """Stream `upload` to `path` in chunks, off the event loop; returns (sha256, size)."""
+    sha256 = hashlib.sha256()
+    size = 0
+    f = await asyncio.to_thread(open, path, "wb")
+
+    def write(chunk):
+        sha256.update(chunk)
+        f.write(chunk)
+
+    try:
+        while chunk := await upload.read(UPLOAD_CHUNK_BYTES):
+            # check the format before anything else has been written
+            if size == 0 and sniff_image_type(chunk) is None:
+                raise HTTPException(415, "Unsupported image format, upload a JPEG or PNG")
+            size += len(chunk)
+            if size > MAX_UPLOAD_BYTES:
+                raise too_large()
+            await asyncio.to_thread(write, chunk)
+    finally:
+        await asyncio.to_thread(f.close)
+    if size == 0:
+        raise HTTPException(422, "Empty image")
+    return sha256.hexdigest(), size
+
+def validate_submission(objects, artifacts, priority, deadline_s):
+    """Normalized (objects, artifacts, priority); 422 on invalid values."""
+    # which masks to reconstruct: "first", "all", "top:K" or "0,2,5"
+    objects = objects.strip().lower()
+    try:
+        parse_object_selection(objects)
+        # outputs to produce, the others are skipped altogether
+        artifacts = parse_artifact_selection(artifacts)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    # interactive jobs are claimed before normal ones, batch jobs last
+    priority = priority.strip().lower()
+    if priority not in PRIORITIES:
+        raise HTTPException(status_code=422, detail=f"priority must be one of {list(PRIORITIES)}")
+    # queued work is dropped once the deadline (seconds from now) has passed
+    if deadline_s is not None and deadline_s <= 0:
+        raise HTTPException(status_code=422, detail="deadline_s must be positive")
+    return objects, artifacts, priority
+
+def admit(n_jobs):
+    """503 while workers are missing, 429 if `n_jobs` more would exceed the queue limit."""
+    if not workers_ready():
         print("Workers not ready, rejecting job submission.")
         raise HTTPException(503, "Workers not ready")
-    
-    if old_job_id is not None:
-        archive_and_clear_worker_data(old_job_id)
 
+    backlog = queued_jobs()
+    if backlog + n_jobs > MAX_QUEUED_JOBS:
+        retry_after = retry_after_s(backlog + n_jobs - 1)
+        print(f"{backlog} jobs queued, rejecting submission of {n_jobs} (retry after {retry_after}s).")
+        raise HTTPException(429, "Too many queued jobs", headers={"Retry-After": str(retry_after)})
+
+async def receive_job(image, prompt):
+    """Workspace with the uploaded image and prompt of a new job; returns (job_id, image_sha256)."""
     job_id = str(uuid.uuid4())
-    job_dir = JOBS / "sam3_worker/input"
-    job_dir.mkdir(parents=True, exist_ok=True)
+    STORE.create_job(job_id)
+    job_dir = STORE.input_dir(job_id)
     print(f"Received job {job_id}, saving image and prompt...")
 
-    with open(job_dir / "job.jpg", "wb") as f:
-        shutil.copyfileobj(image.file, f)
+    try:
+        with TRACER.span("server.upload_write", job_id=job_id) as span:
+            image_sha256, span["bytes"] = await save_upload(image, job_dir / "job.jpg")
+            await asyncio.to_thread((job_dir / "prompt.txt").write_text, prompt)
+    except HTTPException:
+        await asyncio.to_thread(STORE.remove_job, job_id)
+        raise
+    return job_id, image_sha256
+
+async def lookup_result(job_id, image_sha256, prompt, objects, artifacts):
+    """Materialize the cached result of an identical submission into the job's
+    final_output; returns (cache_key, its status or None on a miss)."""
+    cache_key = content_key(image_sha256, prompt.strip(), objects, ",".join(artifacts), PIPELINE_FINGERPRINT)
+    with TRACER.span("server.cache_lookup", job_id=job_id) as span:
+        cached_status = await asyncio.to_thread(RESULT_STORE.get, cache_key, STORE.final_output_dir(job_id))
+        span["hit"] = cached_status is not None
+    return cache_key, cached_status
 
-    (job_dir / "prompt.txt").write_text(prompt)
-    print(f"Job {job_id} submitted successfully.")
+def start_job(job_id, image_sha256, prompt, objects, artifacts, priority, deadline, cache_key, cached_status):
+    """Register a received job; answered from the result cache if `cached_status`, else queued for SAM3."""
+    REGISTRY.create(
+        job_id, prompt=prompt, objects=objects, outputs=list(artifacts), cache_key=cache_key, priority=priority,
+        deadline=deadline, image_sha256=image_sha256,
+    )
+    if cached_status is not None:
+        files = [f for f in STORE.final_output_dir(job_id).iterdir() if f.is_file()]
+        REGISTRY.add_artifacts(job_id, {f.name: f.stat().st_size for f in files if not f.name.startswith(".")})
+        # GIFs that were never downloaded come with the state to render them from
+        REGISTRY.add_on_demand(job_id, [deferred_artifact(f.name) for f in files if deferred_artifact(f.name)])
+        REGISTRY.update(job_id, cached=True)
+        REGISTRY.set_state(job_id, cached_status)
+        print(f"Job {job_id} answered from the result cache ({cached_status}).")
+        return {"job_id": job_id, "cached": True}
+
+    STORE.enqueue("sam3", job_id, priority=priority)
+    print(f"Job {job_id} submitted successfully ({priority}, {STORE.queue_depth('sam3')} queued for SAM3).")
 
-    return {"job_id": job_id}
+    return {"job_id": job_id, "cached": False}
+
+async def admit_received(job_ids, n_misses):
+    # only submissions that have to be computed count against the workers and the
+    # queue limit, identical ones are answered from the cache even under load
+    try:
+        if n_misses:
+            admit(n_misses)
+    except HTTPException:
+        for job_id in job_ids:
+            await asyncio.to_thread(STORE.remove_job, job_id)
+        raise
+    # archived on the archive thread, the submission doesn't wait for the disk I/O
+    ARCHIVE_POOL.submit(archive_finished_jobs)
+
+@app.post("/submit")
+async def submit(
+    image: UploadFile,
+    prompt: str = Form(...),
+    objects: str = Form("first"),
+    artifacts: str = Form("default"),
+    priority: str = Form(DEFAULT_PRIORITY),
+    deadline_s: Optional[float] = Form(None),
+):
+    objects, artifacts, priority = validate_submission(objects, artifacts, priority, deadline_s)
+
+    job_id, image_sha256 = await receive_job(image, prompt)
+    cache_key, cached_status = await lookup_result(job_id, image_sha256, prompt, objects, artifacts)
+    await admit_received([job_id], 0 if cached_status is not None else 1)
+    deadline = None if deadline_s is None else time.time() + deadline_s
+    return start_job(job_id, image_sha256, prompt, objects, artifacts, priority, deadline, cache_key, cached_status)
+
+@app.post("/submit_batch")
+async def submit_batch(
+    images: List[UploadFile],
+    prompts: List[str] = Form(...),
+    objects: str = Form("first"),
+    artifacts: str = Form("default"),
+    priority: str = Form(DEFAULT_PRIORITY),
+    deadline_s: Optional[float] = Form(None),
+):
+    """Several (image, prompt) pairs at once; one prompt applies to all images"""
+    objects, artifacts, priority = validate_submission(objects, artifacts, priority, deadline_s)
+    if len(images) > MAX_BATCH_IMAGES:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_BATCH_IMAGES} images per batch")
+    if len(prompts) == 1:
+        prompts = prompts * len(images)
+    if len(prompts) != len(images):
+        raise HTTPException(status_code=422, detail="Send one prompt, or one prompt per image")
+
+    # every upload is checked before any job of the batch starts
+    received = []
+    try:
+        for image, prompt in zip(images, prompts):
+            received.append(await receive_job(image, prompt))
+    except HTTPException:
+        for job_id, _ in received:
+            await asyncio.to_thread(STORE.remove_job, job_id)
+        raise
+
+    lookups = [
+        await lookup_result(job_id, image_sha256, prompt, objects, artifacts)
+        for (job_id, image_sha256), prompt in zip(received, prompts)
+    ]
+    await admit_received([job_id for job_id, _ in received],
+                         sum(1 for _, cached_status in lookups if cached_status is None))
+
+    deadline = None if deadline_s is None else time.time() + deadline_s
+    jobs = [
+        start_job(job_id, image_sha256, prompt, objects, artifacts, priority, deadline, cache_key, cached_status)
+        for (job_id, image_sha256), prompt, (cache_key, cached_status) in zip(received, prompts, lookups)
+    ]
+    print(f"Batch of {len(jobs)} job(s) submitted.")
+    return {"jobs": jobs}
+
+# registry states as reported by /status
+PUBLIC_STATUS = {"queued": "processing", "processing": "processing", "retrieved": "done", "archived": "done"}
+
+def get_job(job_id):
+    job = REGISTRY.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+def job_status(job):
+    # an expired or failed job stays so after its workspace has been archived
+    state = next((s for s in ("expired", "failed") if s in job["timestamps"]), job["state"])
+    return {
+        "status": PUBLIC_STATUS.get(state, state),
+        "state": job["state"],
+        "timestamps": job["timestamps"],
+        "stages": [
+            {"stage": stage, "started_at": job.get("started", {}).get(stage), "completed_at": t}
+            for stage, t in sorted(job["stages"].items(), key=lambda s: s[1])
+        ],
+        # files that can already be downloaded, even while the job is running
+        "artifacts": sorted(job["artifacts"]),
+        # rendered when they are first downloaded
+        "on_demand": job.get("on_demand", []),
+        "masks": job["masks"],
+        "priority": job.get("priority", DEFAULT_PRIORITY),
+        "deadline": job.get("deadline"),
+        "outputs": job.get("outputs", list(DEFAULT_ARTIFACTS)),
+        # collision LODs requested through /collision that are still being generated
+        "collision_requests": job.get("collision_requests", []),
+        # why a failed job was given up
+        "error": job.get("error"),
+    }
 
 @app.get("/status/{job_id}")
 def status(job_id: str):
-    out = JOBS / "sam_3d_worker/output"
-    if (out / "done.flag").exists():
-        print(f"Job {job_id} is done.")
-        return {"status": "done"}
-    elif (out / "sam3_nomaskdetected.flag").exists():
-        print(f"Job {job_id} completed with no masks detected.")
-        return {"status": "no_masks_detected"}
-    else:
-        print(f"Job {job_id} is still processing.")
-        return {"status": "processing"}
+    result = job_status(get_job(job_id))
+    print(f"Job {job_id}: {result['state']}, stages {[s['stage'] for s in result['stages']]}, "
+          f"{len(result['artifacts'])} artifact(s)")
+    return result
 
-@app.get("/download/{job_id}/{filename}")
-def download(job_id: str, filename: str):
-    file_path = JOBS / "final_output" / filename
-    if not file_path.exists():
-        raise HTTPException(status_code=404, detail="File not found")  
-    print(f"Download requested for job {job_id}, file {filename}")
+SSE_KEEPALIVE_S = 15.0
+# state changes without a new file are picked up at this interval
+SSE_REFRESH_S = 0.5
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
 
-    # Track the downloaded file
-    job_download_tracker[job_id].add(filename)
+async def job_events(job_id, request):
+    # wakes up whenever an artifact lands in final_output
+    waiter = None
+    seen_stages, seen_artifacts = set(), set()
+    last_sent = time.monotonic()
+    try:
+        while True:
+            result = job_status(get_job(job_id))
+            for stage in result["stages"]:
+                if stage["stage"] not in seen_stages:
+                    seen_stages.add(stage["stage"])
+                    yield sse_event("stage", stage)
+                    last_sent = time.monotonic()
+            for name in result["artifacts"]:
+                if name not in seen_artifacts:
+                    seen_artifacts.add(name)
+                    yield sse_event("artifact", {"name": name, "url": f"/download/{job_id}/{name}"})
+                    last_sent = time.monotonic()
+            if result["status"] != "processing":
+                yield sse_event("status", {"status": result["status"]})
+                return
+            if await request.is_disconnected():
+                return
+            if waiter is None:
+                # only set up for a job that is still running, its workspace exists
+                waiter = make_waiter([STORE.final_output_dir(job_id)])
+            await waiter.wait_async(SSE_REFRESH_S)
+            if time.monotonic() - last_sent >= SSE_KEEPALIVE_S:
+                yield ": keepalive\n\n"
+                last_sent = time.monotonic()
+    finally:
+        if waiter is not None:
+            waiter.close()
 
-    # Check if all files for the job have been downloaded
-    job_output = JOBS / "final_output"
-    all_files = {f.name for f in job_output.iterdir() if f.is_file()}
-    if job_download_tracker[job_id] == all_files:
+@app.get("/events/{job_id}")
+async def events(job_id: str, request: Request):
+    """Server-Sent Events: one event per completed stage and per published artifact"""
+    get_job(job_id)
+    return StreamingResponse(
+        job_events(job_id, request),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.get("/download/{job_id}/masks/{filename}")
+def download_mask(job_id: str, filename: str, request: Request):
+    if filename not in get_job(job_id)["masks"]:
+        raise HTTPException(status_code=404, detail="File not found")
+    print(f"Mask download requested for job {job_id}, file {filename}")
+    response = file_response(request, STORE.masks_dir(job_id) / filename, filename)
+    if response is None:
+        raise HTTPException(status_code=404, detail="File not found")
+    return response
+
+def track_downloads(job_id, filenames):
+    # a finished job whose files have all been downloaded is archived on the next submission
+    if REGISTRY.record_downloads(job_id, filenames):
         print(f"All files for job {job_id} have been downloaded.")
-        old_job_id = job_id
-        # remove the done flag so the job no longer reports as done
-        done_flag = JOBS / "sam_3d_worker/output" / "done.flag"
-        if done_flag.exists():
-            done_flag.unlink()
-            print(f"Removed done.flag for job {job_id}")
 
-        # set module-level old_job_id for later archiving (avoid 'global' after assignment)
-        globals()['old_job_id'] = job_id
+# declared before /download/{job_id}/{filename}, which would match it too
+@app.get("/download/{job_id}/bundle")
+async def download_bundle(job_id: str, files: Optional[str] = None, fmt: str = Query("zip", alias="format")):
+    """All artifacts of a job (or the comma separated `files`) as one zip or tar stream"""
+    job = get_job(job_id)
+    if fmt not in BUNDLE_FORMATS:
+        raise HTTPException(status_code=422, detail=f"format must be one of {list(BUNDLE_FORMATS)}")
+    # on-demand files are only bundled when they are asked for by name
+    names = sorted(job["artifacts"]) if files is None else [n.strip() for n in files.split(",") if n.strip()]
+    unknown = [n for n in names if n not in job["artifacts"] and n not in job.get("on_demand", [])]
+    if unknown or not names:
+        raise HTTPException(status_code=404, detail=f"File(s) not found: {unknown}")
+    # on-demand files are rendered before the stream starts
+    deferred = [n for n in names if n not in job["artifacts"]]
+    if deferred:
+        await asyncio.gather(*(render_on_demand(job, n) for n in deferred))
+    print(f"Bundle download requested for job {job_id}: {len(names)} file(s) as {fmt}")
 
-        # cleanup download tracker for this job
-        job_download_tracker.pop(job_id, None)
+    output_dir = STORE.final_output_dir(job_id)
+    return bundle_response(
+        [(n, output_dir / n) for n in names],
+        name=job_id,
+        fmt=fmt,
+        on_complete=lambda: track_downloads(job_id, names),
+    )
 
-    return FileResponse(path=file_path, filename=filename)
+# a download of an on-demand artifact waits this long for its rendering
+RENDER_WAIT_S = float(os.environ.get("SAM_RENDER_WAIT_S", "120"))
+RENDER_RETRY_AFTER_S = 5
+
+async def render_on_demand(job, filename):
+    """Have a SAM-3D replica render an on-demand artifact and wait until it is published."""
+    job_id = job["job_id"]
+    if job["state"] == "archived" or not STORE.job_exists(job_id):
+        # the state it would be rendered from has been moved to the archive
+        raise HTTPException(status_code=410, detail=f"Job {job_id} has been archived")
+    if not live_replicas(STORE.root, QUEUE_CONSUMERS["render"]):
+        raise HTTPException(503, "Workers not ready", headers={"Retry-After": str(RENDER_RETRY_AFTER_S)})
+    # concurrent downloads of the same file share one render
+    if await asyncio.to_thread(REGISTRY.request_render, job_id, filename):
+        await asyncio.to_thread(STORE.enqueue, "render", job_id, job.get("priority", DEFAULT_PRIORITY),
+                                {"names": [filename]})
+        print(f"Rendering {filename} of job {job_id} on demand.")
+
+    waiter = make_waiter([STORE.final_output_dir(job_id)])
+    deadline = time.monotonic() + RENDER_WAIT_S
+    try:
+        while True:
+            job = get_job(job_id)
+            if filename in job["artifacts"]:
+                return
+            if filename not in job.get("render_requests", []):
+                raise HTTPException(status_code=500, detail=f"Rendering {filename} failed")
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise HTTPException(503, f"{filename} is still being rendered",
+                                    headers={"Retry-After": str(RENDER_RETRY_AFTER_S)})
+            await waiter.wait_async(min(SSE_REFRESH_S, remaining))
+    finally:
+        waiter.close()
+
+@app.get("/download/{job_id}/{filename}")
+async def download(job_id: str, filename: str, request: Request):
+    job = get_job(job_id)
+    if filename not in job["artifacts"]:
+        if filename not in job.get("on_demand", []):
+            raise HTTPException(status_code=404, detail="File not found")
+        # e.g. the turntable GIF: rendered on the first download, a plain file afterwards
+        await render_on_demand(job, filename)
+    print(f"Download requested for job {job_id}, file {filename}")
+
+    # ETag/If-None-Match and Range make repeated and resumed downloads cheap;
+    # the file counts as downloaded once the client has all of it
+    response = await asyncio.to_thread(
+        file_response,
+        request,
+        STORE.final_output_dir(job_id) / filename,
+        filename,
+        on_complete=lambda: track_downloads(job_id, [filename]),
+    )
+    if response is None:
+        raise HTTPException(status_code=404, detail="File not found")
+    return response
+
+@app.post("/collision/{job_id}")
+def request_collision(job_id: str, lods: str = Form(...)):
+    """Generate further collision mesh LODs for a finished job, e.g. lods=multi_hull,voxel_64"""
+    job = get_job(job_id)
+    try:
+        requested = parse_collision_lods(lods)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if job["state"] not in ("done", "retrieved"):
+        raise HTTPException(status_code=409, detail=f"Job {job_id} has no reconstructed meshes ({job['state']})")
+    if "collision" not in job.get("outputs", DEFAULT_ARTIFACTS):
+        raise HTTPException(status_code=409, detail=f"Job {job_id} was submitted without collision meshes")
+    if not live_replicas(STORE.root, QUEUE_CONSUMERS["collision"]):
+        raise HTTPException(503, "Workers not ready")
+
+    pending = REGISTRY.request_collision_lods(job_id, requested)
+    STORE.enqueue("collision", job_id, priority=job.get("priority", DEFAULT_PRIORITY), payload={"lods": requested})
+    print(f"Collision LODs {requested} requested for job {job_id}.")
+    return {"job_id": job_id, "collision_requests": pending}
 
 @app.get("/list/{job_id}")
 def list_files(job_id: str):
-    job_output = JOBS / "final_output"
-    if not job_output.exists():
-        return {"files": []}
-    files = [f.name for f in job_output.iterdir() if f.is_file()]
+    job = get_job(job_id)
+    files = sorted(job["artifacts"])
     print(f"Listing files for job {job_id}: {files}")
-    return {"files": files}
+    # not rendered yet; a download renders them, but they are not needed to retrieve the job
+    return {"files": files, "available_on_demand": job.get("on_demand", [])}
+
+@app.get("/stages")
+def stages():
+    """Occupancy, throughput, queue depth and replicas per pipeline stage"""
+    summary = summarize_stages(STORE.root, STAGES)
+    for stage, stats in summary["stages"].items():
+        stats["queue_depth"] = STORE.queue_depth(stage)
+        stats["workers"] = replica_summary(STORE.root, stage)
+    # restarts and recovery times of crashed or hung replicas
+    summary["supervisor"] = read_supervisor_status(STORE.root)
+    return summary
+
+@app.get("/cache")
+def cache_stats():
+    return {"results": RESULT_STORE.stats(), "archive": ARCHIVE.stats()}
+
+@app.get("/metrics")
+def metrics():
+    """Prometheus text exposition of span durations, queues, caches and workers"""
+    m = MetricsText()
+    for (component, name), histogram in sorted(SPANS.collect().items(), key=lambda kv: (str(kv[0][0]), kv[0][1])):
+        m.add("sam_span_duration_seconds", "histogram", "Duration of traced pipeline spans.",
+              histogram, {"component": component, "span": name})
+
+    summary = summarize_stages(STORE.root, STAGES)["stages"]
+    for stage in STAGES:
+        labels = {"stage": stage}
+        m.add("sam_queue_depth", "gauge", "Jobs waiting in the stage queue.", STORE.queue_depth(stage), labels)
+        m.add("sam_stage_live_replicas", "gauge", "Replicas with a recent heartbeat.",
+              len(live_replicas(STORE.root, stage)), labels)
+        m.add("sam_stage_occupancy", "gauge", "Busy fraction of the stage replicas over the stats window.",
+              summary[stage]["occupancy"], labels)
+        m.add("sam_stage_jobs_completed_total", "counter", "Jobs finished by the stage since its workers started.",
+              summary[stage]["jobs_completed"], labels)
+        for w in read_worker_stats(STORE.root, stage):
+            extra = w.get("extra", {})
+            worker = {"stage": stage, "worker_id": w["worker_id"]}
+            m.add("sam_gpu_memory_high_water_bytes", "gauge", "Peak CUDA memory allocated by the worker.",
+                  extra.get("gpu_max_memory_bytes"), worker)
+            embeddings = extra.get("embedding_cache")
+            if embeddings:
+                m.add("sam_embedding_cache_hits_total", "counter", "Image embedding cache hits.", embeddings["hits"], worker)
+                m.add("sam_embedding_cache_misses_total", "counter", "Image embedding cache misses.", embeddings["misses"], worker)
+                m.add("sam_embedding_cache_hit_ratio", "gauge", "Image embedding cache hit ratio.", embeddings["hit_rate"], worker)
+
+    supervisor = read_supervisor_status(STORE.root) or {}
+    for w in supervisor.get("workers", []):
+        m.add("sam_worker_restarts_total", "counter", "Restarts of the replica by the supervisor.",
+              w["restarts"], {"stage": w["stage"], "worker_id": w["worker_id"]})
+    for state, count in sorted(REGISTRY.count_by_state().items()):
+        m.add("sam_jobs", "gauge", "Jobs in the registry by state.", count, {"state": state})
+
+    results = RESULT_STORE.stats()
+    m.add("sam_result_cache_hits_total", "counter", "Submissions answered from the result cache.", results["hits"])
+    m.add("sam_result_cache_misses_total", "counter", "Submissions not found in the result cache.", results["misses"])
+    m.add("sam_result_cache_hit_ratio", "gauge", "Result cache hit ratio.", results["hit_rate"])
+    m.add("sam_result_cache_bytes", "gauge", "Size of the result cache.", results["bytes"])
+    return PlainTextResponse(m.render(), media_type="text/plain; version=0.0.4")
 
 @app.get("/health")
 def health():
@@ -0,0 +1,77 @@
+# scripts/shm_transport.py
+#
+# Zero-copy handoff of NumPy arrays between the worker processes.
+#
+# The producer copies each array once into a POSIX shared-memory segment and
+# writes a small JSON descriptor (segment name, shape, dtype) next to the job.
+# The consumer maps the segments straight into NumPy arrays without decoding
+# anything, and unlinks them when it is done. Ownership moves to the consumer,
+# so neither side's multiprocessing resource tracker may unlink the segments.
+# NumPy is imported lazily: the server only frees leftover segments.
+
+import uuid
+from multiprocessing import resource_tracker, shared_memory
+
+
+def _untrack(shm):
+    # the segment outlives this process; ownership is handled explicitly
+    try:
+        resource_tracker.unregister(shm._name, "shared_memory")
+    except Exception:
+        pass
+
+
+def export_arrays(arrays, prefix="sam"):
+    """Copy `arrays` (name -> ndarray) into shared memory, returns the descriptor."""
+    import numpy as np
+    descriptor = {}
+    for name, arr in arrays.items():
+        shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1), name=f"{prefix}_{name}_{uuid.uuid4().hex[:12]}")
+        _untrack(shm)
+        np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+        descriptor[name] = {"shm": shm.name, "shape": list(arr.shape), "dtype": arr.dtype.str}
+        shm.close()
+    return descriptor
+
+
+class SharedArrays:
+    """Arrays mapped from a descriptor; release() unmaps and unlinks the segments."""
+
+    def __init__(self, descriptor):
+        import numpy as np
+        self._segments = []
+        self.arrays = {}
+        for name, spec in descriptor.items():
+            shm = shared_memory.SharedMemory(name=spec["shm"])
+            _untrack(shm)
+            self._segments.append(shm)
+            self.arrays[name] = np.ndarray(tuple(spec["shape"]), dtype=np.dtype(spec["dtype"]), buffer=shm.buf)
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def release(self):
+        self.arrays.clear()
+        for shm in self._segments:
+            try:
+                shm.close()
+            except BufferError:
+                # a view is still alive somewhere; the mapping goes away with it
+                pass
+            try:
+                shm.unlink()
+            except FileNotFoundError:
+                pass
+        self._segments = []
+
+
+def unlink_segments(descriptor):
+    """Free the segments of a handoff that will never be consumed."""
+    for spec in descriptor.values():
+        try:
+            shm = shared_memory.SharedMemory(name=spec["shm"])
+        except FileNotFoundError:
+            continue
+        _untrack(shm)
+        shm.close()
+        shm.unlink()
@@ -0,0 +1,229 @@
+# scripts/splat_io.py
+#
+# Compact export of the SAM-3D gaussian splats.
+#
+# The full PLY stores 17 float32 per gaussian (position, normal, SH DC,
+# opacity, scale, rotation) plus the higher SH bands. The compressed layout
+# below is the one SuperSplat and the PlayCanvas engine load as
+# `*.compressed.ply`: gaussians are sorted along a Morton curve and split into
+# chunks of 256, each chunk stores the bounds of its positions, scales and
+# colors as float32, and every gaussian is packed into four uint32
+#   - position: 11/10/11 bits, relative to the chunk bounds
+#   - rotation: smallest three components, 2 bit index + 3 x 10 bits
+#   - scale:    log scale, 11/10/11 bits, relative to the chunk bounds
+#   - color:    SH DC color 3 x 8 bits relative to the chunk bounds, opacity 8 bits
+# with the higher SH bands as one byte per coefficient. That is 16 bytes per
+# gaussian instead of 68 for degree 0, and the packing is a handful of
+# vectorized numpy passes.
+#
+# Inputs follow the conventions of the 3DGS PLY: SH coefficients channel-major
+# (all red coefficients first), opacity as a logit, log scales and (w, x, y, z)
+# quaternions.
+
+import numpy as np
+
+CHUNK_SIZE = 256
+SH_C0 = 0.28209479177387814
+# log scales are clamped to this range before quantization
+LOG_SCALE_RANGE = (-20.0, 20.0)
+
+CHUNK_PROPERTIES = [
+    "min_x", "min_y", "min_z", "max_x", "max_y", "max_z",
+    "min_scale_x", "min_scale_y", "min_scale_z", "max_scale_x", "max_scale_y", "max_scale_z",
+    "min_r", "min_g", "min_b", "max_r", "max_g", "max_b",
+]
+VERTEX_PROPERTIES = ["packed_position", "packed_rotation", "packed_scale", "packed_color"]
+
+
+def matrix_to_quaternion(m):
+    """(w, x, y, z) of a 3x3 rotation matrix."""
+    m = np.asarray(m, dtype=np.float64)
+    trace = np.trace(m)
+    if trace > 0:
+        s = 2.0 * np.sqrt(trace + 1.0)
+        q = [0.25 * s, (m[2, 1] - m[1, 2]) / s, (m[0, 2] - m[2, 0]) / s, (m[1, 0] - m[0, 1]) / s]
+    else:
+        i = int(np.argmax(np.diag(m)))
+        j, k = (i + 1) % 3, (i + 2) % 3
+        s = 2.0 * np.sqrt(1.0 + m[i, i] - m[j, j] - m[k, k])
+        q = [0.0] * 4
+        q[0] = (m[k, j] - m[j, k]) / s
+        q[1 + i] = 0.25 * s
+        q[1 + j] = (m[j, i] + m[i, j]) / s
+        q[1 + k] = (m[k, i] + m[i, k]) / s
+    return np.array(q)
+
+
+def quaternion_multiply(a, b):
+    """Hamilton product of (w, x, y, z) quaternions, broadcasting over leading axes."""
+    aw, ax, ay, az = np.moveaxis(np.asarray(a), -1, 0)
+    bw, bx, by, bz = np.moveaxis(np.asarray(b), -1, 0)
+    return np.stack([
+        aw * bw - ax * bx - ay * by - az * bz,
+        aw * bx + ax * bw + ay * bz - az * by,
+        aw * by - ax * bz + ay * bw + az * bx,
+        aw * bz + ax * by - ay * bx + az * bw,
+    ], axis=-1)
+
+
+def transform_gaussians(xyz, rotation, matrix):
+    """Rotate positions and orientations by the 3x3 rotation `matrix`."""
+    matrix = np.asarray(matrix, dtype=np.float64)
+    xyz = (xyz @ matrix.T).astype(np.float32)
+    rotation = quaternion_multiply(matrix_to_quaternion(matrix), rotation).astype(np.float32)
+    return xyz, rotation
+
+
+def _spread_bits(v):
+    # 10-bit integers -> every third bit of a 30-bit integer
+    v = v.astype(np.uint32) & 0x3FF
+    v = (v | (v << 16)) & 0x030000FF
+    v = (v | (v << 8)) & 0x0300F00F
+    v = (v | (v << 4)) & 0x030C30C3
+    v = (v | (v << 2)) & 0x09249249
+    return v
+
+
+def morton_order(xyz):
+    """Permutation sorting the points along a Morton (Z-order) curve."""
+    lo = xyz.min(axis=0)
+    extent = np.maximum(xyz.max(axis=0) - lo, 1e-12)
+    cells = np.clip((xyz - lo) / extent * 1023, 0, 1023).astype(np.uint32)
+    codes = (_spread_bits(cells[:, 0]) << 2) | (_spread_bits(cells[:, 1]) << 1) | _spread_bits(cells[:, 2])
+    return np.argsort(codes, kind="stable")
+
+
+def _chunk_bounds(values):
+    # per-chunk min and max of (N, C) values; the last chunk may be partial
+    n = len(values)
+    padded = np.concatenate([values, np.repeat(values[-1:], -n % CHUNK_SIZE, axis=0)])
+    chunks = padded.reshape(-1, CHUNK_SIZE, values.shape[1])
+    return chunks.min(axis=1), chunks.max(axis=1)
+
+
+def _normalize(values, lo, hi):
+    # values relative to the bounds of their chunk, in [0, 1]
+    chunk = np.arange(len(values)) // CHUNK_SIZE
+    lo, hi = lo[chunk], hi[chunk]
+    span = np.where(hi > lo, hi - lo, 1.0)
+    return np.clip((values - lo) / span, 0.0, 1.0)
+
+
+def _unorm(values, bits):
+    top = (1 << bits) - 1
+    return np.round(values * top).astype(np.uint32)
+
+
+def _pack_111011(v):
+    return (_unorm(v[:, 0], 11) << 21) | (_unorm(v[:, 1], 10) << 11) | _unorm(v[:, 2], 11)
+
+
+def _pack_rotation(rotation):
+    q = rotation / np.maximum(np.linalg.norm(rotation, axis=1, keepdims=True), 1e-12)
+    largest = np.abs(q).argmax(axis=1)
+    # q and -q are the same rotation; make the dropped component positive
+    q *= np.where(q[np.arange(len(q)), largest] < 0, -1.0, 1.0)[:, None]
+    others = np.array([[1, 2, 3], [0, 2, 3], [0, 1, 3], [0, 1, 2]])[largest]
+    rest = np.clip(np.take_along_axis(q, others, axis=1) * (np.sqrt(2) * 0.5) + 0.5, 0.0, 1.0)
+    return ((largest.astype(np.uint32) << 30) | (_unorm(rest[:, 0], 10) << 20)
+            | (_unorm(rest[:, 1], 10) << 10) | _unorm(rest[:, 2], 10))
+
+
+def write_compressed_ply(path, xyz, f_dc, opacity, scale, rotation, f_rest=None):
+    """Write gaussians in the chunked, quantized PLY layout; returns the file size.
+
+    xyz (N, 3), f_dc (N, 3), opacity (N,) logits, scale (N, 3) log scales,
+    rotation (N, 4) and optionally f_rest (N, 3 * K) for the higher SH bands.
+    """
+    n = len(xyz)
+    if n == 0:
+        raise ValueError("No gaussians to export")
+    order = morton_order(np.asarray(xyz, dtype=np.float32))
+    xyz = np.asarray(xyz, dtype=np.float32)[order]
+    color = np.asarray(f_dc, dtype=np.float32)[order] * SH_C0 + 0.5
+    alpha = 1.0 / (1.0 + np.exp(-np.asarray(opacity, dtype=np.float32).reshape(-1)[order]))
+    scale = np.clip(np.asarray(scale, dtype=np.float32)[order], *LOG_SCALE_RANGE)
+    rotation = np.asarray(rotation, dtype=np.float32)[order]
+
+    xyz_lo, xyz_hi = _chunk_bounds(xyz)
+    scale_lo, scale_hi = _chunk_bounds(scale)
+    color_lo, color_hi = _chunk_bounds(color)
+    chunks = np.concatenate([xyz_lo, xyz_hi, scale_lo, scale_hi, color_lo, color_hi], axis=1).astype("<f4")
+
+    packed_color = _unorm(_normalize(color, color_lo, color_hi), 8)
+    vertices = np.stack([
+        _pack_111011(_normalize(xyz, xyz_lo, xyz_hi)),
+        _pack_rotation(rotation),
+        _pack_111011(_normalize(scale, scale_lo, scale_hi)),
+        (packed_color[:, 0] << 24) | (packed_color[:, 1] << 16) | (packed_color[:, 2] << 8) | _unorm(alpha, 8),
+    ], axis=1).astype("<u4")
+
+    header = ["ply", "format binary_little_endian 1.0", f"element chunk {len(chunks)}"]
+    header += [f"property float {p}" for p in CHUNK_PROPERTIES]
+    header += [f"element vertex {n}"] + [f"property uint {p}" for p in VERTEX_PROPERTIES]
+    sh = None
+    if f_rest is not None and np.asarray(f_rest).shape[1]:
+        f_rest = np.asarray(f_rest, dtype=np.float32)[order]
+        sh = np.clip(np.floor((f_rest / 8 + 0.5) * 256), 0, 255).astype(np.uint8)
+        header += [f"element sh {n}"] + [f"property uchar f_rest_{i}" for i in range(sh.shape[1])]
+    header.append("end_header")
+
+    with open(path, "wb") as f:
+        f.write(("\n".join(header) + "\n").encode("ascii"))
+        f.write(chunks.tobytes())
+        f.write(vertices.tobytes())
+        if sh is not None:
+            f.write(sh.tobytes())
+        return f.tell()
+
+
+def _unpack_111011(packed, lo, hi):
+    v = np.stack([(packed >> 21) & 0x7FF, (packed >> 11) & 0x3FF, packed & 0x7FF], axis=1)
+    v = v / np.array([2047.0, 1023.0, 2047.0])
+    return lo + v * (hi - lo)
+
+
+def read_compressed_ply(path):
+    """Decode a file written by write_compressed_ply() back into float arrays
+    (positions in Morton order), e.g. to check the quantization error."""
+    with open(path, "rb") as f:
+        counts, sh_count = {}, 0
+        while (line := f.readline().decode("ascii").strip()) != "end_header":
+            if line.startswith("element"):
+                _, name, count = line.split()
+                counts[name] = int(count)
+            elif line.startswith("property uchar f_rest_"):
+                sh_count += 1
+        chunks = np.frombuffer(f.read(counts["chunk"] * len(CHUNK_PROPERTIES) * 4), dtype="<f4").reshape(-1, 18)
+        n = counts["vertex"]
+        vertices = np.frombuffer(f.read(n * 16), dtype="<u4").reshape(n, 4)
+        sh = np.frombuffer(f.read(n * sh_count), dtype=np.uint8).reshape(n, sh_count) if sh_count else None
+
+    chunk = np.arange(n) // CHUNK_SIZE
+    c = chunks[chunk]
+    xyz = _unpack_111011(vertices[:, 0], c[:, 0:3], c[:, 3:6])
+    scale = _unpack_111011(vertices[:, 2], c[:, 6:9], c[:, 9:12])
+
+    packed = vertices[:, 1]
+    rest = np.stack([(packed >> 20) & 0x3FF, (packed >> 10) & 0x3FF, packed & 0x3FF], axis=1) / 1023.0
+    rest = (rest - 0.5) / (np.sqrt(2) * 0.5)
+    largest = packed >> 30
+    rotation = np.zeros((n, 4))
+    others = np.array([[1, 2, 3], [0, 2, 3], [0, 1, 3], [0, 1, 2]])[largest]
+    np.put_along_axis(rotation, others, rest, axis=1)
+    rotation[np.arange(n), largest] = np.sqrt(np.clip(1.0 - (rest ** 2).sum(axis=1), 0.0, 1.0))
+
+    packed = vertices[:, 3]
+    rgba = np.stack([(packed >> 24) & 0xFF, (packed >> 16) & 0xFF, (packed >> 8) & 0xFF, packed & 0xFF], axis=1) / 255.0
+    color = c[:, 12:15] + rgba[:, :3] * (c[:, 15:18] - c[:, 12:15])
+    alpha = np.clip(rgba[:, 3], 1e-6, 1 - 1e-6)
+    result = {
+        "xyz": xyz,
+        "f_dc": (color - 0.5) / SH_C0,
+        "opacity": np.log(alpha / (1.0 - alpha)),
+        "scale": scale,
+        "rotation": rotation,
+    }
+    if sh is not None:
+        result["f_rest"] = ((sh.astype(np.float32) + 0.5) / 256 - 0.5) * 8
+    return result
@@ -0,0 +1,132 @@
+# scripts/stage_stats.py
+#
+# Per-stage occupancy and throughput bookkeeping.
+#
+# Every worker keeps a StageStats object and rewrites
+# worker_data/stats/<stage>/<worker_id>.json whenever a job starts or finishes.
+# The server aggregates these files (summarize_stages) to show which stage of
+# the pipeline is the bottleneck.
+
+import json
+import os
+import time
+from collections import deque
+from pathlib import Path
+
+# time window used for occupancy and throughput
+STATS_WINDOW_S = 300.0
+
+
+class StageStats:
+    def __init__(self, root, stage, worker_id="0", max_recent=256):
+        self.path = Path(root) / "stats" / stage / f"{worker_id}.json"
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.stage = stage
+        self.worker_id = worker_id
+        self.started_at = time.time()
+        self.jobs_completed = 0
+        self.busy_seconds = 0.0
+        self.blocked_seconds = 0.0
+        self.recent = deque(maxlen=max_recent)  # (start, end) of finished jobs
+        self.current = None  # (job_id, start)
+        self.extra = {}
+        self.write()
+
+    def job_started(self, job_id):
+        self.current = (job_id, time.time())
+        self.write()
+
+    def job_finished(self, job_id, batch_size=1):
+        # a batch of jobs processed together counts as `batch_size` back-to-back
+        # jobs, so throughput and mean service time stay per job
+        if self.current is None:
+            return
+        _, start = self.current
+        end = time.time()
+        self.current = None
+        self.jobs_completed += batch_size
+        self.busy_seconds += end - start
+        step = (end - start) / batch_size
+        self.recent.extend((start + i * step, start + (i + 1) * step) for i in range(batch_size))
+        self.write()
+
+    def add_blocked(self, seconds):
+        # time spent waiting for room in the downstream buffer
+        self.blocked_seconds += seconds
+        self.write()
+
+    def set_extra(self, **fields):
+        # free-form counters (cache hit rates, ...) published with the stats
+        self.extra.update(fields)
+
+    def write(self):
+        data = {
+            "stage": self.stage,
+            "worker_id": self.worker_id,
+            "pid": os.getpid(),
+            "started_at": self.started_at,
+            "updated_at": time.time(),
+            "jobs_completed": self.jobs_completed,
+            "busy_seconds": self.busy_seconds,
+            "blocked_seconds": self.blocked_seconds,
+            "current": None if self.current is None else {"job_id": self.current[0], "since": self.current[1]},
+            "recent": list(self.recent),
+            "extra": self.extra,
+        }
+        tmp_path = self.path.with_suffix(".json.tmp")
+        tmp_path.write_text(json.dumps(data))
+        os.replace(tmp_path, self.path)
+
+
+def read_worker_stats(root, stage):
+    stats_dir = Path(root) / "stats" / stage
+    workers = []
+    if not stats_dir.exists():
+        return workers
+    for f in sorted(stats_dir.glob("*.json")):
+        try:
+            workers.append(json.loads(f.read_text()))
+        except (OSError, ValueError):
+            # being replaced right now
+            continue
+    return workers
+
+
+def summarize_stage(workers, window=STATS_WINDOW_S, now=None):
+    now = now or time.time()
+    window_start = now - window
+    busy = 0.0
+    completed_in_window = 0
+    durations = []
+    for w in workers:
+        intervals = [tuple(i) for i in w.get("recent", [])]
+        if w.get("current"):
+            intervals.append((w["current"]["since"], now))
+        for start, end in intervals:
+            busy += max(0.0, min(end, now) - max(start, window_start))
+        for start, end in w.get("recent", []):
+            durations.append(end - start)
+            if end >= window_start:
+                completed_in_window += 1
+    # don't count time before the first worker came up
+    observed = min(window, now - min((w["started_at"] for w in workers), default=now))
+    replicas = len(workers)
+    ready_times = [w["extra"]["time_to_ready_s"] for w in workers if "time_to_ready_s" in w.get("extra", {})]
+    return {
+        "replicas": replicas,
+        "busy_replicas": sum(1 for w in workers if w.get("current")),
+        "jobs_completed": sum(w.get("jobs_completed", 0) for w in workers),
+        "occupancy": busy / (observed * replicas) if observed > 0 and replicas else 0.0,
+        "throughput_per_min": 60.0 * completed_in_window / observed if observed > 0 else 0.0,
+        "mean_service_s": sum(durations) / len(durations) if durations else None,
+        "blocked_seconds": sum(w.get("blocked_seconds", 0.0) for w in workers),
+        # slowest replica's startup (imports, model load, ...), see the worker logs for the breakdown
+        "time_to_ready_s": max(ready_times) if ready_times else None,
+    }
+
+
+def summarize_stages(root, stages, window=STATS_WINDOW_S):
+    summary = {stage: summarize_stage(read_worker_stats(root, stage), window) for stage in stages}
+    active = {s: v for s, v in summary.items() if v["replicas"]}
+    bottleneck = max(active, key=lambda s: active[s]["occupancy"]) if active else None
+    return {"window_s": window, "stages": summary, "bottleneck": bottleneck}
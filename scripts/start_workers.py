@@ -1,12 +1,38 @@
-import subprocess
+# scripts/start_workers.py
+#
+# Starts the worker replicas and keeps them running.
+#
+# All replicas are spawned at once and announce their readiness on a pipe
+# (see Replica.mark_ready), so the model loads overlap and nothing is polled.
+# The supervisor then watches every replica:
+#   - a process that exits is noticed right away (pidfd, or the next check
+#     MONITOR_INTERVAL_S later where pidfds are not available)
+#   - a replica whose heartbeat is older than HEARTBEAT_TIMEOUT_S, or that is
+#     not ready STARTUP_TIMEOUT_S after it was started, is killed
+# The jobs a failed replica had claimed go straight back into their queues,
+# where the other replicas pick them up, and the replica is restarted with the
+# same worker ID after an exponential backoff. A job that was held by
+# MAX_JOB_ATTEMPTS failed replicas is given up (state "failed") instead, so a
+# job that crashes its worker cannot keep the pipeline in a restart loop.
+# Every recovery (failure detected -> replacement ready) is recorded as a
+# `supervisor.recovery` span (see /metrics) and in
+# worker_data/stats/supervisor.json.
+
+import argparse
+import json
+import os
+import selectors
 import signal
+import socket
+import subprocess
 import sys
-from pathlib import Path
 import time
-import os
-import shutil
 
 from utils import ColorPrint
+from job_store import JobStore, QUEUE_CONSUMERS, STAGES
+from job_registry import JobRegistry
+from replicas import HEARTBEAT_TIMEOUT_S, READY_FD_ENV, read_replicas, ready_dir, supervisor_path
+from tracing import Tracer
 print = ColorPrint(worker_name="All Worker Starter", default_color="purple")
 
 SAM3_PY   = "/home/ferdinand/miniforge3/envs/sam3/bin/python"
@@ -17,34 +43,353 @@ WORKERS = {
     "sam3d":  [SAM3D_PY, "scripts/sam_3d_worker.py"],
 }
 
-READY_DIR = Path("worker_data/workers_ready")
-READY_DIR.mkdir(exist_ok=True)
+# workers that sleep instead of running a model (see stub_worker.py)
+STUB_WORKERS = {
+    stage: [sys.executable, "scripts/stub_worker.py", "--stage", stage] for stage in WORKERS
+}
+
+# restart delays double from RESTART_BACKOFF_S up to RESTART_BACKOFF_MAX_S
+RESTART_BACKOFF_S = 1.0
+RESTART_BACKOFF_MAX_S = 30.0
+# a replica that ran this long before it failed starts over at the shortest delay
+STABLE_AFTER_S = 300.0
+# model loading included; a replica that takes longer is restarted
+STARTUP_TIMEOUT_S = float(os.environ.get("SAM_WORKER_STARTUP_TIMEOUT_S", "600"))
+# heartbeats, startup timeouts and pending restarts are checked at this interval
+MONITOR_INTERVAL_S = 1.0
+# SIGTERM -> SIGKILL grace period on shutdown
+STOP_TIMEOUT_S = 10.0
+# recoveries kept in the status file
+RECOVERY_HISTORY = 50
+# failed replicas a job (or a render/collision request) may take down before it is given up
+MAX_JOB_ATTEMPTS = int(os.environ.get("SAM_MAX_JOB_ATTEMPTS", "3"))
+
+STORE = JobStore()
+REGISTRY = JobRegistry(STORE.registry_path())
+TRACER = Tracer(STORE.root, "supervisor")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Start the pipeline workers and restart them when they fail")
+    parser.add_argument("--sam3", type=int, default=1, help="number of SAM3 replicas")
+    parser.add_argument("--sam3d", type=int, default=1, help="number of SAM-3D replicas")
+    parser.add_argument("--stub", action="store_true", help="start stub workers that sleep instead of running models")
+    parser.add_argument("--gpus", default="", help="comma separated GPU ids the replicas of a stage are spread over")
+    parser.add_argument("--exit-with-parent", action="store_true",
+                        help="stop the workers when the process that started the supervisor exits")
+    return parser.parse_args(argv)
+
+def served_queues(stage):
+    # the stage's own queue and the ones its replicas serve (collision, render)
+    return [stage] + [q for q, consumer in QUEUE_CONSUMERS.items() if consumer == stage]
+
+def give_up(queue, job_id, attempts):
+    reason = f"{attempts} {queue} replica(s) failed while holding it"
+    if queue in STAGES:
+        REGISTRY.fail(job_id, reason)
+    else:
+        # the job itself is finished, only the request is closed without its files
+        job = REGISTRY.get(job_id) or {}
+        if queue == "render":
+            REGISTRY.complete_render(job_id, job.get("render_requests", []))
+        elif queue == "collision":
+            REGISTRY.complete_collision_lods(job_id, job.get("collision_requests", []))
+    print(f"! Gave up on the {queue} entry of job {job_id}: {reason}", color="red")
+
+def kill_group(proc, sig):
+    # workers run in their own session, so their pool processes go with them
+    try:
+        os.killpg(proc.pid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+class WorkerProcess:
+    """One replica slot: its command, the current process and the restart state."""
+
+    def __init__(self, stage, worker_id, command, env):
+        self.stage = stage
+        self.worker_id = worker_id
+        self.command = command
+        self.env = env
+        self.proc = None
+        self.ready_fd = None
+        self.pidfd = None
+        self.spawned_at = None
+        self.ready_at = None
+        self.restarts = 0
+        self.failures = 0
+        self.restart_at = None
+        # the outage being recovered from, until the replacement is ready
+        self.failure = None
+        self._buffer = b""
+
+    def state(self):
+        if self.proc is None:
+            return "restarting"
+        return "ready" if self.ready_at is not None else "starting"
+
+    def heartbeat_at(self):
+        for replica in read_replicas(STORE.root, self.stage):
+            if replica["worker_id"] == self.worker_id and replica.get("pid") == self.proc.pid:
+                return replica.get("updated_at")
+        return None
 
-procs = {}
+    def summary(self):
+        return {
+            "stage": self.stage,
+            "worker_id": self.worker_id,
+            "pid": self.proc.pid if self.proc is not None else None,
+            "state": self.state(),
+            "restarts": self.restarts,
+            "consecutive_failures": self.failures,
+            "restart_at": self.restart_at,
+            "failure": self.failure,
+        }
 
-def start_all():
-    for name, cmd in WORKERS.items():
-        print(f"Starting {name}")
-        procs[name] = subprocess.Popen(cmd)
 
-def wait_until_ready():
-    print("Waiting for workers...")
-    while True:
-        ready = all((READY_DIR / f"{name}.ready").exists() for name in WORKERS)
-        if ready:
+class Supervisor:
+    def __init__(self, workers, exit_with_parent=False):
+        self.workers = workers
+        self.selector = selectors.DefaultSelector()
+        self.parent_pid = os.getppid() if exit_with_parent else None
+        self.recoveries = []
+        self.all_ready_reported = False
+
+    # ---- process lifecycle ----
+
+    def spawn(self, w):
+        read_fd, write_fd = os.pipe()
+        env = dict(w.env, **{READY_FD_ENV: str(write_fd)})
+        w.proc = subprocess.Popen(w.command, env=env, pass_fds=(write_fd,), start_new_session=True)
+        os.close(write_fd)
+        os.set_blocking(read_fd, False)
+        w.ready_fd = read_fd
+        w._buffer = b""
+        self.selector.register(read_fd, selectors.EVENT_READ, ("ready", w))
+        if hasattr(os, "pidfd_open"):
+            try:
+                # readable once the process exits
+                w.pidfd = os.pidfd_open(w.proc.pid)
+                self.selector.register(w.pidfd, selectors.EVENT_READ, ("exit", w))
+            except OSError:
+                w.pidfd = None
+        w.spawned_at = time.time()
+        w.ready_at = None
+        w.restart_at = None
+        print(f"Started {w.stage} replica {w.worker_id} (pid {w.proc.pid})")
+
+    def close_fds(self, w):
+        for attr in ("ready_fd", "pidfd"):
+            fd = getattr(w, attr)
+            if fd is None:
+                continue
+            try:
+                self.selector.unregister(fd)
+            except (KeyError, ValueError):
+                pass
+            os.close(fd)
+            setattr(w, attr, None)
+
+    def read_ready_pipe(self, w):
+        try:
+            data = os.read(w.ready_fd, 4096)
+        except BlockingIOError:
+            return
+        if not data:
+            # every writer is gone; the exit itself is handled by check()
+            self.selector.unregister(w.ready_fd)
+            os.close(w.ready_fd)
+            w.ready_fd = None
+            return
+        w._buffer += data
+        while b"\n" in w._buffer:
+            line, w._buffer = w._buffer.split(b"\n", 1)
+            try:
+                message = json.loads(line)
+            except ValueError:
+                continue
+            if message.get("event") == "ready":
+                self.on_ready(w, message)
+
+    def on_ready(self, w, message):
+        w.ready_at = message.get("ready_at", time.time())
+        print(f"{w.stage} replica {w.worker_id} ready after {w.ready_at - w.spawned_at:.1f}s")
+        if w.failure is not None:
+            # failure detected -> replacement ready
+            recovery_s = w.ready_at - w.failure["detected_at"]
+            TRACER.record("supervisor.recovery", w.failure["detected_at"], recovery_s,
+                          stage=w.stage, worker_id=w.worker_id, reason=w.failure["reason"],
+                          requeued=len(w.failure["requeued"]))
+            self.recoveries = (self.recoveries + [dict(w.failure, recovered_at=w.ready_at,
+                                                       recovery_s=recovery_s)])[-RECOVERY_HISTORY:]
+            print(f"{w.stage} replica {w.worker_id} recovered in {recovery_s:.1f}s")
+            w.failure = None
+        if not self.all_ready_reported and all(x.ready_at is not None for x in self.workers):
+            self.all_ready_reported = True
             print("All workers ready")
+        self.write_status()
+
+    def fail(self, w, reason):
+        """Take a failed replica down, re-queue its jobs and schedule the restart."""
+        now = time.time()
+        heartbeat_at = w.heartbeat_at()
+        if w.proc.poll() is None:
+            kill_group(w.proc, signal.SIGKILL)
+            w.proc.wait()
+        else:
+            # pool processes may outlive the worker itself
+            kill_group(w.proc, signal.SIGKILL)
+        self.close_fds(w)
+        w.proc = None
+        # the server and the scheduler stop counting it right away
+        try:
+            (ready_dir(STORE.root, w.stage) / f"{w.worker_id}.json").unlink()
+        except FileNotFoundError:
+            pass
+        requeued, dropped = self.recover_jobs(w)
+
+        uptime = now - (w.ready_at or w.spawned_at)
+        w.failures = 1 if w.ready_at is not None and uptime >= STABLE_AFTER_S else w.failures + 1
+        delay = min(RESTART_BACKOFF_MAX_S, RESTART_BACKOFF_S * 2 ** (w.failures - 1))
+        w.restart_at = now + delay
+        w.restarts += 1
+        if w.failure is None:
+            w.failure = {"stage": w.stage, "worker_id": w.worker_id, "reason": reason, "detected_at": now,
+                         "last_heartbeat_at": heartbeat_at, "requeued": requeued, "failed_jobs": dropped}
+        else:
+            # the replacement failed too; the outage goes on
+            w.failure["requeued"] += requeued
+            w.failure["failed_jobs"] += dropped
+            w.failure["reason"] += f"; {reason}"
+        given_up = f", gave up on {dropped}" if dropped else ""
+        print(f"! {w.stage} replica {w.worker_id} failed ({reason}), re-queued {requeued}{given_up}, "
+              f"restarting in {delay:.0f}s", color="red")
+        self.write_status()
+
+    def recover_jobs(self, w):
+        """Re-queue the jobs a failed replica held, except those that have been held
+        by MAX_JOB_ATTEMPTS failed replicas; returns (requeued, given up)."""
+        requeued, dropped = [], []
+        for queue in served_queues(w.stage):
+            drop = {}
+            for job_id in set(STORE.active_jobs(queue, owner=w.worker_id)):
+                try:
+                    attempts = REGISTRY.count_requeue(job_id, queue)
+                except KeyError:
+                    # not in the registry (any more), nothing to count
+                    continue
+                if attempts >= MAX_JOB_ATTEMPTS:
+                    drop[job_id] = attempts
+            requeued += STORE.requeue_active(queue, owner=w.worker_id, drop=drop)
+            for job_id, attempts in drop.items():
+                give_up(queue, job_id, attempts)
+            dropped += sorted(drop)
+        return requeued, dropped
+
+    def check(self, w, now):
+        if w.proc is None:
+            if w.restart_at is not None and now >= w.restart_at:
+                self.spawn(w)
+                self.write_status()
             return
-        time.sleep(0.5)
+        returncode = w.proc.poll()
+        if returncode is not None:
+            self.fail(w, f"exited with code {returncode}")
+        elif w.ready_at is None:
+            if now - w.spawned_at > STARTUP_TIMEOUT_S:
+                self.fail(w, f"not ready after {STARTUP_TIMEOUT_S:.0f}s")
+        else:
+            heartbeat_at = max(w.heartbeat_at() or 0, w.ready_at)
+            if now - heartbeat_at > HEARTBEAT_TIMEOUT_S:
+                self.fail(w, f"no heartbeat for {now - heartbeat_at:.0f}s")
+
+    # ---- main loop ----
+
+    def run(self):
+        # Popen returns right away, all replicas load their models at the same time
+        for w in self.workers:
+            self.spawn(w)
+        self.write_status()
+        print("Waiting for workers...")
+        while True:
+            now = time.time()
+            restarts = [w.restart_at - now for w in self.workers if w.restart_at is not None]
+            timeout = max(0.0, min([MONITOR_INTERVAL_S] + restarts))
+            for key, _ in self.selector.select(timeout):
+                kind, w = key.data
+                if kind == "ready":
+                    self.read_ready_pipe(w)
+            # exits (pidfd events) are picked up here as well
+            now = time.time()
+            for w in self.workers:
+                self.check(w, now)
+            if self.parent_pid is not None and os.getppid() != self.parent_pid:
+                print("Parent process is gone")
+                return
+
+    def stop(self):
+        print("Stopping workers")
+        running = [w for w in self.workers if w.proc is not None and w.proc.poll() is None]
+        for w in running:
+            kill_group(w.proc, signal.SIGTERM)
+        deadline = time.monotonic() + STOP_TIMEOUT_S
+        for w in running:
+            try:
+                w.proc.wait(timeout=max(0.0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                kill_group(w.proc, signal.SIGKILL)
+        for w in self.workers:
+            if w.proc is not None:
+                self.close_fds(w)
+
+    def write_status(self):
+        status = {
+            "pid": os.getpid(),
+            "updated_at": time.time(),
+            "workers": [w.summary() for w in self.workers],
+            "recoveries": self.recoveries,
+            # a failure is noticed within detection_bound_s and the replacement
+            # started within restart_backoff_max_s after that
+            "detection_bound_s": HEARTBEAT_TIMEOUT_S + MONITOR_INTERVAL_S,
+            "restart_backoff_max_s": RESTART_BACKOFF_MAX_S,
+            "startup_timeout_s": STARTUP_TIMEOUT_S,
+        }
+        path = supervisor_path(STORE.root)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_suffix(".json.tmp")
+            tmp_path.write_text(json.dumps(status, indent=2))
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"! Could not write {path}: {e}", color="yellow")
+
+
+def make_workers(replicas, stub=False, gpus=()):
+    commands = STUB_WORKERS if stub else WORKERS
+    host = socket.gethostname()
+    workers = []
+    for stage, count in replicas.items():
+        for i in range(count):
+            # unique across boxes that share the job store, and kept across restarts
+            worker_id = f"{host}-{i}"
+            env = dict(os.environ, SAM_WORKER_ID=worker_id)
+            if gpus:
+                env["CUDA_VISIBLE_DEVICES"] = gpus[i % len(gpus)]
+            workers.append(WorkerProcess(stage, worker_id, commands[stage], env))
+    return workers
 
 def shutdown(sig, frame):
-    print("Stopping workers")
-    for p in procs.values():
-        p.terminate()
-    sys.exit(0)
+    raise SystemExit(0)
 
 signal.signal(signal.SIGINT, shutdown)
 signal.signal(signal.SIGTERM, shutdown)
 
 if __name__ == "__main__":
-    start_all()
-    wait_until_ready()
+    args = parse_args()
+    replicas = {"sam3": args.sam3, "sam3d": args.sam3d}
+    gpus = [g.strip() for g in args.gpus.split(",") if g.strip()]
+    supervisor = Supervisor(make_workers(replicas, stub=args.stub, gpus=gpus), exit_with_parent=args.exit_with_parent)
+    try:
+        supervisor.run()
+    finally:
+        supervisor.stop()
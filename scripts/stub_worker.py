@@ -0,0 +1,214 @@
+# scripts/stub_worker.py
+#
+# Stand-in for sam3_worker.py / sam_3d_worker.py that sleeps instead of
+# running a model. It goes through the same queues, registry, stats and
+# replica heartbeat as the real workers and publishes small placeholder
+# artifacts, so scheduling, scaling and the server can be exercised on a box
+# without a GPU:
+#
+#   python scripts/start_workers.py --sam3 1 --sam3d 3 --stub
+#
+# Service times come from SAM_STUB_SERVICE_S (e.g. "sam3=0.5,sam3d=2.0").
+
+import argparse
+import functools
+import json
+import os
+import random
+import time
+
+from utils import ColorPrint, StartupTimer
+from job_store import JobStore, DEFAULT_PRIORITY, DEFAULT_ARTIFACTS, render_state_name
+from job_registry import JobRegistry
+from stage_stats import StageStats
+from replicas import Replica, SCHEDULE_RECHECK_S
+from tracing import Tracer
+from cache import ArtifactStore, RESULT_CACHE_DIR, RESULT_CACHE_MAX_BYTES
+
+DEFAULT_SERVICE_S = {"sam3": 0.5, "sam3d": 2.0}
+# "startup" is the time to load the (imaginary) model
+DEFAULT_STARTUP_S = 1.0
+IDLE_RESCAN_S = 5.0
+# same bounded buffer in front of SAM-3D as the real SAM3 worker
+HANDOFF_CAPACITY = 4
+# placeholder file per selected output kind
+OUTPUT_SUFFIXES = {
+    "visual": "_visual.obj",
+    "collision": "_collision.obj",
+    "glb": "_mesh.glb",
+    "splat": "_gsplat.compressed.ply",
+    "splat_ply": "_gsplat.ply",
+}
+
+
+def parse_service_times(spec):
+    times = dict(DEFAULT_SERVICE_S)
+    for item in (spec or "").split(","):
+        if "=" in item:
+            stage, seconds = item.split("=", 1)
+            times[stage.strip()] = float(seconds)
+    return times
+
+
+def publish_placeholder(store, job_id, name, content=b"stub"):
+    final_output_dir = store.final_output_dir(job_id)
+    tmp_path = final_output_dir / f".{name}.tmp"
+    tmp_path.write_bytes(content)
+    os.replace(tmp_path, final_output_dir / name)
+    return name
+
+
+def prompt_name(store, job_id):
+    prompt_path = store.input_dir(job_id) / "prompt.txt"
+    prompt = prompt_path.read_text().strip() if prompt_path.exists() else ""
+    safe_prompt = "".join(c if c.isalnum() or c in ("_", "-") else "_" for c in (prompt or "object").lower())
+    return safe_prompt.strip("_") or "object"
+
+
+def run_sam3_stub(store, registry, job_id):
+    name = prompt_name(store, job_id)
+    masks_info = {
+        "prompt": name,
+        "name": name,
+        "image": None,
+        "handoff": None,
+        "masks_file": None,
+        "masks": [{"index": 0, "score": 0.9, "box": [0.0, 0.0, 1.0, 1.0]}],
+    }
+    (store.masks_dir(job_id) / "masks.json").write_text(json.dumps(masks_info, indent=2))
+    published = publish_placeholder(store, job_id, f"{name}_segmentation_results.png")
+    registry.add_artifacts(job_id, {published: 4})
+    registry.mark_stage(job_id, "sam3")
+    registry.set_masks(job_id, ["masks.json"])
+
+
+def run_sam3d_stub(store, registry, job_id, result_store=None):
+    name = json.loads((store.masks_dir(job_id) / "masks.json").read_text())["name"]
+    registry.mark_stage(job_id, "sam3d")
+    outputs = registry.get(job_id).get("outputs", DEFAULT_ARTIFACTS)
+    published = [publish_placeholder(store, job_id, f"{name}{suffix}")
+                 for kind, suffix in OUTPUT_SUFFIXES.items() if kind in outputs]
+    if "gif" in outputs:
+        # rendered on the first download, like the real worker does
+        gif_name = f"{name}_3d_visualization.gif"
+        publish_placeholder(store, job_id, render_state_name(gif_name))
+        registry.add_on_demand(job_id, [gif_name])
+    published.append(publish_placeholder(store, job_id, "objects.json", json.dumps({"objects": []}).encode()))
+    registry.add_artifacts(job_id, {n: (store.final_output_dir(job_id) / n).stat().st_size for n in published})
+    registry.mark_stage(job_id, "exports")
+    # cached like the real worker does, so identical resubmissions are cache hits
+    cache_key = registry.get(job_id).get("cache_key")
+    if cache_key and result_store is not None:
+        result_store.put(cache_key, store.final_output_dir(job_id), status="done")
+    registry.set_state(job_id, "done")
+
+
+def serve_collision_stub(store, registry, replica, job_id):
+    job = registry.get(job_id)
+    lods = [lod for payload in store.claimed_payloads("collision", job_id, owner=replica.worker_id)
+            for lod in payload.get("lods", [])]
+    lods = list(dict.fromkeys(lods + (job.get("collision_requests", []) if job else [])))
+    masks_json = store.masks_dir(job_id) / "masks.json"
+    if lods and masks_json.exists():
+        name = json.loads(masks_json.read_text())["name"]
+        published = [publish_placeholder(store, job_id, f"{name}_collision_{lod}.obj") for lod in lods]
+        registry.add_artifacts(job_id, {n: (store.final_output_dir(job_id) / n).stat().st_size for n in published})
+    if lods:
+        registry.complete_collision_lods(job_id, lods)
+    store.complete("collision", job_id)
+
+
+def serve_render_stub(store, registry, replica, result_store, job_id):
+    job = registry.get(job_id)
+    names = [name for payload in store.claimed_payloads("render", job_id, owner=replica.worker_id)
+             for name in payload.get("names", [])]
+    names = list(dict.fromkeys(names or (job.get("render_requests", []) if job else [])))
+    final_output_dir = store.final_output_dir(job_id)
+    for name in names:
+        state_path = final_output_dir / render_state_name(name)
+        if state_path.exists():
+            publish_placeholder(store, job_id, name)
+            registry.add_artifacts(job_id, {name: (final_output_dir / name).stat().st_size})
+            if job and job.get("cache_key"):
+                result_store.add_file(job["cache_key"], final_output_dir / name, replaces=state_path.name)
+            state_path.unlink()
+    registry.complete_render(job_id, names)
+    store.complete("render", job_id)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Worker that sleeps instead of running a model")
+    parser.add_argument("--stage", choices=["sam3", "sam3d"], required=True)
+    parser.add_argument("--startup-s", type=float, default=DEFAULT_STARTUP_S)
+    parser.add_argument("--jitter", type=float, default=0.1, help="relative random variation of the service time")
+    args = parser.parse_args()
+
+    startup = StartupTimer()
+    stage = args.stage
+    service_s = parse_service_times(os.environ.get("SAM_STUB_SERVICE_S"))[stage]
+    print = ColorPrint(worker_name=f"STUB_{stage.upper()}", default_color="white")
+
+    store = JobStore()
+    registry = JobRegistry(store.registry_path())
+    result_store = ArtifactStore(RESULT_CACHE_DIR, max_bytes=RESULT_CACHE_MAX_BYTES)
+    handoff_waiter = store.space_waiter("sam3d") if stage == "sam3" else None
+    replica = Replica(store.root, stage)
+    waiter = store.waiter(stage, replica.worker_id)
+    stats = StageStats(store.root, stage, worker_id=replica.worker_id)
+    tracer = Tracer(store.root, f"stub_{stage}", worker_id=replica.worker_id)
+    time.sleep(args.startup_s)
+    startup.mark("model load (simulated)")
+    replica.mark_ready()
+    stats.set_extra(startup=startup.phases, time_to_ready_s=startup.total(), stub=True)
+    stats.write()
+    print(f"Stub {stage} replica {replica.worker_id} ready ({service_s:.2f}s per job)")
+
+    run_stub = run_sam3_stub if stage == "sam3" else functools.partial(run_sam3d_stub, result_store=result_store)
+    while True:
+        if stage == "sam3d":
+            # collision LODs requested for finished jobs
+            while (collision_job_id := store.claim("collision", owner=replica.worker_id)) is not None:
+                serve_collision_stub(store, registry, replica, collision_job_id)
+            while (render_job_id := store.claim("render", owner=replica.worker_id)) is not None:
+                serve_render_stub(store, registry, replica, result_store, render_job_id)
+        if handoff_waiter is not None:
+            while store.queue_depth("sam3d") >= HANDOFF_CAPACITY:
+                handoff_waiter.wait(timeout=IDLE_RESCAN_S)
+        if store.queue_depth(stage) and not replica.should_claim():
+            waiter.wait(timeout=SCHEDULE_RECHECK_S)
+            continue
+        job_id = store.claim(stage, owner=replica.worker_id)
+        if job_id is None:
+            waiter.wait(timeout=IDLE_RESCAN_S)
+            continue
+        if not store.job_exists(job_id):
+            store.complete(stage, job_id)
+            continue
+        if registry.expire_if_due(job_id):
+            print(f"! Deadline of job {job_id} has passed, dropping it.")
+            store.complete(stage, job_id)
+            continue
+        replica.adjust_load(+1)
+        stats.job_started(job_id)
+        registry.mark_stage_started(job_id, stage)
+        if stage == "sam3":
+            registry.set_state(job_id, "processing")
+        try:
+            with tracer.span(f"{stage}.job", job_id=job_id):
+                time.sleep(max(0.0, random.gauss(service_s, service_s * args.jitter)))
+                run_stub(store, registry, job_id)
+        except Exception as e:
+            # given up like the real workers do, the replica carries on
+            print(f"! Job {job_id} failed: {e!r}", color="red")
+            registry.fail(job_id, f"{stage}: {e!r}")
+        else:
+            if stage == "sam3":
+                store.enqueue("sam3d", job_id, priority=registry.get(job_id).get("priority", DEFAULT_PRIORITY))
+            print(f"Job {job_id} done")
+        store.complete(stage, job_id)
+        stats.job_finished(job_id)
+        replica.adjust_load(-1)
+
+
+if __name__ == "__main__":
+    main()
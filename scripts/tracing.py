@@ -0,0 +1,211 @@
+# scripts/tracing.py
+#
+# Structured timing spans and the Prometheus text format of /metrics.
+#
+# Every process (server, workers, forked post-processing workers) appends its
+# spans as JSON lines to worker_data/traces/<component>-<pid>.jsonl:
+#
+#   {"name": "sam3.set_image", "job_id": "...", "component": "sam3",
+#    "worker_id": "...", "start": 1712.3, "duration_s": 0.41, ...}
+#
+# Spans carry the job_id, so the life of a job can be followed across
+# processes by grepping the trace files for it. The server folds new lines
+# into histograms whenever /metrics is scraped (SpanCollector).
+
+import bisect
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+# seconds; covers everything from file writes to full reconstructions
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+# a trace file is rotated (one old generation is kept) once it gets this big
+MAX_TRACE_BYTES = 64 * 1024**2
+
+# job the current thread works on; spans default to it
+current_job = contextvars.ContextVar("current_job", default=None)
+
+
+def traces_dir(root):
+    return Path(root) / "traces"
+
+
+class Tracer:
+    def __init__(self, root, component, worker_id=None):
+        self.dir = traces_dir(root)
+        self.component = component
+        self.worker_id = worker_id
+        self._lock = threading.Lock()
+        self._file = None
+        self._pid = os.getpid()
+
+    def _open(self):
+        # called with the lock held
+        if self._file is None:
+            self.dir.mkdir(parents=True, exist_ok=True)
+            self.path = self.dir / f"{self.component}-{self._pid}.jsonl"
+            self._file = open(self.path, "a", buffering=1, encoding="utf-8")
+        elif self._file.tell() > MAX_TRACE_BYTES:
+            self._file.close()
+            os.replace(self.path, self.path.with_suffix(".jsonl.1"))
+            self._file = open(self.path, "a", buffering=1, encoding="utf-8")
+        return self._file
+
+    def record(self, name, start, duration_s, job_id=None, **attrs):
+        span = {
+            "name": name,
+            "job_id": job_id or current_job.get(),
+            "component": self.component,
+            "worker_id": self.worker_id,
+            "pid": os.getpid(),
+            "start": start,
+            "duration_s": duration_s,
+        }
+        span.update(attrs)
+        line = json.dumps(span) + "\n"
+        if self._pid != os.getpid():
+            # forked post-processing workers write their own file; the parent's
+            # lock may have been held at fork time
+            self._lock = threading.Lock()
+            self._file = None
+            self._pid = os.getpid()
+        try:
+            with self._lock:
+                self._open().write(line)
+        except OSError:
+            # tracing must never take a job down
+            pass
+
+    @contextlib.contextmanager
+    def span(self, name, job_id=None, **attrs):
+        start = time.time()
+        t0 = time.perf_counter()
+        error = None
+        try:
+            yield attrs
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            if error is not None:
+                attrs["error"] = error
+            self.record(name, start, time.perf_counter() - t0, job_id=job_id, **attrs)
+
+    def traced(self, name):
+        """Decorator: a span per call. The function gains a `job_id` keyword, which
+        nested spans inherit (also inside process pool workers)."""
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, job_id=None, **kwargs):
+                with self.job(job_id or current_job.get()), self.span(name):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    @contextlib.contextmanager
+    def job(self, job_id):
+        """Attribute the spans of this thread to `job_id`."""
+        token = current_job.set(job_id)
+        try:
+            yield
+        finally:
+            current_job.reset(token)
+
+
+# ---- Prometheus text format ----
+
+def _labels(labels):
+    if not labels:
+        return ""
+    escaped = (f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+               for k, v in sorted(labels.items()))
+    return "{" + ",".join(escaped) + "}"
+
+
+class Histogram:
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, n in zip(self.buckets, self.counts):
+            cumulative += n
+            lines.append(f"{name}_bucket{_labels({**labels, 'le': repr(float(bound))})} {cumulative}")
+        lines.append(f"{name}_bucket{_labels({**labels, 'le': '+Inf'})} {self.count}")
+        lines.append(f"{name}_sum{_labels(labels)} {self.sum}")
+        lines.append(f"{name}_count{_labels(labels)} {self.count}")
+        return lines
+
+
+class MetricsText:
+    """Collects metric families and renders them in the Prometheus exposition format."""
+
+    def __init__(self):
+        self._families = {}
+
+    def add(self, name, kind, help_text, value, labels=None):
+        family = self._families.setdefault(name, (kind, help_text, []))
+        family[2].append((labels or {}, value))
+
+    def render(self):
+        lines = []
+        for name, (kind, help_text, samples) in self._families.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                if kind == "histogram":
+                    lines.extend(value.render(name, labels))
+                elif value is not None:
+                    lines.append(f"{name}{_labels(labels)} {float(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class SpanCollector:
+    """Folds the spans of all trace files into one histogram per (component, span name)."""
+
+    def __init__(self, root):
+        self.dir = traces_dir(root)
+        self.histograms = {}
+        self._offsets = {}
+        self._lock = threading.Lock()
+
+    def collect(self):
+        with self._lock:
+            if not self.dir.exists():
+                return self.histograms
+            for path in self.dir.glob("*.jsonl"):
+                offset = self._offsets.get(path.name, 0)
+                try:
+                    if path.stat().st_size < offset:
+                        # rotated since the last scrape
+                        offset = 0
+                    with open(path, "rb") as f:
+                        f.seek(offset)
+                        data = f.read()
+                except OSError:
+                    continue
+                # only complete lines; a partial one is picked up next time
+                end = data.rfind(b"\n") + 1
+                self._offsets[path.name] = offset + end
+                for line in data[:end].splitlines():
+                    try:
+                        span = json.loads(line)
+                    except ValueError:
+                        continue
+                    key = (span.get("component"), span["name"])
+                    self.histograms.setdefault(key, Histogram()).observe(span["duration_s"])
+            return self.histograms
@@ -1,4 +1,5 @@
 import builtins
+import time
 from datetime import datetime
 
 class ColorPrint:
@@ -28,3 +29,28 @@ class ColorPrint:
         prefix = f"[{ts}][{self.worker_name}]"
 
         self._orig_print(f"{c}{prefix}", *args, f"{r}", **kwargs)
+
+
+class StartupTimer:
+    """Wall-clock time of the startup phases of a worker, logged once it is ready."""
+
+    def __init__(self):
+        self.start = time.time()
+        self.last = self.start
+        self.phases = {}
+
+    def mark(self, phase):
+        # time since the previous mark is booked on `phase`
+        now = time.time()
+        self.phases[phase] = round(now - self.last, 3)
+        self.last = now
+
+    def add(self, phase, seconds):
+        # for phases that ran in the background, overlapping the others
+        self.phases[phase] = round(seconds, 3)
+
+    def total(self):
+        return round(time.time() - self.start, 3)
+
+    def summary(self):
+        return ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in self.phases.items())
@@ -0,0 +1,43 @@
+# tests/test_archive.py
+
+import os
+import time
+
+from scripts.archive import JobArchive
+
+
+def make_workspace(path, size=100):
+    (path / "final_output").mkdir(parents=True)
+    (path / "final_output" / "chair.obj").write_bytes(bytes(size))
+    return path
+
+
+def test_add_moves_the_workspace(tmp_path):
+    archive = JobArchive(tmp_path / "finished", compression=None)
+    entry = archive.add("job", make_workspace(tmp_path / "jobs" / "job"))
+    assert not (tmp_path / "jobs" / "job").exists()
+    assert (entry / "final_output" / "chair.obj").stat().st_size == 100
+    assert archive.stats()["entries"] == 1 and archive.stats()["bytes"] == 100
+
+
+def test_compressed_entry(tmp_path):
+    archive = JobArchive(tmp_path / "finished", compression="gz")
+    entry = archive.add("job", make_workspace(tmp_path / "jobs" / "job"))
+    assert entry.name == "worker_data_job.tar.gz"
+    assert sorted(os.listdir(archive.root)) == [entry.name]
+
+
+def test_retention(tmp_path):
+    archive = JobArchive(tmp_path / "finished", compression=None, max_age_s=3600, max_bytes=250)
+    now = time.time()
+    # archived two hours, 30 minutes, 20 and 10 minutes ago
+    for job_id, age in (("expired", 7200), ("oldest", 1800), ("older", 1200), ("newest", 600)):
+        entry = archive.add(job_id, make_workspace(tmp_path / "jobs" / job_id))
+        os.utime(entry, (now - age, now - age))
+
+    # past max_age_s, then the oldest until the rest fits max_bytes
+    assert archive.enforce_retention(force=True) == ["worker_data_expired", "worker_data_oldest"]
+    assert sorted(os.listdir(archive.root)) == ["worker_data_newest", "worker_data_older"]
+    # not again within RETENTION_INTERVAL_S unless forced
+    archive.max_bytes = 0
+    assert archive.enforce_retention() == []
@@ -0,0 +1,59 @@
+# tests/test_cache.py
+
+import os
+
+import numpy as np
+
+from scripts.cache import ArtifactStore, LRUCache
+
+
+def test_lru_eviction():
+    cache = LRUCache(max_bytes=300)
+    cache.put("a", np.zeros(100, dtype=np.uint8))
+    cache.put("b", np.zeros(100, dtype=np.uint8))
+    cache.put("c", np.zeros(100, dtype=np.uint8))
+    # "a" becomes the most recently used, "b" goes first
+    assert cache.get("a") is not None
+    cache.put("d", np.zeros(100, dtype=np.uint8))
+    assert "b" not in cache and all(key in cache for key in ("a", "c", "d"))
+    assert cache.current_bytes == 300 and cache.evictions == 1
+    # larger than the whole cache: not stored, nothing evicted for it
+    assert cache.put("e", np.zeros(301, dtype=np.uint8)) is False
+    assert len(cache) == 3
+    assert cache.get("b") is None
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+
+def make_result(path, content):
+    path.mkdir()
+    (path / "chair.obj").write_bytes(content)
+    return path
+
+
+def test_artifact_store_round_trip(tmp_path):
+    store = ArtifactStore(tmp_path / "results", max_bytes=1000)
+    store.put("key", make_result(tmp_path / "job", b"mesh"), status="done")
+    assert store.get("missing", tmp_path / "other") is None
+
+    assert store.get("key", tmp_path / "copy") == "done"
+    assert (tmp_path / "copy" / "chair.obj").read_bytes() == b"mesh"
+    # e.g. the GIF rendered from its state after the result was stored
+    (tmp_path / "job" / "chair.gif").write_bytes(b"gif")
+    assert store.add_file("key", tmp_path / "job" / "chair.gif", replaces="chair.obj")
+    assert store.get("key", tmp_path / "again") == "done"
+    assert sorted(os.listdir(tmp_path / "again")) == ["chair.gif"]
+    assert store.stats()["hits"] == 2 and store.stats()["misses"] == 1
+
+
+def test_artifact_store_eviction(tmp_path):
+    store = ArtifactStore(tmp_path / "results", max_bytes=350)
+    for i, key in enumerate(("a", "b", "c")):
+        store.put(key, make_result(tmp_path / key, bytes(100)))
+        # the directory mtime is the last use
+        os.utime(store.root / key, (1000 + i, 1000 + i))
+    # a hit counts as use, so "b" is now the least recently used entry
+    store.get("a", tmp_path / "copy")
+    store.put("d", make_result(tmp_path / "d", bytes(100)))
+    assert sorted(os.listdir(store.root)) == ["a", "c", "d"]
+    # the .status file counts too
+    assert store.stats()["bytes"] == 3 * (100 + len("done"))
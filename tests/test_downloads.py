@@ -0,0 +1,82 @@
+# tests/test_downloads.py
+
+import asyncio
+
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+
+from scripts.downloads import file_response, parse_range
+
+
+@pytest.mark.parametrize("header, expected", [
+    (None, None),
+    ("bytes=0-9", (0, 9)),
+    ("bytes=90-", (90, 99)),
+    ("bytes=-10", (90, 99)),
+    ("bytes=-500", (0, 99)),
+    ("bytes=50-500", (50, 99)),
+    ("bytes=0-1,5-6", None),
+    ("bytes=x-1", None),
+    ("bytes=-", None),
+    ("bytes=9-5", None),
+])
+def test_parse_range(header, expected):
+    assert parse_range(header, 100) == expected
+
+
+@pytest.mark.parametrize("header", ["bytes=-0", "bytes=100-", "bytes=100-105"])
+def test_unsatisfiable_range(header):
+    with pytest.raises(ValueError):
+        parse_range(header, 100)
+
+
+def make_request():
+    return Request({"type": "http", "method": "GET", "headers": []})
+
+
+async def read_body(response):
+    return b"".join([chunk async for chunk in response.body_iterator])
+
+
+def test_completion_after_the_body(tmp_path):
+    path = tmp_path / "chair.obj"
+    path.write_bytes(bytes(range(100)))
+    completed = []
+    response = file_response(make_request(), path, path.name, on_complete=lambda: completed.append(True))
+    # not before the file has been sent, the job could be archived meanwhile
+    assert completed == []
+    # the workspace is archived (renamed) before the body is sent
+    path.rename(tmp_path / "archived.obj")
+    assert asyncio.run(read_body(response)) == bytes(range(100))
+    assert completed == [True]
+
+
+@pytest.fixture
+def served(tmp_path):
+    path = tmp_path / "chair.obj"
+    path.write_bytes(bytes(range(100)))
+    completed = []
+    app = FastAPI()
+
+    @app.get("/file")
+    def get_file(request: Request):
+        return file_response(request, path, path.name, on_complete=lambda: completed.append(True))
+
+    return TestClient(app), completed
+
+
+def test_ranges_and_conditional_requests(served):
+    client, completed = served
+    response = client.get("/file", headers={"Range": "bytes=0-9"})
+    assert response.status_code == 206 and response.content == bytes(range(10))
+    assert completed == []
+    response = client.get("/file", headers={"Range": "bytes=-10"})
+    assert response.status_code == 206 and response.content == bytes(range(90, 100))
+    assert len(completed) == 1
+    assert client.get("/file", headers={"Range": "bytes=-0"}).status_code == 416
+    assert client.get("/file", headers={"Range": "bytes=9-5"}).status_code == 200
+    assert len(completed) == 2
+    etag = response.headers["etag"]
+    assert client.get("/file", headers={"If-None-Match": etag}).status_code == 304
+    assert len(completed) == 3
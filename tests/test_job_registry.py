@@ -0,0 +1,89 @@
+# tests/test_job_registry.py
+#
+# The server and the workers share one registry database; every process has
+# its own JobRegistry on it.
+
+import time
+
+from scripts.job_registry import JobRegistry
+
+
+def make_pair(tmp_path):
+    path = tmp_path / "registry.sqlite3"
+    return JobRegistry(path), JobRegistry(path)
+
+
+def test_changes_after_done_reach_other_instances(tmp_path):
+    server, worker = make_pair(tmp_path)
+    server.create("job", prompt="chair")
+    worker.set_state("job", "done")
+    assert server.get("job")["state"] == "done"
+    assert worker.get("job")["state"] == "done"
+
+    assert server.request_render("job", "chair.gif")
+    assert worker.get("job")["render_requests"] == ["chair.gif"]
+
+    worker.add_artifacts("job", {"chair.gif": 10})
+    worker.complete_render("job", ["chair.gif"])
+    job = server.get("job")
+    assert "chair.gif" in job["artifacts"]
+    assert job["render_requests"] == []
+
+
+def test_collision_requests_after_done(tmp_path):
+    server, worker = make_pair(tmp_path)
+    server.create("job")
+    worker.set_state("job", "done")
+    worker.get("job")
+
+    assert server.request_collision_lods("job", ["voxel_128"]) == ["voxel_128"]
+    assert worker.get("job")["collision_requests"] == ["voxel_128"]
+    worker.complete_collision_lods("job", ["voxel_128"])
+    assert server.get("job")["collision_requests"] == []
+
+
+def test_jobs_idle_since(tmp_path):
+    server, worker = make_pair(tmp_path)
+    for job_id in ("old", "downloading", "queued"):
+        server.create(job_id)
+    worker.set_state("old", "done")
+    worker.add_artifacts("downloading", {"chair.obj": 10, "chair.gif": 10})
+    worker.set_state("downloading", "done")
+    time.sleep(0.01)
+    cutoff = time.time()
+    time.sleep(0.01)
+    # a download counts as activity
+    server.record_downloads("downloading", ["chair.obj"])
+    assert server.jobs_idle_since(("done", "no_masks_detected"), cutoff) == ["old"]
+    assert sorted(server.jobs_idle_since(("done",), time.time() + 1)) == ["downloading", "old"]
+
+
+def test_unknown_job(tmp_path):
+    server, _ = make_pair(tmp_path)
+    assert server.get("missing") is None
+
+
+def test_unrequested_on_demand_files_dont_hold_back_retrieval(tmp_path):
+    server, worker = make_pair(tmp_path)
+    server.create("job")
+    worker.add_artifacts("job", {"chair.obj": 10})
+    worker.add_on_demand("job", ["chair.gif"])
+    worker.set_state("job", "done")
+    assert server.record_downloads("job", ["chair.obj"])
+    assert server.get("job")["state"] == "retrieved"
+
+
+def test_requested_on_demand_files_do(tmp_path):
+    server, worker = make_pair(tmp_path)
+    server.create("job")
+    worker.add_artifacts("job", {"chair.obj": 10})
+    worker.add_on_demand("job", ["chair.gif"])
+    worker.set_state("job", "done")
+
+    assert server.request_render("job", "chair.gif")
+    worker.add_artifacts("job", {"chair.gif": 10})
+    worker.complete_render("job", ["chair.gif"])
+    assert server.get("job")["on_demand"] == []
+    assert not server.record_downloads("job", ["chair.obj"])
+    assert server.record_downloads("job", ["chair.gif"])
+    assert server.get("job")["state"] == "retrieved"
@@ -0,0 +1,51 @@
+# tests/test_job_store.py
+
+import pytest
+
+from scripts.job_store import JobStore, parse_object_selection
+
+
+def test_claim_order_and_payloads(tmp_path):
+    store = JobStore(tmp_path)
+    store.enqueue("collision", "a", priority="batch", payload={"lods": ["voxel_32"]})
+    store.enqueue("collision", "b", priority="interactive", payload={"lods": ["voxel_128"]})
+    store.enqueue("sam3", "c")
+
+    assert store.claim("collision", owner="w1") == "b"
+    assert store.claimed_payloads("collision", "b", owner="w1") == [{"lods": ["voxel_128"]}]
+    assert store.claimed_payloads("collision", "b", owner="w2") == []
+    assert store.claim("sam3", owner="w1") == "c"
+    assert store.claimed_payloads("sam3", "c") == []
+
+    store.complete("collision", "b")
+    assert store.claimed_payloads("collision", "b") == []
+
+
+def test_requeue_of_one_owner(tmp_path):
+    store = JobStore(tmp_path)
+    store.enqueue("render", "a", payload={"names": ["a.gif"]})
+    store.enqueue("render", "b")
+    assert store.claim("render", owner="w1") == "a"
+    assert store.claim("render", owner="w2") == "b"
+
+    assert store.requeue_active("render", owner="w1") == ["a"]
+    assert store.queue_depth("render") == 1
+    # the payload moves along with the entry
+    assert store.claim("render", owner="w2") == "a"
+    assert store.claimed_payloads("render", "a", owner="w2") == [{"names": ["a.gif"]}]
+
+
+@pytest.mark.parametrize("spec, expected", [
+    (None, ("first", None)),
+    ("all", ("all", None)),
+    ("top:2", ("top", 2)),
+    ("5,0,2,0", ("indices", [0, 2, 5])),
+])
+def test_parse_object_selection(spec, expected):
+    assert parse_object_selection(spec) == expected
+
+
+@pytest.mark.parametrize("spec", ["top:x", "top:0", "a,b", "1,-2", ","])
+def test_invalid_object_selection(spec):
+    with pytest.raises(ValueError, match="Invalid object selection|top:K"):
+        parse_object_selection(spec)
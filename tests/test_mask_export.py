@@ -0,0 +1,28 @@
+# tests/test_mask_export.py
+
+import numpy as np
+
+from scripts.mask_export import MASKS_FILE, export_masks, load_compact_masks, mask_bboxes
+
+
+def make_masks():
+    # widths that are not a multiple of 8, so the bit-packing pads every row
+    masks = np.zeros((3, 5, 13), dtype=bool)
+    masks[0, 1:3, 2:9] = True
+    masks[1, 4, 12] = True
+    # masks[2] stays empty
+    return masks
+
+
+def test_bboxes():
+    assert mask_bboxes(make_masks()).tolist() == [[2, 1, 9, 3], [12, 4, 13, 5], [0, 0, 0, 0]]
+
+
+def test_round_trip(tmp_path):
+    masks = make_masks()
+    image = np.random.default_rng(0).integers(0, 256, (5, 13, 3), dtype=np.uint8)
+    bboxes, written = export_masks(tmp_path, image, masks, cutouts=True)
+    assert written == [MASKS_FILE, "0.png", "1.png", "2.png"]
+    assert np.array_equal(load_compact_masks(tmp_path / MASKS_FILE), masks)
+    with np.load(tmp_path / MASKS_FILE) as data:
+        assert np.array_equal(data["bboxes"], bboxes)
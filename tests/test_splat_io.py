@@ -0,0 +1,53 @@
+# tests/test_splat_io.py
+
+import numpy as np
+
+from scripts.splat_io import (
+    CHUNK_SIZE, matrix_to_quaternion, morton_order, read_compressed_ply, transform_gaussians, write_compressed_ply,
+)
+
+
+def make_gaussians(n, sh_coefficients=0):
+    rng = np.random.default_rng(0)
+    rotation = rng.normal(size=(n, 4))
+    gaussians = {
+        "xyz": rng.uniform(-1, 1, (n, 3)),
+        "f_dc": rng.uniform(-1, 1, (n, 3)),
+        "opacity": rng.uniform(-3, 3, n),
+        "scale": rng.uniform(-6, -2, (n, 3)),
+        "rotation": rotation / np.linalg.norm(rotation, axis=1, keepdims=True),
+    }
+    if sh_coefficients:
+        gaussians["f_rest"] = rng.uniform(-0.5, 0.5, (n, sh_coefficients))
+    return gaussians
+
+
+def test_round_trip(tmp_path):
+    # a partial last chunk
+    n = CHUNK_SIZE * 2 + 17
+    gaussians = make_gaussians(n, sh_coefficients=9)
+    path = tmp_path / "chair.compressed.ply"
+    size = write_compressed_ply(path, **gaussians)
+    assert size == path.stat().st_size
+    decoded = read_compressed_ply(path)
+
+    # the file is in Morton order
+    original = {name: values[morton_order(gaussians["xyz"].astype(np.float32))] for name, values in gaussians.items()}
+    assert np.abs(decoded["xyz"] - original["xyz"]).max() < 2e-3
+    assert np.abs(decoded["scale"] - original["scale"]).max() < 5e-3
+    assert np.abs(decoded["f_dc"] - original["f_dc"]).max() < 0.05
+    assert np.abs(decoded["f_rest"] - original["f_rest"]).max() < 0.02
+    alpha = 1 / (1 + np.exp(-original["opacity"]))
+    assert np.abs(1 / (1 + np.exp(-decoded["opacity"])) - alpha).max() < 3e-3
+    # q and -q are the same rotation
+    dots = np.abs((decoded["rotation"] * original["rotation"]).sum(axis=1))
+    assert dots.min() > 0.999
+
+
+def test_transform_gaussians():
+    # 90 degrees about x, y-up to z-up
+    matrix = np.array([[1, 0, 0], [0, 0, -1], [0, 1, 0]])
+    xyz, rotation = transform_gaussians(np.array([[0.0, 1.0, 0.0]]), np.array([[1.0, 0.0, 0.0, 0.0]]), matrix)
+    assert np.allclose(xyz, [[0, 0, 1]])
+    assert np.allclose(rotation, [matrix_to_quaternion(matrix)])
+    assert np.allclose(np.abs(rotation), [[np.sqrt(0.5), np.sqrt(0.5), 0, 0]])